@@ -1,6 +1,7 @@
 from amaranth.sim import Simulator
 
 from soc import SOC
+from bench_runner import run_bench
 
 soc = SOC()
 
@@ -19,5 +20,4 @@ sim = Simulator(soc)
 sim.add_clock(1e-6)
 sim.add_testbench(testbench)
 
-with sim.write_vcd('bench.vcd'):
-    sim.run_until(2e-5)
+run_bench(sim, 2e-5, gtkw_file=None)
@@ -1,6 +1,11 @@
 from amaranth.sim import Simulator
 
 from soc import SOC
+from clockworks import add_clocks, enable_simulation_clock
+from bench_runner import run_bench
+
+# The simulator drives the slow clock, see lib/clockworks.py
+enable_simulation_clock()
 
 soc = SOC()
 
@@ -13,12 +18,11 @@ async def testbench(ctx):
         if leds != prev_leds:
             print("LEDS = {:05b}".format(leds))
             prev_leds = leds
-        await ctx.tick()
+        await ctx.tick("slow")
 
 sim = Simulator(soc)
-sim.add_clock(1e-6)
+add_clocks(sim, 1e-6, soc)
 sim.add_testbench(testbench)
 
-with sim.write_vcd('bench.vcd'):
-    # Let's run for a quite long time
-    sim.run_until(2)
+# Let's run for a quite long time
+run_bench(sim, 2, gtkw_file=None)
@@ -24,6 +24,8 @@ class SOC(wiring.Component):
         # Add the clockwork to the top module. If this is not done,
         # the logic will not be instantiated.
         m.submodules.cw = cw
+        # add_clocks() in the bench reads the slow clock period from here
+        self.cw = cw
 
         # The clockwork provides a new clock domain called 'slow'.
         # We replace the default sync domain with the new one to have the
@@ -2,6 +2,11 @@ from amaranth import *
 from amaranth.sim import *
 
 from soc import SOC
+from clockworks import add_clocks, enable_simulation_clock
+from bench_runner import run_bench
+
+# The simulator drives the slow clock, see lib/clockworks.py
+enable_simulation_clock()
 
 soc = SOC()
 
@@ -18,9 +23,8 @@ def proc():
             prev_leds = leds
         yield
 
-sim.add_clock(1e-6)
-sim.add_sync_process(proc)
+add_clocks(sim, 1e-6, soc)
+sim.add_sync_process(proc, domain="slow")
 
-with sim.write_vcd('bench.vcd'):
-    # Let's run for a quite long time
-    sim.run_until(2)
+# Let's run for a quite long time
+run_bench(sim, 2, gtkw_file=None)
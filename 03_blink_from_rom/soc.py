@@ -14,6 +14,8 @@ class SOC(Elaboratable):
 
         cw = Clockworks(m, slow=21)
         m.submodules.cw = cw
+        # add_clocks() in the bench reads the slow clock period from here
+        self.cw = cw
 
         sequence = [
                 0b00000,
@@ -2,6 +2,12 @@ from amaranth import *
 from amaranth.sim import *
 
 from soc import SOC
+from clockworks import add_clocks, enable_simulation_clock
+from riscv_disassembler import disassemble
+from bench_runner import run_bench, StopAtSystem
+
+# The simulator drives the slow clock, see lib/clockworks.py
+enable_simulation_clock()
 
 soc = SOC()
 
@@ -15,7 +21,8 @@ def proc():
         pc = yield soc.pc
         if prev_pc != pc:
             print("pc={}".format(pc))
-            print("instr={:#032b}".format((yield soc.instr)))
+            instr = (yield soc.instr)
+            print("instr={:#032b} {}".format(instr, disassemble(instr)))
             print("LEDS = {:05b}".format((yield soc.leds)))
             if (yield soc.isALUreg):
                 print("ALUreg rd={} rs1={} rs2={} funct3={}".format(
@@ -35,9 +42,9 @@ def proc():
         yield
         prev_pc = pc
 
-sim.add_clock(1e-6)
-sim.add_sync_process(proc)
+add_clocks(sim, 1e-6, soc)
+sim.add_sync_process(proc, domain="slow")
 
-with sim.write_vcd('bench.vcd', 'bench.gtkw', traces=soc.ports):
-    # Let's run for a quite long time
-    sim.run_until(2, )
+# Let's run for a quite long time, or until the CPU reaches EBREAK
+run_bench(sim, 2, traces=soc.ports, domain="slow",
+          stop=[StopAtSystem(soc.isSystem)])
@@ -18,6 +18,8 @@ class SOC(Elaboratable):
 
         cw = Clockworks(m, slow=21)
         m.submodules.cw = cw
+        # add_clocks() in the bench reads the slow clock period from here
+        self.cw = cw
 
         # Instruction sequence to be executed
         sequence = [
@@ -2,41 +2,42 @@ from amaranth import *
 from amaranth.sim import *
 
 from soc import SOC
+from clockworks import add_clocks, enable_simulation_clock
+from riscv_disassembler import disassemble
+from bench_runner import run_bench, StopAtSystem
 
-soc = SOC()
+# The simulator drives the slow clock, see lib/clockworks.py
+enable_simulation_clock()
 
-prev_clk = 0
+soc = SOC()
 
 async def testbench(ctx):
     while True:
-        global prev_clk
-        clk = ctx.get(soc.slow_clk)
-        if prev_clk == 0 and prev_clk != clk:
-            print("pc={}".format(ctx.get(soc.pc)))
-            print("instr={:#032b}".format(ctx.get(soc.instr)))
-            print("LEDS = {:05b}".format(ctx.get(soc.leds)))
-            if ctx.get(soc.isALUreg):
-                print("ALUreg rd={} rs1={} rs2={} funct3={}".format(
-                    ctx.get(soc.rdId), ctx.get(soc.rs1Id), ctx.get(soc.rs2Id),
-                    ctx.get(soc.funct3)))
-            if ctx.get(soc.isALUimm):
-                print("ALUimm rd={} rs1={} imm={} funct3={}".format(
-                    ctx.get(soc.rdId), ctx.get(soc.rs1Id), ctx.get(soc.Iimm),
-                    ctx.get(soc.funct3)))
-            if ctx.get(soc.isLoad):
-                print("LOAD")
-            if ctx.get(soc.isStore):
-                print("STORE")
-            if ctx.get(soc.isSystem):
-                print("SYSTEM")
-                break
-        await ctx.tick()
-        prev_clk = clk
+        await ctx.tick("slow")
+        print("pc={}".format(ctx.get(soc.pc)))
+        instr = ctx.get(soc.instr)
+        print("instr={:#032b} {}".format(instr, disassemble(instr)))
+        print("LEDS = {:05b}".format(ctx.get(soc.leds)))
+        if ctx.get(soc.isALUreg):
+            print("ALUreg rd={} rs1={} rs2={} funct3={}".format(
+                ctx.get(soc.rdId), ctx.get(soc.rs1Id), ctx.get(soc.rs2Id),
+                ctx.get(soc.funct3)))
+        if ctx.get(soc.isALUimm):
+            print("ALUimm rd={} rs1={} imm={} funct3={}".format(
+                ctx.get(soc.rdId), ctx.get(soc.rs1Id), ctx.get(soc.Iimm),
+                ctx.get(soc.funct3)))
+        if ctx.get(soc.isLoad):
+            print("LOAD")
+        if ctx.get(soc.isStore):
+            print("STORE")
+        if ctx.get(soc.isSystem):
+            print("SYSTEM")
+            break
 
 sim = Simulator(soc)
-sim.add_clock(1e-6)
+add_clocks(sim, 1e-6, soc)
 sim.add_testbench(testbench)
 
-with sim.write_vcd('bench.vcd', 'bench.gtkw', traces=soc.ports):
-    # Let's run for a quite long time
-    sim.run_until(2, )
+# Let's run for a quite long time, or until the CPU reaches EBREAK
+run_bench(sim, 2, traces=soc.ports, domain="slow",
+          stop=[StopAtSystem(soc.isSystem)])
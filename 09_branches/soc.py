@@ -25,7 +25,7 @@ class SOC(Elaboratable):
 
         a.assemble()
         self.sequence = a.mem
-        print("memory = {}".format(self.sequence))
+        a.log("memory = {}", self.sequence)
 
     def elaborate(self, platform):
 
@@ -33,6 +33,8 @@ class SOC(Elaboratable):
 
         cw = Clockworks(m, slow=21, sim_slow=10)
         m.submodules.cw = cw
+        # add_clocks() in the bench reads the slow clock period from here
+        self.cw = cw
 
         # Program counter
         pc = Signal(32)
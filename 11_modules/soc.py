@@ -21,6 +21,8 @@ class SOC(Elaboratable):
         memory = DomainRenamer("slow")(Memory())
         cpu = DomainRenamer("slow")(CPU())
         m.submodules.cw = cw
+        # add_clocks() in the bench reads the slow clock period from here
+        self.cw = cw
         m.submodules.cpu = cpu
         m.submodules.memory = memory
 
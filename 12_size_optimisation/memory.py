@@ -17,7 +17,7 @@ class Memory(Elaboratable):
 
         a.assemble()
         self.instructions = a.mem
-        print("memory = {}".format(self.instructions))
+        a.log("memory = {}", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Array([Signal(32, reset=x, name="mem")
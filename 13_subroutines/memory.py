@@ -3,9 +3,15 @@ from riscv_assembler import RiscvAssembler
 
 class Memory(Elaboratable):
 
-    def __init__(self):
+    def __init__(self, simulation=False):
         a = RiscvAssembler()
 
+        # Keep the LED blinking short in simulation
+        if simulation:
+            slow_bit = 3
+        else:
+            slow_bit = 20
+
         a.read("""begin:
         ADD x10, x0, x0
 
@@ -17,17 +23,17 @@ class Memory(Elaboratable):
 
         wait:
         ADDI x11, x0, 1
-        SLLI x11, x11, 20
+        SLLI x11, x11, {slow_bit}
 
         l1:
         ADDI x11, x11, -1
         BNE x11, x0, l1
         JALR x0, x1, 0
-        """)
+        """.format(slow_bit=slow_bit))
 
         a.assemble()
         self.instructions = a.mem
-        print("memory = {}".format(self.instructions))
+        a.log("memory = {}", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Array([Signal(32, reset=x, name="mem")
@@ -3,9 +3,15 @@ from riscv_assembler import RiscvAssembler
 
 class Memory(Elaboratable):
 
-    def __init__(self):
+    def __init__(self, simulation=False):
         a = RiscvAssembler()
 
+        # Keep the LED blinking short in simulation
+        if simulation:
+            slow_bit = 3
+        else:
+            slow_bit = 20
+
         a.read("""begin:
         LI  a0, 0
 
@@ -17,17 +23,17 @@ class Memory(Elaboratable):
 
         wait:
         LI   a1, 1
-        SLLI a1, a1, 20
+        SLLI a1, a1, {slow_bit}
 
         l1:
         ADDI a1, a1, -1
         BNEZ a1, l1
         RET
-        """)
+        """.format(slow_bit=slow_bit))
 
         a.assemble()
         self.instructions = a.mem
-        print("memory = {}".format(self.instructions))
+        a.log("memory = {}", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Array([Signal(32, reset=x, name="mem")
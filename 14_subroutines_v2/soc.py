@@ -18,7 +18,7 @@ class SOC(Elaboratable):
 
         m = Module()
         cw = Clockworks(m)
-        memory = DomainRenamer("slow")(Memory())
+        memory = DomainRenamer("slow")(Memory(simulation=platform is None))
         cpu = DomainRenamer("slow")(CPU())
         m.submodules.cw = cw
         m.submodules.cpu = cpu
@@ -3,9 +3,15 @@ from riscv_assembler import RiscvAssembler
 
 class Memory(Elaboratable):
 
-    def __init__(self):
+    def __init__(self, simulation=False):
         a = RiscvAssembler()
 
+        # Keep the LED blinking short in simulation
+        if simulation:
+            slow_bit = 3
+        else:
+            slow_bit = 20
+
         a.read("""begin:
         LI  s0, 0
         LI  s1, 16
@@ -19,17 +25,17 @@ class Memory(Elaboratable):
 
         wait:
         LI   t0, 1
-        SLLI t0, t0, 20
+        SLLI t0, t0, {slow_bit}
 
         l1:
         ADDI t0, t0, -1
         BNEZ t0, l1
         RET
-        """)
+        """.format(slow_bit=slow_bit))
 
         a.assemble()
         self.instructions = a.mem
-        print("memory = {}".format(self.instructions))
+        a.log("memory = {}", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Array([Signal(32, reset=x, name="mem{}".format(i))
@@ -47,7 +53,7 @@ class Memory(Elaboratable):
         self.mem.append(0x0c0b0a09)
         self.mem.append(0xff0f0e0d)
 
-        print(self.mem)
+        a.log("{}", self.mem)
 
     def elaborate(self, platform):
         m = Module()
@@ -51,7 +51,7 @@ class Memory(Elaboratable):
         while len(self.instructions) < 256:
             self.instructions.append(0)
 
-        print("memory = {}".format(self.instructions))
+        a.log("memory = {}", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Array([Signal(32, reset=x, name="mem{}".format(i))
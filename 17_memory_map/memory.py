@@ -3,10 +3,18 @@ from riscv_assembler import RiscvAssembler
 
 class Mem(Elaboratable):
 
-    def __init__(self):
+    def __init__(self, simulation=False):
         a = RiscvAssembler()
 
+        # Keep the LED blinking short in simulation
+        if simulation:
+            slow_bit = 3
+        else:
+            slow_bit = 18
+
         a.read("""begin:
+        slow_bit equ {slow_bit}
+
         LI sp, 0x1800
         LI gp, 0x400000
 
@@ -39,24 +47,8 @@ class Mem(Elaboratable):
 
         EBREAK
 
-        wait:
-        LI t0, 1
-        SLLI t0, t0, 18
-
-        wait_loop:
-        ADDI t0, t0, -1
-        BNEZ t0, wait_loop
-        RET
-
-        putc:
-        SW a0, gp, 8
-        LI t0, 0x200
-        putc_loop:
-        LW t1, gp, 0x10
-        AND t1, t1, t0
-        BNEZ t1, putc_loop
-        RET
-        """)
+        ; wait and putc are linked from the runtime library
+        """.format(slow_bit=slow_bit))
 
         a.assemble()
         self.instructions = a.mem
@@ -65,7 +57,7 @@ class Mem(Elaboratable):
         while len(self.instructions) < (1024 * 6 / 4):
             self.instructions.append(0)
 
-        print("memory = {}".format(self.instructions))
+        a.log("memory = {}", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Memory(width=32, depth=len(self.instructions),
@@ -18,12 +18,15 @@ class SOC(Elaboratable):
 
     def elaborate(self, platform):
 
-        clk_frequency = int(platform.default_clk_constraint.frequency)
+        if platform is None:
+            clk_frequency = 12 * 1000000
+        else:
+            clk_frequency = int(platform.default_clk_constraint.frequency)
         print("clock frequency = {}".format(clk_frequency))
 
         m = Module()
         cw = Clockworks(m)
-        memory = DomainRenamer("slow")(Mem())
+        memory = DomainRenamer("slow")(Mem(simulation=platform is None))
         cpu = DomainRenamer("slow")(CPU())
         uart_tx = DomainRenamer("slow")(
                 UartTx(freq_hz=clk_frequency, baud_rate=345600))
@@ -35,6 +38,7 @@ class SOC(Elaboratable):
 
         self.cpu = cpu
         self.memory = memory
+        self.mem_wdata = cpu.mem_wdata
 
         ram_rdata = Signal(32)
         mem_wordaddr = Signal(30)
@@ -71,6 +75,7 @@ class SOC(Elaboratable):
 
         # UART
         uart_valid = Signal()
+        self.uart_valid = uart_valid
         uart_ready = Signal()
 
         m.d.comb += [
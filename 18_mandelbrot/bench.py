@@ -1,10 +1,28 @@
+import argparse
 from amaranth import *
 from amaranth.sim import *
 from ctypes import c_int32 as int32
 
 from soc import SOC
+from bench_runner import run_bench
+from checkpoint import Checkpointer, load
+from commit_trace import TraceWriter, CommitTracer
 
-soc = SOC()
+# python bench.py --save-checkpoint mandel.ckpt --at 200000
+#                                       save the state after 200000 cycles
+# python bench.py --checkpoint mandel.ckpt
+#                                       start from there instead of reset
+# python bench.py --commit-trace mandel.trace
+#                                       record the retired instructions,
+#                                       see lib/commit_trace.py
+parser = argparse.ArgumentParser(add_help=False)
+parser.add_argument("--checkpoint", metavar="FILE")
+parser.add_argument("--save-checkpoint", metavar="FILE")
+parser.add_argument("--at", type=int, default=100000, metavar="CYCLES")
+parser.add_argument("--commit-trace", metavar="FILE")
+args, _ = parser.parse_known_args()
+
+soc = SOC(checkpoint=load(args.checkpoint) if args.checkpoint else None)
 
 sim = Simulator(soc)
 
@@ -41,7 +59,21 @@ def proc():
 
 sim.add_clock(1e-6)
 sim.add_sync_process(proc)
+if args.save_checkpoint:
+    sim.add_testbench(Checkpointer(soc, args.save_checkpoint,
+                                   args.at).testbench, background=True)
+
+trace = None
+if args.commit_trace:
+    trace = TraceWriter(args.commit_trace)
+    sim.add_testbench(CommitTracer(soc.cpu, trace).testbench, background=True)
 
-with sim.write_vcd('bench.vcd', 'bench.gtkw', traces=soc.ports):
-    # Let's run for a quite long time
-    sim.run_until(2, )
+# Let's run for a quite long time
+try:
+    run_bench(sim, 2, traces=soc.ports)
+finally:
+    # Also write out the buffered records of an interrupted run
+    if trace is not None:
+        trace.close()
+        print("Wrote {} instructions to {}".format(trace.count,
+                                                   args.commit_trace))
@@ -0,0 +1,99 @@
+from amaranth.sim import Simulator
+
+from riscv_assembler import RiscvAssembler
+from riscv_cycles import CycleCount
+from soc import SOC
+
+# Check the static cycle counts of tools/riscv_cycles.py against the CPUs
+# they model. Small loops run on every CPU configuration, and the cycles of
+# one iteration are compared with the cost riscv_cycles.py gives the loop
+# body, including the taken branch back.
+#
+# Usage: python check_cycles.py
+
+configurations = {
+    "fsm":          {},
+    "fast_decode":  {"fast_decode": True},
+    "pipeline":     {"pipelined": True},
+    "harvard":      {"pipelined": True, "harvard": True},
+}
+
+loops = {
+    "ALU": """
+        loop:
+        ADDI    a1, a1, 1
+        ADDI    a0, a0, -1
+        BNEZ    a0, loop
+    """,
+    "load-use": """
+        loop:
+        LW      a1, zero, 0
+        ADDI    a1, a1, 1
+        ADDI    a0, a0, -1
+        BNEZ    a0, loop
+    """,
+}
+
+def assemble(body, iterations):
+    a = RiscvAssembler(verbose=False, listing=None, runtime=False)
+    a.read("""
+        LI      a0, {}
+        {}
+        EBREAK
+    """.format(iterations, body))
+    a.assemble()
+    return a
+
+def count_cycles(options, words, instructions):
+    # Cycles until the CPU has retired the given number of instructions
+    soc = SOC(firmware=words, **options)
+    sim = Simulator(soc)
+    result = {}
+
+    async def testbench(ctx):
+        cycles = 0
+        retired = 0
+        while retired < instructions:
+            retired += ctx.get(soc.cpu.retire)
+            cycles += 1
+            await ctx.tick("slow")
+        result["cycles"] = cycles
+
+    sim.add_clock(1e-6)
+    sim.add_testbench(testbench)
+    sim.run()
+    return result["cycles"]
+
+def measured(options, body):
+    # Cycles of one iteration, from the difference between 100 and 200
+    # iterations so that the prologue and pipeline fill cancel out
+    cycles = []
+    for iterations in (100, 200):
+        a = assemble(body, iterations)
+        loop = a.labels["LOOP"] // 4
+        length = len(a.mem) - 1 - loop
+        cycles.append(count_cycles(options, a.mem,
+                                   loop + iterations * length))
+    return (cycles[1] - cycles[0]) / 100
+
+def predicted(model, body):
+    a = assemble(body, 100)
+    c = CycleCount(a.mem, a.labels, model)
+    for first, last, n, cycles, taken in c.blocks:
+        if first == a.labels["LOOP"]:
+            return taken
+
+failures = 0
+for model, options in configurations.items():
+    for name, body in loops.items():
+        static = predicted(model, body)
+        simulated = measured(options, body)
+        ok = static == simulated
+        failures += not ok
+        print("  {:12} {:9} static={:3d} simulated={:6.2f} {}".format(
+            model, name, static, simulated, "ok" if ok else "MISMATCH"))
+
+if failures:
+    raise SystemExit("{} static cycle counts differ from the simulation"
+                     .format(failures))
+print("Static cycle counts match the simulation")
@@ -2,31 +2,64 @@ from amaranth import *
 
 class CPU(Elaboratable):
 
-    def __init__(self):
+    def __init__(self, rv32m=False, fast_decode=False, bram_regs=False,
+                 harvard=False, init=None):
+        # Optional RV32M extension: single cycle (DSP) multiplier and
+        # multi-cycle iterative divider
+        self.rv32m = rv32m
+        # Read the source registers while the instruction arrives from
+        # memory, which saves the FETCH_REGS state
+        self.fast_decode = fast_decode
+        # Implement the register bank as a memory with synchronous read
+        # ports (block RAM or LUT RAM) instead of flip-flops
+        self.bram_regs = bram_regs
+        # Fetch instructions through a separate instruction bus (imem_*)
+        # and use the mem_* bus for loads and stores only
+        self.harvard = harvard
+        # Initial pc, instr, FSM state, regs and x10, e.g. from a
+        # checkpoint (see lib/checkpoint.py)
+        self.init = init or {}
+
         self.mem_addr = Signal(32)
         self.mem_rstrb = Signal()
         self.mem_rdata = Signal(32)
         self.mem_wdata = Signal(32)
         self.mem_wmask = Signal(4)
-        self.x10 = Signal(32)
+        if self.harvard:
+            self.imem_addr = Signal(32)
+            self.imem_rstrb = Signal()
+            self.imem_rdata = Signal(32)
+        self.x10 = Signal(32, reset=self.init.get("x10", 0))
+        self.retire = Signal()
         self.fsm = None
 
     def elaborate(self, platform):
         m = Module()
 
+        init = self.init
+
         # Program counter
-        pc = Signal(32)
+        pc = Signal(32, reset=init.get("pc", 0))
         self.pc = pc
 
         # Memory
         mem_rdata = self.mem_rdata
+        if self.harvard:
+            instr_rdata = self.imem_rdata
+        else:
+            instr_rdata = self.mem_rdata
 
         # Current instruction
-        instr = Signal(32, reset=0b0110011)
+        instr = Signal(32, reset=init.get("instr", 0b0110011))
         self.instr = instr
 
         # Register bank
-        regs = Array([Signal(32, name="x"+str(x)) for x in range(32)])
+        regs_init = init.get("regs", [0] * 32)
+        if self.bram_regs:
+            regs = Memory(width=32, depth=32, name="regs", init=regs_init)
+        else:
+            regs = Array([Signal(32, name="x"+str(x), reset=regs_init[x])
+                          for x in range(32)])
         self.regs = regs
         rs1 = Signal(32)
         rs2 = Signal(32)
@@ -168,6 +201,54 @@ class CPU(Elaboratable):
             with m.Case("---"):
                 m.d.comb += takeBranch.eq(0)
 
+        # RV32M multiply / divide
+        if self.rv32m:
+            isMulDiv = Signal()
+            isDivide = Signal()
+            m.d.comb += [
+                isMulDiv.eq(isALUreg & (funct7 == 0b0000001)),
+                isDivide.eq(isMulDiv & funct3[2])
+            ]
+            self.isMulDiv = isMulDiv
+            self.isDivide = isDivide
+
+            # Multiplier: MUL, MULH, MULHSU, MULHU
+            # Both operands are extended to 33 bits, so that a single signed
+            # multiplier handles all sign combinations.
+            mulSign1 = Signal()
+            mulSign2 = Signal()
+            m.d.comb += [
+                mulSign1.eq(rs1[31] & (funct3[0] ^ funct3[1])),
+                mulSign2.eq(rs2[31] & (funct3 == 0b001))
+            ]
+            multiply = (Cat(rs1, mulSign1).as_signed() *
+                        Cat(rs2, mulSign2).as_signed())
+            mulOut = Mux(funct3 == 0b000, multiply[0:32], multiply[32:64])
+
+            # Divider: DIV, DIVU, REM, REMU
+            # Restoring divider, computing one quotient bit per cycle on the
+            # absolute values. The signs are fixed up at the end.
+            dividend = Signal(32)
+            divisor = Signal(63)
+            quotient = Signal(32)
+            quotientMsk = Signal(32)
+            divSigned = ~funct3[0]
+            divNegQuotient = Signal()
+            divNegRemainder = Signal()
+            divDone = Signal()
+            divSub = Signal(64)
+
+            m.d.comb += [
+                divSub.eq(Cat(dividend, C(0, 31)) - divisor),
+                divDone.eq(quotientMsk == 0)
+            ]
+
+            divResult = Mux(funct3[1],
+                            Mux(divNegRemainder, -dividend, dividend),
+                            Mux(divNegQuotient, -quotient, quotient))
+
+            mulDivOut = Mux(funct3[2], divResult, mulOut)
+
         # Next program counter is either next intstruction or depends on
         # jump target
         pcPlusImm = pc + Mux(instr[3], Jimm[0:32],
@@ -180,19 +261,29 @@ class CPU(Elaboratable):
                          pcPlus4))
 
         # Main state machine
-        with m.FSM(reset="FETCH_INSTR") as fsm:
+        with m.FSM(reset=init.get("state", "FETCH_INSTR")) as fsm:
             self.fsm = fsm
             with m.State("FETCH_INSTR"):
                 m.next = "WAIT_INSTR"
             with m.State("WAIT_INSTR"):
-                m.d.sync += instr.eq(self.mem_rdata)
-                m.next = ("FETCH_REGS")
-            with m.State("FETCH_REGS"):
-                m.d.sync += [
-                    rs1.eq(regs[rs1Id]),
-                    rs2.eq(regs[rs2Id])
-                ]
-                m.next = "EXECUTE"
+                m.d.sync += instr.eq(instr_rdata)
+                if self.fast_decode:
+                    if not self.bram_regs:
+                        m.d.sync += [
+                            rs1.eq(regs[instr_rdata[15:20]]),
+                            rs2.eq(regs[instr_rdata[20:25]])
+                        ]
+                    m.next = "EXECUTE"
+                else:
+                    m.next = ("FETCH_REGS")
+            if not self.fast_decode:
+                with m.State("FETCH_REGS"):
+                    if not self.bram_regs:
+                        m.d.sync += [
+                            rs1.eq(regs[rs1Id]),
+                            rs2.eq(regs[rs2Id])
+                        ]
+                    m.next = "EXECUTE"
             with m.State("EXECUTE"):
                 with m.If(~isSystem):
                     m.d.sync += pc.eq(nextPc)
@@ -200,6 +291,19 @@ class CPU(Elaboratable):
                     m.next = "LOAD"
                 with m.Elif(isStore):
                     m.next = "STORE"
+                if self.rv32m:
+                    with m.Elif(isDivide):
+                        m.d.sync += [
+                            dividend.eq(Mux(divSigned & rs1[31], -rs1, rs1)),
+                            divisor.eq(Cat(C(0, 31), Mux(divSigned & rs2[31],
+                                                         -rs2, rs2))),
+                            quotient.eq(0),
+                            quotientMsk.eq(1 << 31),
+                            divNegQuotient.eq(divSigned & (rs1[31] ^ rs2[31])
+                                              & rs2.any()),
+                            divNegRemainder.eq(divSigned & rs1[31])
+                        ]
+                        m.next = "DIVIDE"
                 with m.Else():
                     m.next = "FETCH_INSTR"
             with m.State("LOAD"):
@@ -208,6 +312,20 @@ class CPU(Elaboratable):
                 m.next = "FETCH_INSTR"
             with m.State("STORE"):
                 m.next = "FETCH_INSTR"
+            if self.rv32m:
+                with m.State("DIVIDE"):
+                    with m.If(divDone):
+                        m.next = "FETCH_INSTR"
+                    with m.Else():
+                        with m.If(~divSub[63]):
+                            m.d.sync += [
+                                dividend.eq(divSub[0:32]),
+                                quotient.eq(quotient | quotientMsk)
+                            ]
+                        m.d.sync += [
+                            divisor.eq(divisor[1:]),
+                            quotientMsk.eq(quotientMsk[1:])
+                        ]
 
         ## Load and store
 
@@ -263,31 +381,97 @@ class CPU(Elaboratable):
                     )
                 )
 
-        # Wire memory address to pc or loadStoreAddr
-        m.d.comb += [
-            self.mem_addr.eq(
-                Mux(fsm.ongoing("WAIT_INSTR") | fsm.ongoing("FETCH_INSTR"),
-                    pc, loadStoreAddr)),
-            self.mem_rstrb.eq(fsm.ongoing("FETCH_INSTR") | fsm.ongoing("LOAD")),
-            self.mem_wmask.eq(fsm.ongoing("STORE").replicate(4) & store_wmask)
-        ]
+        if self.harvard:
+            # Instructions and data on separate buses
+            m.d.comb += [
+                self.imem_addr.eq(pc),
+                self.imem_rstrb.eq(fsm.ongoing("FETCH_INSTR")),
+                self.mem_addr.eq(loadStoreAddr),
+                self.mem_rstrb.eq(fsm.ongoing("LOAD")),
+                self.mem_wmask.eq(
+                    fsm.ongoing("STORE").replicate(4) & store_wmask)
+            ]
+        else:
+            # Wire memory address to pc or loadStoreAddr
+            m.d.comb += [
+                self.mem_addr.eq(
+                    Mux(fsm.ongoing("WAIT_INSTR") | fsm.ongoing("FETCH_INSTR"),
+                        pc, loadStoreAddr)),
+                self.mem_rstrb.eq(
+                    fsm.ongoing("FETCH_INSTR") | fsm.ongoing("LOAD")),
+                self.mem_wmask.eq(
+                    fsm.ongoing("STORE").replicate(4) & store_wmask)
+            ]
 
 
         # Register write back
+        if self.rv32m:
+            aluOrMulDivOut = Mux(isMulDiv, mulDivOut, aluOut)
+        else:
+            aluOrMulDivOut = aluOut
+
         writeBackData = Mux((isJAL | isJALR), pcPlus4,
                             Mux(isLUI, Uimm,
                                 Mux(isAUIPC, pcPlusImm,
                                     Mux(isLoad, loadData,
-                                    aluOut))))
+                                    aluOrMulDivOut))))
 
         writeBackEn = ((fsm.ongoing("EXECUTE") & ~isBranch & ~isStore & ~isLoad)
                        | fsm.ongoing("WAIT_DATA"))
 
+        if self.rv32m:
+            # Division results are written back once the divider is done
+            writeBackEn = ((writeBackEn & ~isDivide)
+                           | (fsm.ongoing("DIVIDE") & divDone))
+
         self.writeBackData = writeBackData
+        self.writeBackEn = writeBackEn
+
+        # Flag the last cycle of every instruction
+        retire = (fsm.ongoing("EXECUTE") & ~isLoad & ~isStore) \
+                 | fsm.ongoing("WAIT_DATA") | fsm.ongoing("STORE")
+        if self.rv32m:
+            retire = ((retire & ~isDivide)
+                      | (fsm.ongoing("DIVIDE") & divDone))
+        m.d.comb += self.retire.eq(retire)
+
+
+        if self.bram_regs:
+            # The read ports are enabled in the same state in which the
+            # registers are latched otherwise, so the data is available in
+            # EXECUTE. The ports keep their data until the next instruction.
+            rs1_port = m.submodules.rs1_port = regs.read_port(
+                domain="sync", transparent=False)
+            rs2_port = m.submodules.rs2_port = regs.read_port(
+                domain="sync", transparent=False)
+            rd_port = m.submodules.rd_port = regs.write_port(domain="sync")
+
+            if self.fast_decode:
+                m.d.comb += [
+                    rs1_port.addr.eq(instr_rdata[15:20]),
+                    rs2_port.addr.eq(instr_rdata[20:25]),
+                    rs1_port.en.eq(fsm.ongoing("WAIT_INSTR")),
+                    rs2_port.en.eq(fsm.ongoing("WAIT_INSTR"))
+                ]
+            else:
+                m.d.comb += [
+                    rs1_port.addr.eq(rs1Id),
+                    rs2_port.addr.eq(rs2Id),
+                    rs1_port.en.eq(fsm.ongoing("FETCH_REGS")),
+                    rs2_port.en.eq(fsm.ongoing("FETCH_REGS"))
+                ]
 
+            m.d.comb += [
+                rs1.eq(rs1_port.data),
+                rs2.eq(rs2_port.data),
+                rd_port.addr.eq(rdId),
+                rd_port.data.eq(writeBackData),
+                rd_port.en.eq(writeBackEn & (rdId != 0))
+            ]
 
         with m.If(writeBackEn & (rdId != 0)):
-            m.d.sync += regs[rdId].eq(writeBackData)
+            if not self.bram_regs:
+                m.d.sync += regs[rdId].eq(writeBackData)
             # Also assign to debug output to see what is happening
             with m.If(rdId == 10):
                 m.d.sync += self.x10.eq(writeBackData)
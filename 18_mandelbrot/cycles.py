@@ -0,0 +1,63 @@
+import sys
+from amaranth.sim import Simulator
+
+from soc import SOC
+
+# Compare the number of CPU cycles the Mandelbrot firmware takes with the
+# different CPU options. Each configuration runs until it has sent the
+# given number of characters over the UART.
+#
+# Usage: python cycles.py [number_of_characters]
+
+configurations = [
+    ("multi-cycle",             {}),
+    ("multi-cycle, fast decode", {"fast_decode": True}),
+    ("multi-cycle, rv32m",      {"rv32m": True}),
+    ("fast decode, rv32m",      {"fast_decode": True, "rv32m": True}),
+    ("pipelined",               {"pipelined": True}),
+    ("pipelined, harvard",      {"pipelined": True, "harvard": True}),
+    ("pipelined, optimized",    {"pipelined": True, "optimize": True}),
+]
+
+if len(sys.argv) > 1:
+    n_chars = int(sys.argv[1])
+else:
+    n_chars = 20
+
+def count_cycles(options):
+    soc = SOC(**options)
+    sim = Simulator(soc)
+    result = {}
+
+    async def testbench(ctx):
+        cpu = soc.cpu
+        cycles = 0
+        instructions = 0
+        chars = 0
+        while chars < n_chars:
+            if ctx.get(soc.uart_valid):
+                chars += 1
+            if ctx.get(cpu.retire):
+                instructions += 1
+            cycles += 1
+            await ctx.tick("slow")
+        result["cycles"] = cycles
+        result["instructions"] = instructions
+
+    sim.add_clock(1e-6)
+    sim.add_testbench(testbench)
+    sim.run()
+    return result
+
+results = []
+for name, options in configurations:
+    results.append((name, count_cycles(options)))
+
+reference = results[0][1]["cycles"]
+print("Cycles for the first {} characters of the Mandelbrot set:".format(
+    n_chars))
+for name, result in results:
+    print("  {:26} cycles={:9d} instructions={:9d} CPI={:.2f} speedup={:.2f}"
+          .format(name, result["cycles"], result["instructions"],
+                  result["cycles"] / result["instructions"],
+                  reference / result["cycles"]))
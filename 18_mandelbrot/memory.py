@@ -3,24 +3,43 @@ from riscv_assembler import RiscvAssembler
 
 class Mem(Elaboratable):
 
-    def __init__(self):
-        a = RiscvAssembler()
+    def __init__(self, rv32m=False, simulation=False, dual_port=False,
+                 optimize=False, init=None, firmware=None):
+        # With dual_port, instructions are fetched through a separate read
+        # port, so that fetches and data accesses can overlap
+        self.dual_port = dual_port
+
+        # optimize runs the assembler's peephole optimizer on the firmware
+        a = RiscvAssembler(simulation=simulation, relax=True,
+                           optimize=optimize)
+
+        # Keep the LED blinking short in simulation
+        if simulation:
+            slow_bit = 1
+        else:
+            slow_bit = 18
+
+        # With the RV32M extension the multiplications are done by the CPU,
+        # otherwise the mulsi3 subroutine is called.
+        if rv32m:
+            mul = "MUL     a0, a0, a1"
+        else:
+            mul = "CALL    mulsi3"
 
         a.read("""begin:
 
         mandel_shift    equ 10
-        mandel_shift_m1 equ  9
-        mandel_mul      equ 1024    ; (1 << mandel_shift)
-        xmin            equ -2048   ; (-2 * mandel_mul)
-        xmax            equ 2028    ; ( 2 * mandel_mul)
-        ymin            equ -2048   ; (-2 * mandel_mul)
-        ymax            equ 2028    ; ( 2 * mandel_mul)
-        dx              equ 51      ; (xmax - xmin) / 80
-        dy              equ 51      ; (ymax - ymin) / 80
-        norm_max        equ 4096    ; (4 << mandel_shift)
-        io_leds         equ 4       ; (2 + 2)
-        slow_bit        equ 18      ; wait (1 << 18) clocks
-        ; slow_bit        equ 1      ; wait (1 << 18) clocks
+        mandel_shift_m1 equ mandel_shift - 1
+        mandel_mul      equ 1 << mandel_shift
+        xmin            equ -2 * mandel_mul
+        xmax            equ  2 * mandel_mul
+        ymin            equ -2 * mandel_mul
+        ymax            equ  2 * mandel_mul
+        dx              equ (xmax - xmin) / 80
+        dy              equ (ymax - ymin) / 80
+        norm_max        equ 4 << mandel_shift
+        io_leds         equ 4       ; word address bit 0
+        slow_bit        equ {slow_bit}      ; wait (1 << slow_bit) clocks
 
         LI      sp, 0x1800          ; end of RAM, 6 kB
         LI      gp, 0x400000        ; IO page
@@ -53,7 +72,7 @@ class Mem(Elaboratable):
 
         loop_y:
         LI      s0, 0
-        LI      s2, ymin ; (bug in LI?)
+        LI      s2, ymin
 
         loop_x:
         MV      s4, s2                  ; z <- c
@@ -65,15 +84,15 @@ class Mem(Elaboratable):
         loop_z:
         MV      a0, s4
         MV      a1, s4
-        CALL    mulsi3
+        {mul}
         SRLI    s6, a0, mandel_shift    ; s6=Zrr <- (Zr*Zr) >> mandel_shift
         MV      a0, s4
         MV      a1, s5
-        CALL    mulsi3
+        {mul}
         SRAI    s7, a0, mandel_shift_m1 ; s7=Zri <- (Zr*Zi) >> (mandelshift-1)
         MV      a0, s5
         MV      a1, s5
-        CALL    mulsi3
+        {mul}
         SRLI    s8, a0, mandel_shift    ; s8=Zii <- (Zi*Zi) >> mandelshift
         SUB     s4, s6, s8              ; s4=Zr <- Zrr - Zii + Cr
         ADD     s4, s4, s2
@@ -110,50 +129,23 @@ class Mem(Elaboratable):
 
         EBREAK
 
-        wait:
-        LI      t0, 1
-        SLLI    t0, t0, slow_bit
-        wait_loop:
-        ADDI    t0, t0, -1
-        BNEZ    t0, wait_loop
-        RET
-
-        mulsi3:                 ; integer multiplication
-        MV      a2, a0
-        LI      a0, 0
-        mulsi3_l0:
-        ANDI    a3, a1, 1
-        BEQZ    a3, mulsi3_l1
-        ADD     a0, a0, a2
-        mulsi3_l1:
-        SRLI    a1, a1, 1
-        SLLI    a2, a2, 1
-        BNEZ    a1, mulsi3_l0
-        RET
-
-        putc:                   ; Send one character
-        SW      a0, gp, 8       ; (1 << IO_UART_DAT_bit + 2)
-        LI      t0, 0x200       ; Test bit 9 (status bit) below
-        putc_loop:
-        LW      t1, gp, 0x10    ; (1 << IO_UART_CNTL_bit + 2)
-        AND     t1, t1, t0      ; Test
-        BNEZ    t1, putc_loop
-        RET
-
-        """)
+        ; wait, putc and mulsi3 are linked from the runtime library
+        """.format(mul=mul, slow_bit=slow_bit))
 
         a.assemble()
-        self.instructions = a.mem
+        # firmware, a list of words, runs instead of the Mandelbrot program
+        self.instructions = a.mem if firmware is None else list(firmware)
 
         # Add 0 memory up to offset 1024 / word 256
         while len(self.instructions) < (1024 * 6 / 4):
             self.instructions.append(0)
 
-        print("memory = {}".format(self.instructions))
+        a.log("memory = {}", self.instructions)
 
-        # Instruction memory initialised with above instructions
+        # Instruction memory initialised with above instructions, or with
+        # the RAM contents of a checkpoint
         self.mem = Memory(width=32, depth=len(self.instructions),
-                          init=self.instructions, name="mem")
+                          init=init or self.instructions, name="mem")
 
         self.mem_addr = Signal(32)
         self.mem_rdata = Signal(32)
@@ -161,6 +153,12 @@ class Mem(Elaboratable):
         self.mem_wdata = Signal(32)
         self.mem_wmask = Signal(4)
 
+        # Instruction read port
+        if self.dual_port:
+            self.imem_addr = Signal(32)
+            self.imem_rdata = Signal(32)
+            self.imem_rstrb = Signal()
+
     def elaborate(self, platform):
         m = Module()
 
@@ -190,4 +188,15 @@ class Mem(Elaboratable):
             w_port.data.eq(self.mem_wdata)
         ]
 
+        # Hook up instruction read port
+        if self.dual_port:
+            i_port = m.submodules.i_port = self.mem.read_port(
+                domain="sync", transparent=False
+            )
+            m.d.comb += [
+                i_port.addr.eq(self.imem_addr[2:32]),
+                i_port.en.eq(self.imem_rstrb),
+                self.imem_rdata.eq(i_port.data)
+            ]
+
         return m
@@ -0,0 +1,435 @@
+from amaranth import *
+
+# Five stage pipelined RV32I core: IF, ID, EX, MEM and WB.
+#
+# It exposes the same memory interface as the multi-cycle CPU, so it can
+# replace it in the SOC. Instruction fetch and data access share this single
+# memory bus, so fetching pauses while the MEM stage uses the bus. With
+# harvard=True, instructions are fetched over a separate imem_* bus instead
+# and fetching continues during loads and stores.
+#
+# Results are forwarded to EX from the EX/MEM and MEM/WB registers, and the
+# register bank is written through to ID. A load followed by an instruction
+# using its result stalls for one cycle. Taken branches, JAL and JALR are
+# resolved in EX, which flushes the instruction in ID and fetches from the
+# target right away.
+
+# ADD x0, x0, x0 is used as the bubble inserted into the pipeline
+NOP = 0b00000000000000000000000000110011
+
+class PipelineCPU(Elaboratable):
+
+    def __init__(self, harvard=False):
+        self.harvard = harvard
+
+        self.mem_addr = Signal(32)
+        self.mem_rstrb = Signal()
+        self.mem_rdata = Signal(32)
+        self.mem_wdata = Signal(32)
+        self.mem_wmask = Signal(4)
+        if self.harvard:
+            self.imem_addr = Signal(32)
+            self.imem_rstrb = Signal()
+            self.imem_rdata = Signal(32)
+        self.x10 = Signal(32)
+        self.retire = Signal()
+        self.fsm = None
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Memory
+        mem_rdata = self.mem_rdata
+        if self.harvard:
+            instr_rdata = self.imem_rdata
+        else:
+            instr_rdata = self.mem_rdata
+
+        # Register bank
+        regs = Array([Signal(32, name="x"+str(x)) for x in range(32)])
+        self.regs = regs
+
+        # Extend a signal with a sign bit repeated n times
+        def SignExtend(signal, sign, n):
+            return Cat(signal, sign.replicate(n))
+
+        # Opcodes
+        OP_ALUreg = 0b0110011
+        OP_ALUimm = 0b0010011
+        OP_Branch = 0b1100011
+        OP_JALR   = 0b1100111
+        OP_JAL    = 0b1101111
+        OP_AUIPC  = 0b0010111
+        OP_LUI    = 0b0110111
+        OP_Load   = 0b0000011
+        OP_Store  = 0b0100011
+        OP_System = 0b1110011
+
+        ## Pipeline registers, named after the two stages they sit between
+
+        # IF: program counter of the next instruction to fetch
+        F_PC = Signal(32)
+        self.pc = F_PC
+
+        # IF/ID: the fetched instruction arrives one cycle after
+        # the fetch. If ID cannot take it, it is held in FD_instrHeld.
+        FD_PC = Signal(32)
+        FD_nop = Signal(reset=1)
+        FD_held = Signal()
+        FD_instrHeld = Signal(32)
+
+        # ID/EX
+        DE_PC = Signal(32)
+        DE_valid = Signal()
+        DE_instr = Signal(32, reset=NOP)
+        DE_rs1 = Signal(32)
+        DE_rs2 = Signal(32)
+        self.instr = DE_instr
+
+        # EX/MEM
+        EM_valid = Signal()
+        EM_rdId = Signal(5)
+        EM_wen = Signal()
+        EM_isLoad = Signal()
+        EM_isStore = Signal()
+        EM_funct3 = Signal(3)
+        EM_result = Signal(32)    # result or load / store address
+        EM_rs2 = Signal(32)
+
+        # MEM/WB
+        MW_valid = Signal()
+        MW_rdId = Signal(5)
+        MW_wen = Signal()
+        MW_isLoad = Signal()
+        MW_funct3 = Signal(3)
+        MW_result = Signal(32)
+
+        ## WB: register write back
+
+        W_wen = MW_wen
+        W_rdId = MW_rdId
+        W_data = Signal(32)
+
+        loadHalfword = Signal(16)
+        loadByte = Signal(8)
+        loadSign = Signal()
+        loadData = Signal(32)
+        W_byteAccess = MW_funct3[0:2] == C(0, 2)
+        W_halfwordAccess = MW_funct3[0:2] == C(1, 2)
+
+        m.d.comb += [
+            loadHalfword.eq(Mux(MW_result[1], mem_rdata[16:32],
+                                mem_rdata[0:16])),
+            loadByte.eq(Mux(MW_result[0], loadHalfword[8:16],
+                            loadHalfword[0:8])),
+            loadSign.eq(~MW_funct3[2] & Mux(W_byteAccess, loadByte[7],
+                                            loadHalfword[15])),
+            loadData.eq(
+                Mux(W_byteAccess, SignExtend(loadByte, loadSign, 24),
+                    Mux(W_halfwordAccess, SignExtend(loadHalfword,
+                                                     loadSign, 16),
+                        mem_rdata))),
+            W_data.eq(Mux(MW_isLoad, loadData, MW_result))
+        ]
+
+        with m.If(W_wen):
+            m.d.sync += regs[W_rdId].eq(W_data)
+            # Also assign to debug output to see what is happening
+            with m.If(W_rdId == 10):
+                m.d.sync += self.x10.eq(W_data)
+
+        ## ID: instruction decode and register read
+
+        D_instr = Signal(32)
+        m.d.comb += D_instr.eq(Mux(FD_nop, NOP,
+                                   Mux(FD_held, FD_instrHeld, instr_rdata)))
+
+        D_rs1Id = D_instr[15:20]
+        D_rs2Id = D_instr[20:25]
+        D_opcode = D_instr[0:7]
+
+        D_readsRs1 = ~((D_opcode == OP_LUI) | (D_opcode == OP_AUIPC)
+                       | (D_opcode == OP_JAL))
+        D_readsRs2 = ((D_opcode == OP_ALUreg) | (D_opcode == OP_Branch)
+                      | (D_opcode == OP_Store))
+
+        # The register written back in this cycle is passed through
+        D_rs1 = Mux(W_wen & (W_rdId == D_rs1Id), W_data, regs[D_rs1Id])
+        D_rs2 = Mux(W_wen & (W_rdId == D_rs2Id), W_data, regs[D_rs2Id])
+
+        ## EX: execute
+
+        instr = DE_instr
+
+        isALUreg = Signal()
+        isALUimm = Signal()
+        isBranch = Signal()
+        isJALR   = Signal()
+        isJAL    = Signal()
+        isAUIPC  = Signal()
+        isLUI    = Signal()
+        isLoad   = Signal()
+        isStore  = Signal()
+        isSystem = Signal()
+        m.d.comb += [
+            isALUreg.eq(instr[0:7] == OP_ALUreg),
+            isALUimm.eq(instr[0:7] == OP_ALUimm),
+            isBranch.eq(instr[0:7] == OP_Branch),
+            isJALR.eq(instr[0:7] == OP_JALR),
+            isJAL.eq(instr[0:7] == OP_JAL),
+            isAUIPC.eq(instr[0:7] == OP_AUIPC),
+            isLUI.eq(instr[0:7] == OP_LUI),
+            isLoad.eq(instr[0:7] == OP_Load),
+            isStore.eq(instr[0:7] == OP_Store),
+            isSystem.eq(instr[0:7] == OP_System)
+        ]
+        self.isSystem = isSystem
+
+        Uimm = Signal(32)
+        Iimm = Signal(32)
+        Simm = Signal(32)
+        Bimm = Signal(32)
+        Jimm = Signal(32)
+        m.d.comb += [
+            Uimm.eq(Cat(Const(0).replicate(12), instr[12:32])),
+            Iimm.eq(Cat(instr[20:31], instr[31].replicate(21))),
+            Simm.eq(Cat(instr[7:12], instr[25:31], instr[31].replicate(21))),
+            Bimm.eq(Cat(0, instr[8:12], instr[25:31], instr[7],
+                instr[31].replicate(20))),
+            Jimm.eq(Cat(0, instr[21:31], instr[20], instr[12:20],
+                instr[31].replicate(12)))
+        ]
+
+        rs1Id = instr[15:20]
+        rs2Id = instr[20:25]
+        rdId = instr[7:12]
+        funct3 = instr[12:15]
+        funct7 = instr[25:32]
+
+        # Forwarding: the most recent result wins. Loads in MEM have no
+        # result yet, the load-use stall makes sure it is not needed.
+        EM_forward = EM_wen & ~EM_isLoad
+        rs1 = Signal(32)
+        rs2 = Signal(32)
+        m.d.comb += [
+            rs1.eq(Mux(EM_forward & (EM_rdId == rs1Id), EM_result,
+                       Mux(W_wen & (W_rdId == rs1Id), W_data, DE_rs1))),
+            rs2.eq(Mux(EM_forward & (EM_rdId == rs2Id), EM_result,
+                       Mux(W_wen & (W_rdId == rs2Id), W_data, DE_rs2)))
+        ]
+
+        # ALU
+        aluIn1 = Signal.like(rs1)
+        aluIn2 = Signal.like(rs2)
+        aluMinus = Signal(33)
+        aluPlus = Signal.like(aluIn1)
+        aluOut = Signal(32)
+        takeBranch = Signal()
+
+        m.d.comb += [
+            aluIn1.eq(rs1),
+            aluIn2.eq(Mux((isALUreg | isBranch), rs2, Iimm)),
+            aluMinus.eq(Cat(~aluIn2, C(1,1)) + Cat(aluIn1, C(0,1)) + 1),
+            aluPlus.eq(aluIn1 + aluIn2)
+        ]
+
+        EQ = aluMinus[0:32] == 0
+        LTU = aluMinus[32]
+        LT = Mux((aluIn1[31] ^ aluIn2[31]), aluIn1[31], aluMinus[32])
+
+        def flip32(x):
+            a = [x[i] for i in range(0, 32)]
+            return Cat(*reversed(a))
+
+        shifter_in = Mux(funct3 == 0b001, flip32(aluIn1), aluIn1)
+        shifter = (Cat(shifter_in,
+                       (instr[30] & aluIn1[31]))).as_signed() >> aluIn2[0:5]
+        leftshift = flip32(shifter)
+
+        with m.Switch(funct3):
+            with m.Case(0b000):
+                m.d.comb += aluOut.eq(Mux(funct7[5] & instr[5],
+                                          aluMinus[0:32], aluPlus))
+            with m.Case(0b001):
+                m.d.comb += aluOut.eq(leftshift)
+            with m.Case(0b010):
+                m.d.comb += aluOut.eq(LT)
+            with m.Case(0b011):
+                m.d.comb += aluOut.eq(LTU)
+            with m.Case(0b100):
+                m.d.comb += aluOut.eq(aluIn1 ^ aluIn2)
+            with m.Case(0b101):
+                m.d.comb += aluOut.eq(shifter)
+            with m.Case(0b110):
+                m.d.comb += aluOut.eq(aluIn1 | aluIn2)
+            with m.Case(0b111):
+                m.d.comb += aluOut.eq(aluIn1 & aluIn2)
+
+        with m.Switch(funct3):
+            with m.Case(0b000):
+                m.d.comb += takeBranch.eq(EQ)
+            with m.Case(0b001):
+                m.d.comb += takeBranch.eq(~EQ)
+            with m.Case(0b100):
+                m.d.comb += takeBranch.eq(LT)
+            with m.Case(0b101):
+                m.d.comb += takeBranch.eq(~LT)
+            with m.Case(0b110):
+                m.d.comb += takeBranch.eq(LTU)
+            with m.Case(0b111):
+                m.d.comb += takeBranch.eq(~LTU)
+            with m.Case("---"):
+                m.d.comb += takeBranch.eq(0)
+
+        # Jumps and taken branches redirect the fetch. System instructions
+        # jump to themselves, which halts the CPU like the multi-cycle core.
+        E_redirect = Signal()
+        E_target = Signal(32)
+        m.d.comb += [
+            E_redirect.eq((isBranch & takeBranch) | isJAL | isJALR
+                          | isSystem),
+            E_target.eq(
+                Mux(isSystem, DE_PC,
+                    Mux(isJALR, Cat(C(0, 1), aluPlus[1:32]),
+                        DE_PC + Mux(isJAL, Jimm, Bimm))))
+        ]
+
+        loadStoreAddr = rs1 + Mux(isStore, Simm, Iimm)
+
+        E_result = Mux((isJAL | isJALR), DE_PC + 4,
+                       Mux(isLUI, Uimm,
+                           Mux(isAUIPC, DE_PC + Uimm,
+                               Mux(isLoad | isStore, loadStoreAddr,
+                                   aluOut))))
+
+        m.d.sync += [
+            EM_valid.eq(DE_valid),
+            EM_rdId.eq(rdId),
+            EM_wen.eq(~isBranch & ~isStore & ~isSystem & (rdId != 0)),
+            EM_isLoad.eq(isLoad),
+            EM_isStore.eq(isStore),
+            EM_funct3.eq(funct3),
+            EM_result.eq(E_result),
+            EM_rs2.eq(rs2)
+        ]
+
+        ## MEM: load and store
+
+        M_byteAccess = EM_funct3[0:2] == C(0, 2)
+        M_halfwordAccess = EM_funct3[0:2] == C(1, 2)
+        M_addr = EM_result
+
+        m.d.comb += [
+            self.mem_wdata[ 0: 8].eq(EM_rs2[0:8]),
+            self.mem_wdata[ 8:16].eq(
+                Mux(M_addr[0], EM_rs2[0:8], EM_rs2[8:16])),
+            self.mem_wdata[16:24].eq(
+                Mux(M_addr[1], EM_rs2[0:8], EM_rs2[16:24])),
+            self.mem_wdata[24:32].eq(
+                Mux(M_addr[0], EM_rs2[0:8],
+                    Mux(M_addr[1], EM_rs2[8:16], EM_rs2[24:32])))
+        ]
+
+        store_wmask = Signal(4)
+        m.d.comb += store_wmask.eq(
+                Mux(M_byteAccess,
+                    Mux(M_addr[1],
+                        Mux(M_addr[0], 0b1000, 0b0100),
+                        Mux(M_addr[0], 0b0010, 0b0001)
+                        ),
+                    Mux(M_halfwordAccess,
+                        Mux(M_addr[1], 0b1100, 0b0011),
+                        0b1111)
+                    )
+                )
+
+        m.d.sync += [
+            MW_valid.eq(EM_valid),
+            MW_rdId.eq(EM_rdId),
+            MW_wen.eq(EM_wen),
+            MW_isLoad.eq(EM_isLoad),
+            MW_funct3.eq(EM_funct3),
+            MW_result.eq(EM_result)
+        ]
+
+        ## Hazards and memory bus arbitration
+
+        # Load-use hazard: the instruction in ID needs the result of the load
+        # in EX, which is only available in WB.
+        D_stall = Signal()
+        m.d.comb += D_stall.eq(
+            isLoad & (rdId != 0) &
+            ((D_readsRs1 & (D_rs1Id == rdId)) |
+             (D_readsRs2 & (D_rs2Id == rdId))))
+
+        fetchAddr = Signal(32)
+        fetch = Signal()
+        m.d.comb += fetchAddr.eq(Mux(E_redirect, E_target, F_PC))
+
+        if self.harvard:
+            m.d.comb += [
+                fetch.eq(~D_stall),
+                self.imem_addr.eq(fetchAddr),
+                self.imem_rstrb.eq(fetch),
+                self.mem_addr.eq(M_addr),
+                self.mem_rstrb.eq(EM_isLoad),
+                self.mem_wmask.eq(EM_isStore.replicate(4) & store_wmask)
+            ]
+        else:
+            # The MEM stage has priority on the memory bus
+            M_busy = Signal()
+            m.d.comb += [
+                M_busy.eq(EM_isLoad | EM_isStore),
+                fetch.eq(~M_busy & ~D_stall)
+            ]
+
+            m.d.comb += [
+                self.mem_addr.eq(Mux(M_busy, M_addr, fetchAddr)),
+                self.mem_rstrb.eq(Mux(M_busy, EM_isLoad, fetch)),
+                self.mem_wmask.eq(EM_isStore.replicate(4) & store_wmask)
+            ]
+
+        # IF and IF/ID
+        with m.If(fetch):
+            m.d.sync += [
+                F_PC.eq(fetchAddr + 4),
+                FD_PC.eq(fetchAddr),
+                FD_nop.eq(0),
+                FD_held.eq(0)
+            ]
+        with m.Elif(E_redirect):
+            m.d.sync += [
+                F_PC.eq(E_target),
+                FD_nop.eq(1),
+                FD_held.eq(0)
+            ]
+        with m.Elif(D_stall):
+            m.d.sync += [
+                FD_instrHeld.eq(D_instr),
+                FD_held.eq(1)
+            ]
+        with m.Else():
+            m.d.sync += [
+                FD_nop.eq(1),
+                FD_held.eq(0)
+            ]
+
+        # ID/EX: a bubble is inserted on a stall or a flush
+        with m.If(E_redirect | D_stall):
+            m.d.sync += [
+                DE_valid.eq(0),
+                DE_instr.eq(NOP)
+            ]
+        with m.Else():
+            m.d.sync += [
+                DE_valid.eq(~FD_nop),
+                DE_PC.eq(FD_PC),
+                DE_instr.eq(D_instr),
+                DE_rs1.eq(D_rs1),
+                DE_rs2.eq(D_rs2)
+            ]
+
+        # Instructions leave the pipeline in WB
+        m.d.comb += self.retire.eq(MW_valid)
+
+        return m
@@ -4,13 +4,33 @@ from amaranth import *
 from clockworks import Clockworks
 from memory import Mem
 from cpu import CPU
+from pipeline_cpu import PipelineCPU
 from uart_tx import UartTx
 
 class SOC(Elaboratable):
 
-    def __init__(self):
-
-        self.leds = Signal(5)
+    def __init__(self, rv32m=False, pipelined=False, fast_decode=False,
+                 bram_regs=False, harvard=False, optimize=False,
+                 checkpoint=None, firmware=None):
+
+        if rv32m and pipelined:
+            raise ValueError("The pipelined CPU does not support RV32M")
+        if checkpoint is not None and pipelined:
+            raise ValueError("Checkpoints only hold the state of the "
+                             "multi-cycle CPU")
+
+        self.rv32m = rv32m
+        self.pipelined = pipelined
+        self.fast_decode = fast_decode
+        self.bram_regs = bram_regs
+        self.harvard = harvard
+        self.optimize = optimize
+        # State to start from instead of reset, see lib/checkpoint.py
+        self.checkpoint = checkpoint or {}
+        # Words to run instead of the Mandelbrot firmware
+        self.firmware = firmware
+
+        self.leds = Signal(5, reset=self.checkpoint.get("leds", 0))
         self.tx = Signal()
 
         # Signals in this list can easily be plotted as vcd traces
@@ -18,15 +38,33 @@ class SOC(Elaboratable):
 
     def elaborate(self, platform):
 
-        clk_frequency = int(platform.default_clk_constraint.frequency)
+        simulation = platform is None
+
+        if simulation:
+            clk_frequency = 12 * 1000000
+        else:
+            clk_frequency = int(platform.default_clk_constraint.frequency)
         print("clock frequency = {}".format(clk_frequency))
 
         m = Module()
         cw = Clockworks(m)
-        memory = DomainRenamer("slow")(Mem())
-        cpu = DomainRenamer("slow")(CPU())
+        memory = DomainRenamer("slow")(Mem(rv32m=self.rv32m,
+                                           simulation=simulation,
+                                           dual_port=self.harvard,
+                                           optimize=self.optimize,
+                                           init=self.checkpoint.get("mem"),
+                                           firmware=self.firmware))
+        if self.pipelined:
+            cpu = DomainRenamer("slow")(PipelineCPU(harvard=self.harvard))
+        else:
+            cpu = DomainRenamer("slow")(CPU(rv32m=self.rv32m,
+                                            fast_decode=self.fast_decode,
+                                            bram_regs=self.bram_regs,
+                                            harvard=self.harvard,
+                                            init=self.checkpoint.get("cpu")))
         uart_tx = DomainRenamer("slow")(
-                UartTx(freq_hz=clk_frequency, baud_rate=345600))
+                UartTx(freq_hz=clk_frequency, baud_rate=345600,
+                       init=self.checkpoint.get("uart")))
 
         m.submodules.cw = cw
         m.submodules.cpu = cpu
@@ -35,6 +73,7 @@ class SOC(Elaboratable):
 
         self.cpu = cpu
         self.memory = memory
+        self.uart_tx = uart_tx
 
         ram_rdata = Signal(32)
         mem_wordaddr = Signal(30)
@@ -57,6 +96,13 @@ class SOC(Elaboratable):
 
         self.mem_wdata = cpu.mem_wdata
 
+        # Read data arrives one cycle after the read strobe. Remember whether
+        # RAM or IO was read, since the CPU may already drive the next
+        # address in that cycle (the pipelined CPU does).
+        rdataIsRAM = Signal()
+        with m.If(cpu.mem_rstrb):
+            m.d.slow += rdataIsRAM.eq(isRAM)
+
         # Connect memory to CPU
         m.d.comb += [
             memory.mem_addr.eq(cpu.mem_addr),
@@ -64,9 +110,17 @@ class SOC(Elaboratable):
             memory.mem_wdata.eq(cpu.mem_wdata),
             memory.mem_wmask.eq(isRAM.replicate(4) & cpu.mem_wmask),
             ram_rdata.eq(memory.mem_rdata),
-            cpu.mem_rdata.eq(Mux(isRAM, ram_rdata, io_rdata))
+            cpu.mem_rdata.eq(Mux(rdataIsRAM, ram_rdata, io_rdata))
         ]
 
+        # Instructions are only fetched from RAM
+        if self.harvard:
+            m.d.comb += [
+                memory.imem_addr.eq(cpu.imem_addr),
+                memory.imem_rstrb.eq(cpu.imem_rstrb),
+                cpu.imem_rdata.eq(memory.imem_rdata)
+            ]
+
         # LEDs
         with m.If(isIO & mem_wstrb & mem_wordaddr[IO_LEDS_bit]):
             m.d.sync += self.leds.eq(cpu.mem_wdata)
@@ -88,11 +142,12 @@ class SOC(Elaboratable):
             self.tx.eq(uart_tx.tx)
         ]
 
-        # Data from UART
-        m.d.comb += [
-            io_rdata.eq(Mux(mem_wordaddr[IO_UART_CNTL_bit],
-                Cat(C(0, 9), ~uart_ready, C(0, 22)), C(0, 32)))
-        ]
+        # Data from UART, registered like the RAM read data
+        with m.If(cpu.mem_rstrb):
+            m.d.slow += [
+                io_rdata.eq(Mux(mem_wordaddr[IO_UART_CNTL_bit],
+                    Cat(C(0, 9), ~uart_ready, C(0, 22)), C(0, 32)))
+            ]
 
 
         # Export signals for simulation
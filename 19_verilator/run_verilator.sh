@@ -2,6 +2,10 @@
 
 set -e
 
+# Manual flow for a design built for a board. verilate.py does all of this
+# for the simulation build of any step, with cached builds:
+#   python 19_verilator/verilate.py 18
+
 echo "Make sure:"
 echo "  - you've compiled a design previously, so build/top.v exists"
 echo "  - you've added the snippet.v to the 'top' module in build/top.v"
@@ -1,15 +1,20 @@
 #include "Vsoc.h"
 #include "verilated.h"
+#include <cstdlib>
 #include <iostream>
 
 int
 main(int argc, char **argv, char **env)
 {
+	// Optional argument: number of clock cycles to run for
+	unsigned long long max_cycles = argc > 1 ? strtoull(argv[1], 0, 0) : 0;
+	unsigned long long cycles = 0;
 	Vsoc top;
 	top.clk = 0;
-	while (!Verilated::gotFinish()) {
+	while (!Verilated::gotFinish() && (!max_cycles || cycles < max_cycles)) {
 		top.clk = !top.clk;
 		top.eval();
+		cycles += top.clk;
 	}
 	return 0;
 }
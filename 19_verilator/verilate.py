@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from amaranth import Module, Fragment
+from amaranth.back import verilog
+from amaranth.lib import wiring
+from amaranth.lib.wiring import Out
+
+# Run the SOC of any step in Verilator, straight from Python:
+#
+#   source env.sh
+#   python 19_verilator/verilate.py 18                 Mandelbrot
+#   python 19_verilator/verilate.py 18 -p rv32m --cycles 2000000
+#
+# Any step can be built, the SOCs with a UART are 17, 18 and tests/. The
+# SOC is elaborated for simulation (platform None, as in bench.py) and
+# written out with amaranth.back.verilog. The $write of the UART characters
+# from snippet.v is added to the top module, so nothing has to be edited by
+# hand. The generated C++ model is compiled into a cache directory named
+# after the hash of the Verilog, sim_main.cpp and the Verilator command
+# line. A design that did not change runs the binary compiled before.
+#
+# The cache lives in VERILATOR_CACHE, default
+# ~/.cache/learn-fpga-amaranth/verilator.
+
+here = os.path.dirname(os.path.abspath(__file__))
+root = os.path.dirname(here)
+
+default_cache_dir = os.environ.get("VERILATOR_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "learn-fpga-amaranth",
+                 "verilator"))
+
+verilator_flags = ["-DBENCH", "-DBOARD_FREQ=12", "-Wno-fatal",
+                   "--top-module", "soc", "-cc", "-exe"]
+
+# snippet.v for the generated top module, using its ports
+uart_hook = """
+  `ifdef BENCH
+  always @(posedge slow_clk)
+  begin
+      if(uart_valid)
+      begin
+          $write("%c", uart_data);
+          $fflush(32'h8000_0001);
+      end
+  end
+  `endif
+"""
+
+class VerilatorTop(wiring.Component):
+    # The SOC with the signals the UART hook needs as top level ports. The
+    # SOCs only create uart_valid, mem_wdata and slow_clk in elaborate(),
+    # so the SOC is elaborated here before the ports are connected. The
+    # slow clock is taken from the slow_clk the SOC exports, the slow
+    # domain itself is not visible outside the SOC since amaranth 0.6.
+
+    def __init__(self, soc):
+        self.soc = soc
+        self.uart = hasattr(soc, "tx")
+        ports = {"leds": Out(5)}
+        if self.uart:
+            ports.update({"tx": Out(1), "uart_valid": Out(1),
+                          "uart_data": Out(8), "slow_clk": Out(1)})
+        super().__init__(ports)
+
+    def elaborate(self, platform):
+        soc = self.soc
+        m = Module()
+        m.submodules.soc = Fragment.get(soc, platform)
+        m.d.comb += self.leds.eq(soc.leds)
+        if self.uart:
+            m.d.comb += [
+                self.tx.eq(soc.tx),
+                self.uart_valid.eq(soc.uart_valid),
+                self.uart_data.eq(soc.mem_wdata[0:8]),
+                self.slow_clk.eq(soc.slow_clk)
+            ]
+        return m
+
+def step_path(step):
+    # Directory of a step, from its number or its name
+    if os.path.isdir(os.path.join(root, step)):
+        return os.path.join(root, step)
+    try:
+        paths = glob.glob(os.path.join(root, "{:02d}_*".format(int(step))))
+    except ValueError:
+        paths = []
+    if not paths:
+        raise ValueError("no step '{}'".format(step))
+    return paths[0]
+
+def load_soc(step, **options):
+    # The SOC class of a step, constructed with the given options
+    path = step_path(step)
+    # Give priority to the step, as boards/top.py does
+    sys.path[:0] = [path, os.path.join(root, "lib"),
+                    os.path.join(root, "tools")]
+    from soc import SOC
+    return SOC(**options)
+
+def generate_verilog(soc):
+    top = VerilatorTop(soc)
+    text = verilog.convert(top, name="soc", emit_src=False)
+    if top.uart:
+        start = text.index("module soc(")
+        end = text.index("endmodule", start)
+        text = text[:end] + uart_hook + text[end:]
+    return text
+
+def design_hash(text):
+    h = hashlib.sha256()
+    h.update(text.encode())
+    with open(os.path.join(here, "sim_main.cpp"), "rb") as f:
+        h.update(f.read())
+    h.update(" ".join(verilator_flags).encode())
+    try:
+        version = subprocess.run(["verilator", "--version"], check=True,
+                                 capture_output=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        version = b""
+    h.update(version)
+    return h.hexdigest()
+
+def build(text, cache_dir=None, rebuild=False, jobs=None):
+    # Path of the Verilator binary for the Verilog text, compiled unless it
+    # is in the cache already
+    cache_dir = cache_dir or default_cache_dir
+    target = os.path.join(cache_dir, design_hash(text))
+    binary = os.path.join(target, "Vsoc")
+    if os.path.exists(binary) and not rebuild:
+        print("using cached build {}".format(target))
+        return binary
+
+    # Build next to the cache entry and rename, so that an interrupted
+    # build never leaves a half finished entry behind
+    os.makedirs(cache_dir, exist_ok=True)
+    work = tempfile.mkdtemp(dir=cache_dir)
+    try:
+        with open(os.path.join(work, "top.v"), "w") as f:
+            f.write(text)
+        shutil.copy(os.path.join(here, "sim_main.cpp"), work)
+        subprocess.run(["verilator"] + verilator_flags
+                       + ["sim_main.cpp", "top.v"], cwd=work, check=True)
+        subprocess.run(["make", "-C", "obj_dir", "-j{}".format(
+                            jobs or os.cpu_count() or 1), "-f", "Vsoc.mk"],
+                       cwd=work, check=True)
+        shutil.move(os.path.join(work, "obj_dir", "Vsoc"),
+                    os.path.join(work, "Vsoc"))
+        shutil.rmtree(os.path.join(work, "obj_dir"))
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        os.replace(work, target)
+    finally:
+        if os.path.exists(work):
+            shutil.rmtree(work)
+    return binary
+
+def run(binary, cycles=None):
+    # Runs the model, the UART output goes to stdout
+    args = [binary]
+    if cycles is not None:
+        args.append(str(cycles))
+    return subprocess.run(args).returncode
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build and run a step's SOC with Verilator")
+    parser.add_argument("step", help="step number or directory, e.g. 18")
+    parser.add_argument("-p", "--option", action="append", default=[],
+                        metavar="NAME",
+                        help="SOC option to switch on, e.g. rv32m or "
+                        "pipelined (may be repeated)")
+    parser.add_argument("--cycles", type=int,
+                        help="stop after this many clock cycles")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="build cache (default {})".format(
+                            default_cache_dir))
+    parser.add_argument("--rebuild", action="store_true",
+                        help="compile even if the design is in the cache")
+    parser.add_argument("--verilog", metavar="FILE",
+                        help="also write the Verilog to FILE")
+    parser.add_argument("--build-only", action="store_true",
+                        help="do not run the model")
+    args = parser.parse_args()
+
+    soc = load_soc(args.step, **{name: True for name in args.option})
+    text = generate_verilog(soc)
+    if args.verilog:
+        with open(args.verilog, "w") as f:
+            f.write(text)
+    binary = build(text, args.cache, args.rebuild)
+    if not args.build_only:
+        sys.exit(run(binary, args.cycles))
@@ -0,0 +1,260 @@
+import argparse
+import re
+import sys
+import time
+
+# Shared end of every bench.py: run the simulation and optionally write the
+# VCD trace.
+#
+#   python bench.py                       trace the whole run (default)
+#   python bench.py --no-trace            do not write a trace at all
+#   python bench.py --trace-window 0.1:0.2
+#                                         only trace from 0.1s to 0.2s
+#   python bench.py --until 0.5           stop after 0.5s instead of the
+#                                         bench's default
+#   python bench.py --max-cycles 10000    stop after 10000 CPU cycles
+#
+# A bench can also pass stop conditions, e.g.
+#
+#   run_bench(sim, 2, traces=soc.ports, domain="slow",
+#             stop=[StopAtSystem(cpu.isSystem),
+#                   StopOnUart(soc.uart_valid, soc.mem_wdata[0:8], "\n")])
+#
+# and the run ends as soon as one of them is met. The number of cycles and
+# the wall time are reported.
+#
+# Times are simulated seconds. Without a trace, or with a short window, long
+# firmware runs are not limited by writing millions of value changes to disk.
+
+UNITS = {"s": 1, "ms": 1e-3, "us": 1e-6, "ns": 1e-9, "ps": 1e-12,
+         "fs": 1e-15}
+
+class TraceWindow():
+    # File object for Simulator.write_vcd that only keeps the value changes
+    # between start and end seconds. The simulator does not allow starting
+    # a trace after time has advanced, so the changes before the window are
+    # folded into a single dump of all values at the window start instead.
+
+    def __init__(self, name, start, end):
+        self.name = name
+        self.file = open(name, "w")
+        self.start = start
+        self.end = end
+        self.header = []
+        self.in_header = True
+        self.before = True
+        self.after = False
+        self.values = {}
+        self.partial = ""
+
+    def write(self, text):
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.line(line)
+        return len(text)
+
+    def line(self, line):
+        if self.after:
+            return
+        if self.in_header:
+            self.header.append(line)
+            self.file.write(line + "\n")
+            if line.startswith("$enddefinitions"):
+                self.in_header = False
+                m = re.search(r"\$timescale\s+(\d+)\s*(\w+)\s+\$end",
+                              " ".join(self.header))
+                self.scale = int(m.group(1)) * UNITS[m.group(2)]
+                self.start_time = round(self.start / self.scale)
+                self.end_time = round(self.end / self.scale)
+            return
+        if line.startswith("#"):
+            time = int(line[1:])
+            if time > self.end_time:
+                self.file.write("#{}\n".format(self.end_time))
+                self.after = True
+                return
+            if self.before and time >= self.start_time:
+                self.before = False
+                self.file.write("#{}\n".format(self.start_time))
+                for value in self.values.values():
+                    self.file.write(value + "\n")
+                self.values = None
+                if time == self.start_time:
+                    return
+            elif self.before:
+                return
+        elif self.before:
+            if line and line[0] != "$":
+                # Value changes look like "1!" or "b0101 !"
+                key = line.rpartition(" ")[2] if " " in line else line[1:]
+                self.values[key] = line
+            return
+        self.file.write(line + "\n")
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.partial:
+            self.line(self.partial)
+            self.partial = ""
+        self.file.close()
+
+def time_window(text):
+    start, sep, end = text.partition(":")
+    if not sep:
+        raise argparse.ArgumentTypeError(
+            "expected start:end, got '{}'".format(text))
+    try:
+        start = float(start) if start else 0.0
+        end = float(end) if end else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "expected start:end in seconds, got '{}'".format(text))
+    if end is not None and end <= start:
+        raise argparse.ArgumentTypeError(
+            "trace window ends before it starts: '{}'".format(text))
+    return start, end
+
+def bench_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Run the simulation bench")
+    trace = parser.add_mutually_exclusive_group()
+    trace.add_argument("--no-trace", action="store_true",
+                       help="do not write a VCD trace")
+    trace.add_argument("--trace-window", type=time_window, metavar="START:END",
+                       help="only trace between START and END seconds")
+    parser.add_argument("--until", type=float, metavar="SECONDS",
+                        help="simulated time to run for")
+    parser.add_argument("--max-cycles", type=int, metavar="N",
+                        help="stop after N cycles of the bench's domain")
+    args, _ = parser.parse_known_args(sys.argv[1:] if argv is None else argv)
+    return args
+
+class StopAtSystem():
+    # The CPU reached EBREAK / ECALL
+
+    def __init__(self, isSystem):
+        self.isSystem = isSystem
+
+    def check(self, ctx, cycles):
+        if ctx.get(self.isSystem):
+            return "EBREAK/ECALL"
+
+class StopAtPc():
+
+    def __init__(self, pc, addr):
+        self.pc = pc
+        self.addr = addr
+
+    def check(self, ctx, cycles):
+        if ctx.get(self.pc) == self.addr:
+            return "pc=0x{:04x}".format(self.addr)
+
+class StopOnUart():
+    # The firmware sent the given byte sequence over the UART
+
+    def __init__(self, valid, data, sequence):
+        self.valid = valid
+        self.data = data
+        if isinstance(sequence, str):
+            sequence = sequence.encode()
+        self.sequence = bytes(sequence)
+        self.received = bytearray()
+
+    def check(self, ctx, cycles):
+        if ctx.get(self.valid):
+            self.received.append(ctx.get(self.data))
+            if self.received.endswith(self.sequence):
+                return "UART sent {!r}".format(self.sequence)
+            del self.received[:-len(self.sequence)]
+
+class StopAfterCycles():
+
+    def __init__(self, cycles):
+        self.cycles = cycles
+
+    def check(self, ctx, cycles):
+        if cycles >= self.cycles:
+            return "{} cycles".format(self.cycles)
+
+class StopBench(Exception):
+    pass
+
+class Watcher():
+    # Background testbench evaluating the stop conditions once per cycle of
+    # the given domain. When a condition is met it ends the simulation by
+    # raising StopBench out of Simulator.run_until().
+
+    def __init__(self, conditions, domain="sync"):
+        self.conditions = conditions
+        self.domain = domain
+        self.cycles = 0
+        self.reason = None
+
+    async def testbench(self, ctx):
+        conditions = self.conditions
+        while True:
+            for condition in conditions:
+                reason = condition.check(ctx, self.cycles)
+                if reason is not None:
+                    # Let the other testbenches see this cycle as well
+                    self.reason = reason
+                    await ctx.tick(self.domain)
+                    raise StopBench(reason)
+            await ctx.tick(self.domain)
+            self.cycles += 1
+
+def run_bench(sim, until, traces=(), vcd_file="bench.vcd",
+              gtkw_file="bench.gtkw", stop=(), domain="sync", argv=None):
+    # Runs the simulation for `until` seconds, or until one of the `stop`
+    # conditions is met. Returns the Watcher when there are stop conditions.
+    args = bench_arguments(argv)
+    if args.until is not None:
+        until = args.until
+
+    stop = list(stop)
+    if args.max_cycles is not None:
+        stop.append(StopAfterCycles(args.max_cycles))
+    watcher = None
+    if stop:
+        watcher = Watcher(stop, domain)
+        sim.add_testbench(watcher.testbench, background=True)
+
+    wall = time.perf_counter()
+    end = until
+    trace = not args.no_trace
+    if args.trace_window is not None:
+        start, end = args.trace_window
+        if end is None or end > until:
+            end = until
+        if end <= start:
+            trace = False
+        elif trace:
+            vcd_file = TraceWindow(vcd_file, start, end)
+
+    try:
+        if trace:
+            if gtkw_file is None:
+                vcd = sim.write_vcd(vcd_file)
+            else:
+                vcd = sim.write_vcd(vcd_file, gtkw_file, traces=traces)
+            with vcd:
+                sim.run_until(end)
+        if end < until or not trace:
+            sim.run_until(until)
+    except StopBench:
+        pass
+    wall = time.perf_counter() - wall
+
+    if watcher is not None:
+        reason = watcher.reason or "time limit of {}s".format(until)
+        print("Stopped at {} after {} {} cycles in {:.2f}s "
+              "({:.0f} cycles/s)".format(
+                  reason, watcher.cycles, domain, wall,
+                  watcher.cycles / wall if wall else 0))
+        watcher.wall = wall
+    return watcher
@@ -0,0 +1,94 @@
+import json
+
+# Checkpoints of the multi-cycle SOC of step 18: pc, instr, FSM state,
+# register bank, RAM, LEDs and UART transmitter. A simulation saves one
+# when it has got somewhere interesting,
+#
+#   checkpointer = Checkpointer(soc, "mandel.ckpt", cycles=200000)
+#   sim.add_testbench(checkpointer.testbench, background=True)
+#
+# and later simulations start from there instead of from reset:
+#
+#   soc = SOC(checkpoint=load("mandel.ckpt"))
+#
+# The state is restored through the initial values of the signals and the
+# memories, so the new simulation starts right at the checkpoint without
+# running any cycles to get there.
+#
+# Checkpoints are taken in FETCH_INSTR, between two instructions. The
+# registers only used while an instruction executes (rs1, rs2, the
+# divider, the read data) are not needed then and not saved.
+#
+# The file is JSON with the version below, the cycle the checkpoint was
+# taken at and the state as SOC(checkpoint=...) takes it.
+
+CHECKPOINT_VERSION = 1
+
+class CheckpointError(Exception):
+    pass
+
+def capture(ctx, soc, cycle=None):
+    # The state of the SOC as seen by the testbench context ctx
+    cpu = soc.cpu
+    uart = soc.uart_tx
+    memory = soc.memory.mem
+    state = cpu.fsm.decoding[ctx.get(cpu.fsm.state)]
+    if isinstance(state, tuple):
+        state = state[0]
+    return {
+        "version": CHECKPOINT_VERSION,
+        "cycle": cycle,
+        "leds": ctx.get(soc.leds),
+        "cpu": {
+            "pc": ctx.get(cpu.pc),
+            "instr": ctx.get(cpu.instr),
+            "state": state,
+            "regs": [ctx.get(cpu.regs[i]) for i in range(32)],
+            "x10": ctx.get(cpu.x10)
+        },
+        "mem": [ctx.get(memory[i]) for i in range(memory.depth)],
+        "uart": {
+            "cnt": ctx.get(uart.cnt),
+            "data": ctx.get(uart.shift),
+            "ready": ctx.get(uart.ready)
+        }
+    }
+
+def save(filename, checkpoint):
+    with open(filename, "w") as f:
+        json.dump(checkpoint, f)
+
+def load(filename):
+    with open(filename) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+        raise CheckpointError("{}: checkpoint version {}, expected {}".format(
+            filename, checkpoint.get("version"), CHECKPOINT_VERSION))
+    return checkpoint
+
+class Checkpointer():
+    # Background testbench saving a checkpoint at the first instruction
+    # boundary after the given number of cycles of the domain
+
+    def __init__(self, soc, filename, cycles, domain="slow"):
+        self.soc = soc
+        self.filename = filename
+        self.cycles = cycles
+        self.domain = domain
+        self.checkpoint = None
+
+    async def testbench(self, ctx):
+        cycle = 0
+        fsm = self.soc.cpu.fsm
+        fetch = fsm.encoding["FETCH_INSTR"]
+        while cycle < self.cycles or ctx.get(fsm.state) != fetch:
+            await ctx.tick(self.domain)
+            cycle += 1
+        # Cycles count from reset, also when this run started from a
+        # checkpoint itself
+        start = self.soc.checkpoint.get("cycle") or 0
+        self.checkpoint = capture(ctx, self.soc, start + cycle)
+        save(self.filename, self.checkpoint)
+        print("Saved checkpoint at cycle {} (pc=0x{:04x}) to {}".format(
+            self.checkpoint["cycle"], self.checkpoint["cpu"]["pc"],
+            self.filename))
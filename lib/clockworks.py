@@ -6,11 +6,30 @@ from amaranth.lib.wiring import In, Out
 
 clockworks_domain_name = "slow"
 
+# By default the divided clock is generated by the counter, in simulation
+# as on hardware. A bench can instead have the simulator drive it at the
+# divided period, which saves simulating 2^sim_slow idle cycles of the fast
+# clock for every cycle of the slow one:
+#
+#   enable_simulation_clock()       before the design is elaborated
+#   soc = SOC()
+#   sim = Simulator(soc)
+#   add_clocks(sim, 1e-6, soc)      finds the Clockworks as soc.cw
+#
+# The slow domain of a Clockworks elaborated this way has no clock of its
+# own, so only do this when the simulation adds it with add_clocks().
+simulation_clock = False
+
+def enable_simulation_clock(enable=True):
+    # Applies to the Clockworks created from now on (in SOC.elaborate())
+    global simulation_clock
+    simulation_clock = enable
+
 class Clockworks(wiring.Component):
 
     o_slow: Out(1)
 
-    def __init__(self, module, slow=0, sim_slow=None):
+    def __init__(self, module, slow=0, sim_slow=None, sim_clock=None):
 
         # Since amaranth 0.6 clock domains do not propagate upwards (RFC59)
         module.domains += ClockDomain(clockworks_domain_name)
@@ -24,6 +43,17 @@ class Clockworks(wiring.Component):
             self.sim_slow = slow
         else:
             self.sim_slow = sim_slow
+        if sim_clock is None:
+            self.sim_clock = simulation_clock
+        else:
+            self.sim_clock = sim_clock
+
+        # Period of the slow clock in periods of sync when the simulator
+        # drives it, None when the counter generates it
+        if self.slow != 0 and self.sim_clock:
+            self.sim_period_factor = 2 ** (self.sim_slow + 1)
+        else:
+            self.sim_period_factor = None
 
         super().__init__()
 
@@ -32,6 +62,12 @@ class Clockworks(wiring.Component):
         o_clk = Signal()
         m = Module()
 
+        if self.sim_period_factor is not None and platform is None:
+            # The simulator provides the slow clock, 'slow' toggles every
+            # 2^sim_slow cycles of 'sync' as with the counter below.
+            m.domains += ClockDomain("slow")
+            return m
+
         if self.slow != 0:
             # When the design is simulated, platform is None
             if platform is None:
@@ -57,3 +93,13 @@ class Clockworks(wiring.Component):
         m.d.comb += ClockSignal("slow").eq(o_clk)
 
         return m
+
+def add_clocks(sim, period, soc):
+    # Add the 'sync' clock with the given period and, if the Clockworks of
+    # the design (soc.cw) is driven by the simulator, the 'slow' clock at
+    # the divided period. Designs without soc.cw only get 'sync'.
+    sim.add_clock(period, if_exists=True)
+    cw = getattr(soc, "cw", None)
+    if cw is not None and cw.sim_period_factor is not None:
+        sim.add_clock(period * cw.sim_period_factor,
+                      domain=clockworks_domain_name)
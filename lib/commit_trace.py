@@ -0,0 +1,267 @@
+import argparse
+import mmap
+import struct
+
+# Binary trace of the instructions a CPU retires. Every instruction is one
+# fixed size record, so a trace of millions of instructions is written
+# without formatting any text and read back in bulk:
+#
+#   with TraceWriter("mandel.trace") as writer:
+#       sim.add_testbench(CommitTracer(soc.cpu, writer).testbench,
+#                         background=True)
+#       sim.run_until(1)
+#
+#   for chunk in read_trace("mandel.trace"):     numpy structured arrays
+#       print(np.unique(chunk["pc"], return_counts=True))
+#
+# MmapTraceWriter writes through a memory map instead of a buffer. numpy is
+# only imported by read_trace() and load_trace(), records() reads a trace
+# as tuples without it.
+#
+# The file starts with a 16 byte header (magic, version, record size) and
+# is followed by the records, all little endian:
+#
+#   offset  size  field
+#        0     8  cycle     cycle of the domain the instruction retired in
+#        8     4  pc
+#       12     4  instr
+#       16     4  value     value written to rd
+#       20     4  addr      byte address of a load or store
+#       24     4  data      value loaded or bytes stored (masked)
+#       28     1  rd        0 when no register is written
+#       29     1  wmask     byte mask of a store
+#       30     1  flags     WRITE, LOAD, STORE
+#       31     1  (padding)
+
+MAGIC = b"RVCT"
+TRACE_VERSION = 1
+HEADER = struct.Struct("<4sHHQ")
+RECORD = struct.Struct("<QIIIIIBBBx")
+
+FIELDS = ["cycle", "pc", "instr", "value", "addr", "data", "rd", "wmask",
+          "flags"]
+
+WRITE = 1
+LOAD = 2
+STORE = 4
+
+class TraceError(Exception):
+    pass
+
+def header():
+    return HEADER.pack(MAGIC, TRACE_VERSION, RECORD.size, 0)
+
+class TraceWriter():
+    # Collects the records in a buffer of buffer_records records and writes
+    # the buffer to the file when it is full
+
+    def __init__(self, filename, buffer_records=1 << 16):
+        self.file = open(filename, "wb")
+        self.file.write(header())
+        self.buffer = bytearray(RECORD.size * buffer_records)
+        self.offset = 0
+        self.count = 0
+
+    def write(self, cycle, pc, instr, rd=0, value=0, addr=0, data=0,
+              wmask=0, flags=0):
+        RECORD.pack_into(self.buffer, self.offset, cycle, pc, instr, value,
+                         addr, data, rd, wmask, flags)
+        self.offset += RECORD.size
+        self.count += 1
+        if self.offset == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.file.write(memoryview(self.buffer)[:self.offset])
+        self.offset = 0
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class MmapTraceWriter(TraceWriter):
+    # Writes the records straight into a memory map of the file, which
+    # grows by chunk_records records at a time and is cut to the size of
+    # the records written when it is closed
+
+    def __init__(self, filename, chunk_records=1 << 20):
+        self.file = open(filename, "w+b")
+        self.chunk = RECORD.size * chunk_records
+        self.size = HEADER.size + self.chunk
+        self.file.truncate(self.size)
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.map[0:HEADER.size] = header()
+        self.offset = HEADER.size
+        self.count = 0
+
+    def write(self, cycle, pc, instr, rd=0, value=0, addr=0, data=0,
+              wmask=0, flags=0):
+        if self.offset == self.size:
+            self.map.close()
+            self.size += self.chunk
+            self.file.truncate(self.size)
+            self.map = mmap.mmap(self.file.fileno(), self.size)
+        RECORD.pack_into(self.map, self.offset, cycle, pc, instr, value,
+                         addr, data, rd, wmask, flags)
+        self.offset += RECORD.size
+        self.count += 1
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.map.close()
+            self.file.truncate(self.offset)
+            self.file.close()
+            self.file = None
+
+def check_header(data, filename):
+    if len(data) < HEADER.size:
+        raise TraceError("{}: not a commit trace".format(filename))
+    magic, version, size, _ = HEADER.unpack(data[:HEADER.size])
+    if magic != MAGIC:
+        raise TraceError("{}: not a commit trace".format(filename))
+    if version != TRACE_VERSION or size != RECORD.size:
+        raise TraceError("{}: trace version {} with {} byte records, "
+                         "expected version {}".format(filename, version,
+                                                      size, TRACE_VERSION))
+
+def records(filename, chunk_records=1 << 16):
+    # The records as tuples in the order of FIELDS, without numpy
+    with open(filename, "rb") as f:
+        check_header(f.read(HEADER.size), filename)
+        while True:
+            data = f.read(RECORD.size * chunk_records)
+            if not data:
+                break
+            # A trace cut short by a crash ends in a partial record
+            end = len(data) - len(data) % RECORD.size
+            yield from RECORD.iter_unpack(data[:end])
+
+def trace_dtype():
+    import numpy as np
+    return np.dtype({
+        "names": FIELDS,
+        "formats": ["<u8", "<u4", "<u4", "<u4", "<u4", "<u4", "u1", "u1",
+                    "u1"],
+        "offsets": [0, 8, 12, 16, 20, 24, 28, 29, 30],
+        "itemsize": RECORD.size})
+
+def load_trace(filename):
+    # The whole trace as a read only numpy structured array, mapped from
+    # the file rather than read into memory
+    import numpy as np
+    with open(filename, "rb") as f:
+        check_header(f.read(HEADER.size), filename)
+    dtype = trace_dtype()
+    data = np.memmap(filename, dtype=np.uint8, mode="r")
+    n = (len(data) - HEADER.size) // RECORD.size
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.ndarray((n,), dtype=dtype, buffer=data, offset=HEADER.size)
+
+def read_trace(filename, chunk_records=1 << 20):
+    # The trace as numpy structured arrays of up to chunk_records records
+    trace = load_trace(filename)
+    for start in range(0, len(trace), chunk_records):
+        yield trace[start:start + chunk_records]
+
+class CommitTracer():
+    # Background testbench writing a record for every instruction the
+    # multi-cycle CPU of step 18 (or tests/) retires. The pc is taken in
+    # the cycle after a retire, when the CPU is fetching the next
+    # instruction, as Cosim does.
+
+    def __init__(self, cpu, writer, domain="slow"):
+        self.cpu = cpu
+        self.writer = writer
+        self.domain = domain
+
+    async def testbench(self, ctx):
+        cpu = self.cpu
+        write = self.writer.write
+        load_state = cpu.fsm.encoding["LOAD"]
+        cycle = 0
+        pc = 0
+        fetch = False
+        rd = value = addr = data = wmask = flags = 0
+        while True:
+            if fetch:
+                pc = ctx.get(cpu.pc)
+                fetch = False
+            if ctx.get(cpu.writeBackEn):
+                rd = ctx.get(cpu.instr[7:12])
+                if rd:
+                    value = ctx.get(cpu.writeBackData)
+                    flags |= WRITE
+                if flags & LOAD:
+                    data = value
+            if ctx.get(cpu.fsm.state) == load_state:
+                addr = ctx.get(cpu.mem_addr)
+                flags |= LOAD
+            store = ctx.get(cpu.mem_wmask)
+            if store:
+                wmask = store
+                addr = ctx.get(cpu.mem_addr) & ~3
+                data = ctx.get(cpu.mem_wdata) & sum(
+                    0xff << (8 * i) for i in range(4) if wmask & (1 << i))
+                flags |= STORE
+            if ctx.get(cpu.retire):
+                write(cycle, pc, ctx.get(cpu.instr), rd, value, addr, data,
+                      wmask, flags)
+                rd = value = addr = data = wmask = flags = 0
+                fetch = True
+            await ctx.tick(self.domain)
+            cycle += 1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Print or summarize a binary commit trace")
+    parser.add_argument("trace", help="trace file")
+    parser.add_argument("-n", "--head", type=int, metavar="N",
+                        help="only print the first N instructions")
+    parser.add_argument("--stats", action="store_true",
+                        help="summarize the trace with numpy instead")
+    args = parser.parse_args()
+
+    if args.stats:
+        try:
+            import numpy as np
+        except ImportError:
+            parser.error("--stats needs numpy")
+        trace = load_trace(args.trace)
+        print("{} instructions in {} cycles".format(
+            len(trace), int(trace["cycle"][-1]) + 1 if len(trace) else 0))
+        for name, flag in (("register writes", WRITE), ("loads", LOAD),
+                           ("stores", STORE)):
+            print("{:16} {}".format(name, np.count_nonzero(
+                trace["flags"] & flag)))
+        pcs, counts = np.unique(trace["pc"], return_counts=True)
+        print("most executed:")
+        for i in np.argsort(counts)[::-1][:10]:
+            print("  0x{:04x} {:10d}".format(pcs[i], counts[i]))
+    else:
+        from riscv_disassembler import disassemble
+        for i, r in enumerate(records(args.trace)):
+            if args.head is not None and i >= args.head:
+                break
+            cycle, pc, instr, value, addr, data, rd, wmask, flags = r
+            line = "{:10d} {:08x} {:08x} {:24}".format(
+                cycle, pc, instr, disassemble(instr, pc))
+            if flags & WRITE:
+                line += " x{}=0x{:08x}".format(rd, value)
+            if flags & LOAD:
+                line += " load [0x{:x}]".format(addr)
+            if flags & STORE:
+                line += " store [0x{:x}] mask={:04b} 0x{:08x}".format(
+                    addr, wmask, data)
+            print(line.rstrip())
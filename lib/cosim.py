@@ -0,0 +1,149 @@
+from riscv_sim import RiscvSim, Halt, MASK, IO_BIT, decodeIimm, decodeSimm
+
+# Lockstep co-simulation of the multi-cycle RTL CPU against the instruction
+# set simulator in tools/riscv_sim.py.
+#
+# Every time the CPU retires an instruction the reference simulator executes
+# the same instruction and the two are compared:
+#
+#  - the pc the instruction was fetched from
+#  - the register write (rd and value), if any
+#  - the memory store (word address, byte mask and stored bytes), if any
+#
+# The simulation stops at the first divergence with a short report, or when
+# the reference simulator reaches ECALL / EBREAK.
+#
+# Loads from IO are not compared. The value the CPU read (e.g. the UART busy
+# flag) is copied into the reference simulator instead.
+#
+# Usage:
+#
+#   cosim = Cosim(soc.cpu, soc.memory.instructions)
+#   sim.add_testbench(cosim.testbench)
+#
+# The reference accepts RV32M instructions only when the CPU does, taken
+# from cpu.rv32m (False for CPUs without the option) unless rv32m is given.
+
+class Divergence(Exception):
+    pass
+
+class Cosim():
+
+    def __init__(self, cpu, mem, ram_size=6 * 1024, rv32m=None,
+                 domain="slow", max_instructions=None, uart=None):
+        self.cpu = cpu
+        if rv32m is None:
+            rv32m = getattr(cpu, "rv32m", False)
+        self.ref = RiscvSim(mem, ram_size=ram_size, uart=uart, rv32m=rv32m)
+        self.domain = domain
+        self.max_instructions = max_instructions
+        self.instructions = 0
+        self.ok = None
+
+    def expected(self, instr):
+        # The register write and store the reference is about to make, which
+        # are only known before it executes the instruction
+        ref = self.ref
+        opcode = instr & 0x7f
+        rd = (instr >> 7) & 31
+        rs1 = ref.regs[(instr >> 15) & 31]
+        store = None
+        io_load = False
+        if opcode == 0b0100011:
+            addr = (rs1 + decodeSimm(instr)) & MASK
+            width = 1 << ((instr >> 12) & 3)
+            shift = addr & 3
+            wmask = ((1 << width) - 1) << shift
+            data = (ref.regs[(instr >> 20) & 31] << (shift * 8)) & MASK
+            store = (addr >> 2, wmask, data & bytemask(wmask))
+        elif opcode == 0b0000011:
+            io_load = bool((rs1 + decodeIimm(instr)) & IO_BIT)
+        if opcode in (0b1100011, 0b0100011, 0b1110011):
+            rd = 0
+        return rd, store, io_load
+
+    def report(self, pc, instr, what, expected, got):
+        print("cosim: divergence at instruction {}".format(
+            self.instructions))
+        print("  pc=0x{:04x} instr=0x{:08x}".format(pc, instr))
+        print("  {}: expected {} got {}".format(what, expected, got))
+
+    def check(self, pc, writes, stores):
+        ref = self.ref
+        if pc != ref.pc:
+            self.report(ref.pc, ref.load_word(ref.pc), "pc",
+                        "0x{:04x}".format(ref.pc), "0x{:04x}".format(pc))
+            raise Divergence()
+
+        instr = ref.load_word(pc)
+        rd, store, io_load = self.expected(instr)
+        ref.step()
+        self.instructions += 1
+
+        if io_load and rd and writes:
+            # Take the IO value from the CPU
+            ref.regs[rd] = writes[-1][1]
+        write = (rd, ref.regs[rd]) if rd else None
+        got = writes[-1] if writes else None
+        if write != got:
+            self.report(pc, instr, "register write", fmt_write(write),
+                        fmt_write(got))
+            raise Divergence()
+
+        got = stores[-1] if stores else None
+        if store != got:
+            self.report(pc, instr, "store", fmt_store(store), fmt_store(got))
+            raise Divergence()
+
+    async def testbench(self, ctx):
+        cpu = self.cpu
+        pc = 0
+        writes = []
+        stores = []
+        fetch = False
+        try:
+            while (self.max_instructions is None or
+                   self.instructions < self.max_instructions):
+                if fetch:
+                    pc = ctx.get(cpu.pc)
+                    fetch = False
+                if ctx.get(cpu.writeBackEn):
+                    rd = ctx.get(cpu.instr[7:12])
+                    if rd:
+                        writes.append((rd, ctx.get(cpu.writeBackData) & MASK))
+                wmask = ctx.get(cpu.mem_wmask)
+                if wmask:
+                    stores.append((ctx.get(cpu.mem_addr[2:32]), wmask,
+                                   ctx.get(cpu.mem_wdata) & bytemask(wmask)))
+                if ctx.get(cpu.retire):
+                    self.check(pc, writes, stores)
+                    writes = []
+                    stores = []
+                    fetch = True
+                await ctx.tick(self.domain)
+        except Halt:
+            print("cosim: reached ECALL/EBREAK at pc=0x{:04x} after {} "
+                  "instructions, no divergence".format(
+                      self.ref.pc, self.instructions))
+            self.ok = True
+            return
+        except Divergence:
+            self.ok = False
+            return
+        print("cosim: {} instructions, no divergence".format(
+            self.instructions))
+        self.ok = True
+
+def bytemask(wmask):
+    return sum(0xff << (8 * i) for i in range(4) if wmask & (1 << i))
+
+def fmt_write(write):
+    if write is None:
+        return "no write"
+    return "x{}=0x{:08x}".format(*write)
+
+def fmt_store(store):
+    if store is None:
+        return "no store"
+    return "[0x{:04x}] mask={:04b} data=0x{:08x}".format(
+        store[0] << 2, store[1], store[2])
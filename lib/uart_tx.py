@@ -11,16 +11,18 @@ from amaranth import *
 
 class UartTx(Elaboratable):
 
-    def __init__(self, freq_hz=0, baud_rate=57600):
+    def __init__(self, freq_hz=0, baud_rate=57600, init=None):
         self.freq_hz = freq_hz
         self.baud_rate = baud_rate
+        # Initial cnt, data and ready, e.g. from a checkpoint
+        self.init = init or {}
 
         # Inputs
         self.data = Signal(8)
         self.valid = Signal()
 
         # Outputs
-        self.ready = Signal()
+        self.ready = Signal(reset=self.init.get("ready", 0))
         self.tx = Signal()
 
     def elaborate(self, platform):
@@ -30,8 +32,10 @@ class UartTx(Elaboratable):
 
         print("UartTx: start_value = {}, width = {}".format(start_value, width))
 
-        cnt = Signal(width+1)
-        data = Signal(10)
+        cnt = Signal(width+1, reset=self.init.get("cnt", 0))
+        data = Signal(10, reset=self.init.get("data", 0))
+        self.cnt = cnt
+        self.shift = data
 
         ready = self.ready
         valid = self.valid
@@ -3,6 +3,7 @@ from amaranth.sim import *
 from ctypes import c_int32 as int32
 
 from soc import SOC
+from bench_runner import run_bench, StopAtSystem
 
 soc = SOC()
 
@@ -32,6 +33,6 @@ def proc():
 sim.add_clock(1e-6)
 sim.add_sync_process(proc)
 
-with sim.write_vcd('bench.vcd', 'bench.gtkw', traces=soc.ports):
-    # Let's run for a quite long time
-    sim.run_until(2, )
+# Let's run for a quite long time, or until the CPU reaches EBREAK
+run_bench(sim, 2, traces=soc.ports, domain="slow",
+          stop=[StopAtSystem(soc.cpu.isSystem)])
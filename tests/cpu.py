@@ -9,6 +9,7 @@ class CPU(Elaboratable):
         self.mem_wdata = Signal(32)
         self.mem_wmask = Signal(4)
         self.x10 = Signal(32)
+        self.retire = Signal()
         self.fsm = None
 
     def elaborate(self, platform):
@@ -285,7 +286,12 @@ class CPU(Elaboratable):
                        | fsm.ongoing("WAIT_DATA"))
 
         self.writeBackData = writeBackData
+        self.writeBackEn = writeBackEn
 
+        # Flag the last cycle of every instruction
+        m.d.comb += self.retire.eq(
+            (fsm.ongoing("EXECUTE") & ~isLoad & ~isStore)
+            | fsm.ongoing("WAIT_DATA") | fsm.ongoing("STORE"))
 
         with m.If(writeBackEn & (rdId != 0)):
             m.d.sync += regs[rdId].eq(writeBackData)
@@ -0,0 +1,17 @@
+from amaranth.sim import Simulator
+
+from soc import SOC
+from cosim import Cosim
+
+# Run the test program on the RTL CPU and the instruction set simulator in
+# lockstep and report the first point where they disagree.
+
+soc = SOC()
+
+sim = Simulator(soc)
+
+cosim = Cosim(soc.cpu, soc.memory.instructions)
+
+sim.add_clock(1e-6)
+sim.add_testbench(cosim.testbench)
+sim.run()
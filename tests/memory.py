@@ -12,7 +12,7 @@ class Mem(Elaboratable):
 
         self.instructions = a.mem
 
-        print("memory = {}".format(self.instructions))
+        a.log("memory = {}", self.instructions)
 
         # Instruction memory initialised with above instructions
         self.mem = Memory(width=32, depth=len(self.instructions),
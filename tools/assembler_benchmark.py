@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import os
+import time
+
+from riscv_assembler import RiscvAssembler
+
+# Assemble a generated program to check that the assembler stays linear in
+# the number of source lines. Every block of ten lines defines a label and
+# refers to labels before and after it, so the label table grows with the
+# program.
+#
+# Usage: python assembler_benchmark.py [-n lines] [--steps n]
+
+block = """block{i}:
+    ADDI  a0, a0, {imm}
+    ADD   a1, a0, a1
+    LI    a2, {big}
+    SLLI  a3, a2, 3
+    LW    a4, sp, 8
+    SW    a4, sp, 12
+    BNE   a0, a1, block{prev}
+    CALL  block{next}
+    J     block{i}"""
+
+def synthetic_source(lines):
+    n = max(lines // 10, 1)
+    return "\n".join(block.format(i=i, prev=max(i - 1, 0),
+                                  next=min(i + 1, n - 1),
+                                  imm=i % 2048, big=0x12345 + i)
+                     for i in range(n)) + "\nEBREAK\n"
+
+def assemble(text):
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            a = RiscvAssembler(cache=False, relax=True)
+            t0 = time.perf_counter()
+            a.read(text)
+            t1 = time.perf_counter()
+            a.assemble()
+            t2 = time.perf_counter()
+    return a, t1 - t0, t2 - t1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Time the assembler on a synthetic program")
+    parser.add_argument("-n", "--lines", type=int, default=100000,
+                        help="number of source lines (default 100000)")
+    parser.add_argument("--steps", type=int, default=4,
+                        help="also time this many smaller programs")
+    args = parser.parse_args()
+
+    sizes = [args.lines * (i + 1) // args.steps for i in range(args.steps)]
+    print("{:>8} {:>8} {:>9} {:>9} {:>12}".format(
+        "lines", "words", "read", "assemble", "us/line"))
+    for lines in sizes:
+        text = synthetic_source(lines)
+        n_lines = text.count("\n")
+        a, t_read, t_assemble = assemble(text)
+        print("{:8d} {:8d} {:8.2f}s {:8.2f}s {:12.2f}".format(
+            n_lines, len(a.mem), t_read, t_assemble,
+            (t_read + t_assemble) / n_lines * 1e6))
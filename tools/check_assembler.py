@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import os
+import subprocess
+import sys
+import tempfile
+
+from riscv_sim import RiscvSim
+from riscv_disassembler import disassemble
+
+# Check that a program assembled from several source files jumps and calls
+# across them: labels of the second file are at their place in the image,
+# not at their offset in the file.
+#
+# Usage: python check_assembler.py
+
+first = """
+        J       second
+        EBREAK
+"""
+
+second = """
+        NOP
+        second:
+        ADDI    a0, zero, 7
+        CALL    third
+        EBREAK
+"""
+
+third = """
+        third:
+        ADDI    a1, zero, 9
+        RET
+"""
+
+def assemble(directory, options):
+    # The image the command line assembler writes for the three files
+    paths = []
+    for name, text in (("first.S", first), ("second.S", second),
+                       ("third.S", third)):
+        path = os.path.join(directory, name)
+        with open(path, "w") as f:
+            f.write(text)
+        paths.append(path)
+    image = os.path.join(directory, "image.hex")
+    env = dict(os.environ, RISCV_ASM_CACHE="off")
+    subprocess.run([sys.executable, os.path.join(os.path.dirname(
+                        os.path.abspath(__file__)), "riscv_assembler.py"),
+                    "-q", "-o", image] + options + paths,
+                   check=True, env=env)
+    with open(image) as f:
+        return [int(line, 16) for line in f if line.strip()]
+
+failures = 0
+with tempfile.TemporaryDirectory() as directory:
+    for options in ([], ["-O"]):
+        words = assemble(directory, options)
+        sim = RiscvSim(words)
+        halted = sim.run(100)
+        ok = halted and sim.regs[10] == 7 and sim.regs[11] == 9
+        failures += not ok
+        print("  {:4} {} {}".format(" ".join(options) or "-",
+                                    disassemble(words[0], 0),
+                                    "ok" if ok else
+                                    "FAILED a0={} a1={}".format(
+                                        sim.regs[10], sim.regs[11])))
+
+if failures:
+    raise SystemExit("cross-file jumps or calls miss their target")
+print("Labels of all source files resolve to their place in the image")
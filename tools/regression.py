@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+# Run the bench of every step and check what it prints:
+#
+#   python tools/regression.py                 all steps, a worker per core
+#   python tools/regression.py 05 18 -j 2      only steps 05 and 18
+#   python tools/regression.py --junit benches.xml --json benches.json
+#
+# Every bench runs as "python bench.py --no-trace" in its own process, in
+# the directory of its step and with lib and tools on PYTHONPATH as env.sh
+# sets them. The steps all have their own soc, cpu and memory modules, so
+# they never share an interpreter. A thread pool keeps up to -j benches
+# running at the same time; the threads only wait for the processes.
+#
+# The output of a bench is checked against the expectations below:
+#
+#   leds    the LED values it prints ("LEDS = 00101"), with repeats removed,
+#           start with this sequence
+#   final   the last LED value it prints
+#   uart    the characters it prints as "out: 'c'" start with this text
+#   stop    the reason run_bench gives for stopping contains this text
+#   until   simulated seconds to run for instead of the bench's default
+#   timeout wall seconds before the bench is killed (default --timeout)
+#
+# A step fails when the bench exits with an error, times out or doesn't
+# meet its expectations.
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+expectations = {
+    "01_blink": {"leds": ["00001", "00010", "00011", "00100"]},
+    # The slow clock of 02-04 ticks every 4.2 simulated seconds
+    "02_slower_blinky": {"leds": ["00001", "00010", "00011", "00100"],
+                         "until": 20},
+    "03_blink_from_rom": {"leds": ["00001", "00010", "00100", "01000",
+                                   "10000"], "until": 25},
+    "04_instruction_decoder": {"leds": ["11000", "01000", "10100", "00100"],
+                               "final": "11111", "stop": "EBREAK",
+                               "until": 60},
+    "05_register_bank": {"leds": ["00010", "00100", "00001", "00010"],
+                         "stop": "EBREAK"},
+    "06_alu": {"leds": ["00010", "00100", "00001", "00010"],
+               "stop": "EBREAK"},
+    "07_assembler": {"leds": ["00010", "00100", "00001", "00010"],
+                     "stop": "EBREAK"},
+    "08_jumps": {"leds": ["00000", "00001", "00010", "00011"]},
+    "09_branches": {"leds": ["00000", "00001", "00010", "00011"],
+                    "stop": "EBREAK"},
+    "10_lui_auipc": {"leds": ["00000", "11111"], "final": "11111",
+                     "stop": "EBREAK"},
+    "11_modules": {"leds": ["00000", "11111", "00001", "00010"],
+                   "stop": "EBREAK"},
+    "12_size_optimisation": {"leds": ["00000", "11111", "00001", "00010"],
+                             "stop": "EBREAK"},
+    # 13-17 shorten their wait loops when elaborated for simulation
+    "13_subroutines": {"leds": ["{:05b}".format(i) for i in range(8)],
+                       "until": 0.02},
+    "14_subroutines_v2": {"leds": ["{:05b}".format(i) for i in range(8)],
+                          "until": 0.02},
+    "15_load": {"leds": ["{:05b}".format(i) for i in range(16)],
+                "final": "11111", "stop": "EBREAK"},
+    "16_store": {"leds": ["00000", "00001", "00010", "00011"],
+                 "final": "11111", "stop": "EBREAK"},
+    "17_memory_map": {"leds": ["{:05b}".format(i) for i in range(16)],
+                      "uart": "abcdefghijklmnopqrstuvwxyz", "until": 0.05},
+    "18_mandelbrot": {"uart": "@@@@", "until": 0.1},
+    "tests": {"stop": "EBREAK"},
+}
+
+led_line = re.compile(r"LEDS = ([01]{5})")
+uart_line = re.compile(r"out: '(.*)'$")
+stop_line = re.compile(r"^Stopped at (.*) after ")
+
+def bench_command(options):
+    command = [sys.executable, "bench.py", "--no-trace"]
+    if "until" in options:
+        command += ["--until", str(options["until"])]
+    return command
+
+def bench_environment():
+    env = dict(os.environ)
+    paths = [os.path.join(root, "lib"), os.path.join(root, "tools")]
+    if env.get("PYTHONPATH"):
+        paths.append(env["PYTHONPATH"])
+    env["PYTHONPATH"] = os.pathsep.join(paths)
+    return env
+
+def parse_output(text):
+    # LED values without repeats, UART text and the reason for stopping
+    leds = []
+    uart = []
+    stop = None
+    for line in text.splitlines():
+        m = led_line.search(line)
+        if m:
+            if not leds or leds[-1] != m.group(1):
+                leds.append(m.group(1))
+            continue
+        m = uart_line.search(line)
+        if m:
+            uart.append(m.group(1))
+            continue
+        m = stop_line.search(line)
+        if m:
+            stop = m.group(1)
+    return leds, "".join(uart), stop
+
+def check(options, leds, uart, stop):
+    # Failure messages, empty when the output meets the expectations
+    failures = []
+    if "leds" in options and leds[:len(options["leds"])] != options["leds"]:
+        failures.append("LEDs {} do not start with {}".format(
+            " ".join(leds[:8]) or "none", " ".join(options["leds"])))
+    if "final" in options and (not leds or leds[-1] != options["final"]):
+        failures.append("final LEDs {}, expected {}".format(
+            leds[-1] if leds else "none", options["final"]))
+    if "uart" in options and not uart.startswith(options["uart"]):
+        failures.append("UART output {!r} does not start with {!r}".format(
+            uart[:40], options["uart"]))
+    if "stop" in options and (stop is None or options["stop"] not in stop):
+        failures.append("stopped at {}, expected {}".format(
+            stop or "no stop report", options["stop"]))
+    return failures
+
+def run_step(step, options, timeout):
+    # Result of one bench as a dict, see the JSON summary
+    result = {"step": step, "failures": [], "leds": [], "uart": "",
+              "stop": None}
+    t0 = time.perf_counter()
+    try:
+        p = subprocess.run(bench_command(options),
+                           cwd=os.path.join(root, step),
+                           env=bench_environment(), stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                           timeout=options.get("timeout", timeout))
+        output = p.stdout.decode(errors="replace")
+        status = "passed"
+        if p.returncode != 0:
+            status = "error"
+            result["failures"].append("exit status {}".format(p.returncode))
+    except subprocess.TimeoutExpired as e:
+        output = (e.stdout or b"").decode(errors="replace")
+        status = "timeout"
+        result["failures"].append("no result after {}s".format(
+            options.get("timeout", timeout)))
+    result["time"] = time.perf_counter() - t0
+    leds, uart, stop = parse_output(output)
+    result.update(leds=leds, uart=uart, stop=stop)
+    if status != "timeout":
+        failures = check(options, leds, uart, stop)
+        if failures and status == "passed":
+            status = "failed"
+        result["failures"] += failures
+    result["status"] = status
+    # The end of the output is usually where it went wrong
+    result["output"] = "\n".join(output.splitlines()[-40:])
+    return result
+
+def junit(results, total_time):
+    suite = ET.Element("testsuite", name="benches", tests=str(len(results)),
+                       failures=str(sum(r["status"] == "failed"
+                                        for r in results)),
+                       errors=str(sum(r["status"] in ("error", "timeout")
+                                      for r in results)),
+                       time="{:.3f}".format(total_time))
+    for r in results:
+        case = ET.SubElement(suite, "testcase", classname="bench",
+                             name=r["step"], time="{:.3f}".format(r["time"]))
+        if r["status"] != "passed":
+            tag = "failure" if r["status"] == "failed" else "error"
+            ET.SubElement(case, tag, message="; ".join(r["failures"]))
+        ET.SubElement(case, "system-out").text = r["output"]
+    return ET.ElementTree(suite)
+
+def select_steps(names):
+    # Steps matching the given numbers or directory names, all by default
+    if not names:
+        return list(expectations)
+    steps = []
+    for name in names:
+        matches = [s for s in expectations
+                   if s == name or s.split("_")[0] == name.zfill(2)]
+        if not matches:
+            raise SystemExit("no step '{}'".format(name))
+        steps += [s for s in matches if s not in steps]
+    return steps
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run the benches of all steps and check their output")
+    parser.add_argument("steps", nargs="*",
+                        help="step numbers or directories (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="benches to run at the same time "
+                        "(default: number of cores)")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="wall seconds per bench (default 600)")
+    parser.add_argument("--junit", metavar="FILE",
+                        help="write a JUnit XML summary to FILE")
+    parser.add_argument("--json", metavar="FILE",
+                        help="write a JSON summary to FILE")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print the end of the output of failed steps")
+    args = parser.parse_args()
+
+    steps = select_steps(args.steps)
+    t0 = time.perf_counter()
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(run_step, step, expectations[step],
+                               args.timeout): step for step in steps}
+        for future in concurrent.futures.as_completed(futures):
+            r = future.result()
+            results[r["step"]] = r
+            print("{:24} {:8} {:7.1f}s  {}".format(
+                r["step"], r["status"], r["time"], "; ".join(r["failures"])),
+                flush=True)
+            if args.verbose and r["status"] != "passed":
+                print(r["output"])
+    total_time = time.perf_counter() - t0
+    results = [results[step] for step in steps]
+
+    passed = sum(r["status"] == "passed" for r in results)
+    print("{} of {} steps passed in {:.1f}s".format(passed, len(results),
+                                                     total_time))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"time": total_time, "passed": passed,
+                       "steps": results}, f, indent=2)
+    if args.junit:
+        junit(results, total_time).write(args.junit, encoding="unicode",
+                                          xml_declaration=True)
+    sys.exit(0 if passed == len(results) else 1)
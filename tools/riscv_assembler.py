@@ -1,5 +1,15 @@
 #!/usr/bin/env python3
+import argparse
+import array
+import hashlib
+import json
+import os
 import re
+import struct
+import sys
+import tempfile
+
+import riscv_runtime
 
 # instructions
 
@@ -16,6 +26,21 @@ RInstructions = [
     ("AND",  0b111, 0b0000000)
 ]
 ROps = [x[0] for x in RInstructions]
+ROpcodes = {op: (f3, f7) for op, f3, f7 in RInstructions}
+
+# RV32M extension
+MInstructions = [
+    ("MUL",    0b000, 0b0000001),
+    ("MULH",   0b001, 0b0000001),
+    ("MULHSU", 0b010, 0b0000001),
+    ("MULHU",  0b011, 0b0000001),
+    ("DIV",    0b100, 0b0000001),
+    ("DIVU",   0b101, 0b0000001),
+    ("REM",    0b110, 0b0000001),
+    ("REMU",   0b111, 0b0000001)
+]
+MOps = [x[0] for x in MInstructions]
+MOpcodes = {op: (f3, f7) for op, f3, f7 in MInstructions}
 
 IInstructions = [
     ("ADDI",  0b000),
@@ -26,6 +51,7 @@ IInstructions = [
     ("ANDI",  0b111)
 ]
 IOps = [x[0] for x in IInstructions]
+IOpcodes = {op: f3 for op, f3 in IInstructions}
 
 IRInstructions = [
     ("SLLI", 0b001, 0b0000000),
@@ -33,6 +59,7 @@ IRInstructions = [
     ("SRAI", 0b101, 0b0100000)
 ]
 IROps = [x[0] for x in IRInstructions]
+IROpcodes = {op: (f3, f7) for op, f3, f7 in IRInstructions}
 
 JInstructions = [
     ("JAL",  0b1101111),
@@ -49,12 +76,18 @@ BInstructions = [
     ("BGEU", 0b111)
 ]
 BOps = [x[0] for x in BInstructions]
+BOpcodes = {op: f3 for op, f3 in BInstructions}
+# Branch with the opposite condition, for branches relaxed into a branch
+# around a JAL
+BInverted = {"BEQ": "BNE", "BNE": "BEQ", "BLT": "BGE", "BGE": "BLT",
+             "BLTU": "BGEU", "BGEU": "BLTU"}
 
 UInstructions = [
     ("LUI",   0b0110111),
     ("AUIPC", 0b0010111)
 ]
 UOps = [x[0] for x in UInstructions]
+UOpcodes = {op: opcode for op, opcode in UInstructions}
 
 LInstructions = [
     ("LB",  0b000),
@@ -64,6 +97,7 @@ LInstructions = [
     ("LHU", 0b101)
 ]
 LOps = [x[0] for x in LInstructions]
+LOpcodes = {op: f3 for op, f3 in LInstructions}
 
 SInstructions = [
     ("SB",  0b000),
@@ -71,6 +105,7 @@ SInstructions = [
     ("SW",  0b010)
 ]
 SOps = [x[0] for x in SInstructions]
+SOpcodes = {op: f3 for op, f3 in SInstructions}
 
 SysInstructions = [
     ("FENCE",),
@@ -109,6 +144,374 @@ DebugInstructions = [
 ]
 DebugOps = [x[0] for x in DebugInstructions]
 
+# The assembler is quiet by default. The listing it used to print (labels,
+# pseudo ops, every encoded word) is available with RiscvAssembler(verbose=
+# True) on the console or RiscvAssembler(listing="file.lst") as a file. The
+# defaults come from the environment, so that the listing of firmware that
+# is assembled inside a SOC can be enabled for any bench:
+#
+#   RISCV_ASM_VERBOSE=1 python bench.py
+#   RISCV_ASM_LISTING=bench.lst python bench.py
+
+default_verbose = os.environ.get("RISCV_ASM_VERBOSE", "") not in ("", "0")
+default_listing = os.environ.get("RISCV_ASM_LISTING") or None
+
+# Assembled images are cached on disk, keyed by the source text, the
+# assembler options and the assembler itself. The cache lives in
+# RISCV_ASM_CACHE, default ~/.cache/learn-fpga-amaranth/asm, and is switched
+# off with RISCV_ASM_CACHE=off or RiscvAssembler(cache=False). A cache file
+# is a JSON header with the label and debug tables, followed by the words
+# as little endian 32-bit integers.
+
+ASSEMBLER_VERSION = 1
+
+default_cache_dir = os.environ.get("RISCV_ASM_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "learn-fpga-amaranth",
+                 "asm"))
+if default_cache_dir.lower() in ("", "0", "off", "none"):
+    default_cache_dir = None
+
+_assembler_hash = None
+
+def assembler_hash():
+    # Hash of this file and the runtime library, so that any change to the
+    # assembler invalidates the cache
+    global _assembler_hash
+    if _assembler_hash is None:
+        h = hashlib.sha256()
+        for filename in (__file__, riscv_runtime.__file__):
+            with open(filename, "rb") as f:
+                h.update(f.read())
+        _assembler_hash = h.hexdigest()
+    return _assembler_hash
+
+def cache_key(sources, *options):
+    # options are the assembler options that change the image
+    h = hashlib.sha256()
+    h.update("{} {} {}\n".format(ASSEMBLER_VERSION, assembler_hash(),
+                                  [bool(x) for x in options]).encode())
+    for text in sources:
+        h.update(text.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+def load_cached(cache_dir, key):
+    try:
+        with open(os.path.join(cache_dir, key + ".bin"), "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    view = memoryview(data)
+    size = int.from_bytes(view[0:4], "little")
+    tables = json.loads(bytes(view[4:4 + size]))
+    words = array.array("I")
+    words.frombytes(view[4 + size:])
+    if sys.byteorder != "little":
+        words.byteswap()
+    return words.tolist(), tables
+
+def store_cached(cache_dir, key, words, tables):
+    try:
+        words = array.array("I", words)
+    except (OverflowError, TypeError):
+        # Negative DATAW values are kept as they are and unhandled ops
+        # encode to None, don't cache those
+        return
+    if sys.byteorder != "little":
+        words.byteswap()
+    header = json.dumps(tables).encode()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(len(header).to_bytes(4, "little") + header
+                    + words.tobytes())
+        os.replace(tmp, os.path.join(cache_dir, key + ".bin"))
+    except OSError:
+        pass
+
+# Output files for tools outside Python, e.g. the Verilator flow:
+#
+#   .hex   one word per line in hex, for $readmemh
+#   .bin   the raw image, little endian
+#   .elf   a minimal ELF32 executable for RISC-V, the image as a single
+#          .text section loaded at address 0, with the labels in .symtab
+#
+# Each file is built in memory and written with a single write().
+
+def image_words(words):
+    words = array.array("I", (w & 0xffffffff for w in words))
+    if sys.byteorder != "little":
+        words.byteswap()
+    return words
+
+def hex_image(words):
+    return "".join("{:08x}\n".format(w & 0xffffffff)
+                   for w in words).encode()
+
+def bin_image(words):
+    return image_words(words).tobytes()
+
+def elf_image(words, labels=None):
+    text = bin_image(words)
+    labels = sorted((labels or {}).items(), key=lambda x: (x[1], x[0]))
+
+    strtab = bytearray(b"\0")
+    symtab = bytearray(16)
+    for name, pc in labels:
+        # Global symbols without type in section 1 (.text)
+        symtab += struct.pack("<IIIBBH", len(strtab), pc, 0, 0x10, 0, 1)
+        strtab += name.lower().encode() + b"\0"
+    shstrtab = bytearray(b"\0")
+    section_names = []
+    for name in (".text", ".symtab", ".strtab", ".shstrtab"):
+        section_names.append(len(shstrtab))
+        shstrtab += name.encode() + b"\0"
+
+    def aligned(offset):
+        return (offset + 3) & ~3
+
+    text_offset = 52 + 32
+    symtab_offset = aligned(text_offset + len(text))
+    strtab_offset = symtab_offset + len(symtab)
+    shstrtab_offset = strtab_offset + len(strtab)
+    sh_offset = aligned(shstrtab_offset + len(shstrtab))
+
+    header = struct.pack("<4sBBBB8xHHIIIIIHHHHHH",
+        b"\x7fELF", 1, 1, 1, 0,            # 32 bit, little endian
+        2, 243, 1,                          # executable, RISC-V
+        0, 52, sh_offset, 0,                # entry, phoff, shoff, flags
+        52, 32, 1, 40, 5, 4)
+    program_header = struct.pack("<IIIIIIII",
+        1, text_offset, 0, 0, len(text), len(text), 7, 4)
+    sections = struct.pack("<10I", *[0] * 10) + b"".join(
+        struct.pack("<10I", name, kind, flags, 0, offset, size, link, info,
+                    align, entsize)
+        for name, kind, flags, offset, size, link, info, align, entsize in [
+            (section_names[0], 1, 7, text_offset, len(text), 0, 0, 4, 0),
+            (section_names[1], 2, 0, symtab_offset, len(symtab), 3, 1, 4, 16),
+            (section_names[2], 3, 0, strtab_offset, len(strtab), 0, 0, 1, 0),
+            (section_names[3], 3, 0, shstrtab_offset, len(shstrtab), 0, 0, 1,
+             0)])
+
+    data = bytearray(header + program_header + text)
+    data += bytes(symtab_offset - len(data)) + symtab + strtab + shstrtab
+    data += bytes(sh_offset - len(data)) + sections
+    return bytes(data)
+
+image_formats = {".hex": "hex", ".bin": "bin", ".elf": "elf"}
+
+def write_image(filename, words, labels=None, format=None):
+    # The format is taken from the file extension unless given
+    if format is None:
+        format = image_formats.get(os.path.splitext(filename)[1].lower())
+        if format is None:
+            raise ValueError("Unknown output format of '{}', use .hex, .bin "
+                             "or .elf".format(filename))
+    if format == "hex":
+        data = hex_image(words)
+    elif format == "bin":
+        data = bin_image(words)
+    else:
+        data = elf_image(words, labels)
+    with open(filename, "wb") as f:
+        f.write(data)
+
+# Constant expressions, accepted by equ and wherever an immediate is
+# expected:
+#
+#   mandel_mul  equ 1 << mandel_shift
+#   dx          equ (xmax - xmin) / 80
+#   table_size  equ table_end - table
+#   ADDI        s2, s2, (xmax - xmin) / 80
+#
+# Operators, from lowest to highest precedence, are | ^ & << >> + - * / %
+# and the unary - + ~, with the C meaning (/ and % truncate towards zero).
+# Numbers are decimal, 0x hex or 0b binary. Names are constants, labels,
+# which stand for their address, or "." for the address of the current
+# instruction. A bare label as the immediate of a jump or branch is still
+# relative to the instruction, as before.
+#
+# %hi(x) and %lo(x) split a value for LUI / ADDI. LUI here takes the value
+# with its low 12 bits ignored (LUI x5, 0x30000), so %hi(x) is not shifted:
+#
+#   LUI   a0, %hi(x)
+#   ADDI  a0, a0, %lo(x)
+
+class ExpressionError(ValueError):
+    pass
+
+class UnresolvedName(ExpressionError):
+    # A name that has no value yet, e.g. a label while parsing
+    pass
+
+expression_tokens = re.compile(r"""\s*(?:
+    (?P<number>0[xX][0-9a-fA-F_]+|0[bB][01_]+|[0-9][0-9_]*) |
+    (?P<function>%hi|%lo|%HI|%LO) |
+    (?P<name>[A-Za-z_.][A-Za-z0-9_.]*) |
+    (?P<op><<|>>|[-+*/%&|^~()]))""", re.VERBOSE)
+
+binary_operators = [
+    {"|": lambda a, b: a | b},
+    {"^": lambda a, b: a ^ b},
+    {"&": lambda a, b: a & b},
+    {"<<": lambda a, b: a << b, ">>": lambda a, b: a >> b},
+    {"+": lambda a, b: a + b, "-": lambda a, b: a - b},
+    {"*": lambda a, b: a * b, "/": lambda a, b: divide(a, b),
+     "%": lambda a, b: a - b * divide(a, b)},
+]
+
+def divide(a, b):
+    if b == 0:
+        raise ExpressionError("division by zero")
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+# Value of an ALU op on constants, for the optimizer
+ConstantFolds = {
+    "ADDI":  lambda a, b: a + b,
+    "XORI":  lambda a, b: a ^ b,
+    "ORI":   lambda a, b: a | b,
+    "ANDI":  lambda a, b: a & b,
+    "SLTI":  lambda a, b: int(a < b),
+    "SLTIU": lambda a, b: int((a & 0xffffffff) < (b & 0xffffffff)),
+    "SLLI":  lambda a, b: a << b,
+    "SRLI":  lambda a, b: (a & 0xffffffff) >> b,
+    "SRAI":  lambda a, b: a >> b,
+}
+
+def hi_part(value):
+    return (value + 0x800) & 0xfffff000
+
+def lo_part(value):
+    return ((value & 0xfff) ^ 0x800) - 0x800
+
+def signed32(value):
+    if not -(1 << 31) <= value < (1 << 32):
+        raise ExpressionError("0x{:x} does not fit in 32 bits".format(value))
+    return ((value + (1 << 31)) & 0xffffffff) - (1 << 31)
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = expression_tokens.match(text, pos)
+        if m is None:
+            raise ExpressionError("can't parse '{}' at '{}'".format(
+                text, text[pos:].strip()))
+        tokens.append((m.lastgroup, m.group(m.lastgroup)))
+        pos = m.end()
+    return tokens
+
+def evaluate(text, lookup):
+    # Value of the expression in text. lookup(name) returns the value of a
+    # name, or raises UnresolvedName.
+    tokens = tokenize(text)
+    pos = 0
+
+    def peek():
+        return tokens[pos][1] if pos < len(tokens) else None
+
+    def expect(token):
+        if peek() != token:
+            raise ExpressionError("expected '{}' in '{}'".format(token, text))
+        advance()
+
+    def advance():
+        nonlocal pos
+        pos += 1
+
+    def binary(level):
+        if level == len(binary_operators):
+            return unary()
+        operators = binary_operators[level]
+        value = binary(level + 1)
+        while pos < len(tokens) and tokens[pos][0] == "op" \
+                and peek() in operators:
+            operator = operators[peek()]
+            advance()
+            value = operator(value, binary(level + 1))
+        return value
+
+    def unary():
+        if pos == len(tokens):
+            raise ExpressionError("unexpected end of '{}'".format(text))
+        kind, token = tokens[pos]
+        advance()
+        if kind == "number":
+            if token[:2] in ("0x", "0X", "0b", "0B"):
+                return int(token, 0)
+            return int(token)
+        if kind == "name":
+            return lookup(token)
+        if kind == "function":
+            expect("(")
+            value = binary(0)
+            expect(")")
+            return hi_part(value) if token.lower() == "%hi" else lo_part(value)
+        if token == "(":
+            value = binary(0)
+            expect(")")
+            return value
+        if token == "-":
+            return -unary()
+        if token == "+":
+            return unary()
+        if token == "~":
+            return ~unary()
+        raise ExpressionError("unexpected '{}' in '{}'".format(token, text))
+
+    value = binary(0)
+    if pos != len(tokens):
+        raise ExpressionError("unexpected '{}' in '{}'".format(peek(), text))
+    return value
+
+# .include "file" inserts the text of another source file. The path is
+# relative to the including file, and every file is included only once.
+
+include_directive = re.compile(r'^\s*\.include\s+"([^"]+)"\s*(;.*)?$',
+                               re.MULTILINE | re.IGNORECASE)
+
+def expand_includes(text, directory, seen):
+    def include(m):
+        filename = os.path.normpath(os.path.join(directory, m.group(1)))
+        if filename in seen:
+            return ""
+        seen.add(filename)
+        try:
+            with open(filename) as f:
+                included = f.read()
+        except OSError as e:
+            print("Can't include '{}': {}".format(m.group(1), e.strerror))
+            exit(1)
+        return expand_includes(included, os.path.dirname(filename), seen)
+    if ".include" not in text.lower():
+        return text
+    return include_directive.sub(include, text)
+
+# Runtime routines parsed once per process, by (name, relax, simulation)
+_compiled_routines = {}
+
+def compiled_routine(name, relax, simulation):
+    key = (name, bool(relax), bool(simulation))
+    if key not in _compiled_routines:
+        a = RiscvAssembler(simulation=simulation, verbose=False, listing=None,
+                           cache=False, relax=relax, runtime=False)
+        a.parse(riscv_runtime.routines[name])
+        _compiled_routines[key] = (a.instructions, a.labels, a.pseudos)
+    instructions, labels, pseudos = _compiled_routines[key]
+    return list(instructions), labels, pseudos
+
+name_pattern = re.compile(r"[A-Za-z_.][A-Za-z0-9_.]*")
+
+def referenced_names(instructions):
+    # Upper case names in the arguments of the instructions
+    text = " ".join(arg for inst in instructions for arg in inst.args)
+    return set(name_pattern.findall(text.upper()))
+
+labelref_split = re.compile('[ ()]+')
+
 class LabelRef():
     def __init__(self, op, name, arg):
         self.op = op
@@ -119,8 +522,7 @@ class LabelRef():
         return text
     @classmethod
     def fromString(cls, string):
-        r = re.compile('[ ()]+')
-        args = r.split(string)
+        args = labelref_split.split(string)
         op = args[1]
         name = args[2]
         arg = args[3]
@@ -188,21 +590,111 @@ def reg2int(arg):
         exit(-1)
 
 class RiscvAssembler():
-    def __init__(self, simulation = False):
+    def __init__(self, simulation = False, verbose = None, listing = None,
+                 cache = True, relax = False, optimize = False,
+                 runtime = True):
         self.pc = 0
         self.labels = {}
+        # Reverse index of self.labels, pc -> names of the labels at pc
+        self.pc_labels = {}
         self.constants = {}
         self.pseudos = {}
         self.instructions = []
         self.mem = []
         self.debug_args = []
         self.simulation = simulation
+        # Shortest CALLs and branches, see relaxInstructions(). Off by
+        # default, the tutorial steps explain CALL as AUIPC + JALR.
+        self.relax = relax
+        self.optimize = optimize
+        # Link routines of riscv_runtime.py the program uses
+        self.runtime = runtime
+        self.optimized = None
+        self.verbose = default_verbose if verbose is None else verbose
+        self.listing = default_listing if listing is None else listing
+        self.listing_lines = []
+        self.logging = self.verbose or self.listing is not None
+        # A cache hit has no listing, so don't use the cache when one is
+        # wanted. Sources are parsed in assemble() when the cache is used.
+        if cache and not self.logging:
+            self.cache_dir = default_cache_dir if cache is True else cache
+        else:
+            self.cache_dir = None
+        self.sources = []
+        self.from_cache = False
 
-        print("Simulation = ", "OFF" if simulation==False else "ON")
+        # Encoder for every opcode
+        self.encoders = {}
+        for ops, encoder in [
+                (ROps, self.encodeRops),
+                (MOps, self.encodeMops),
+                (IOps, self.encodeIops),
+                (IROps, self.encodeIRops),
+                (JOps, self.encodeJops),
+                (BOps, self.encodeBops),
+                (UOps, self.encodeUops),
+                (LOps, self.encodeLops),
+                (SOps, self.encodeSops),
+                (SysOps, self.encodeSysops),
+                (MemOps, self.encodeMemops),
+                (DebugOps, self.encodeDebugops)]:
+            for op in ops:
+                self.encoders[op] = encoder
+
+        self.log("Simulation =  {}", "OFF" if simulation==False else "ON")
+
+    def log(self, fmt, *args):
+        # Arguments are only formatted when the text goes somewhere
+        if self.logging:
+            text = fmt.format(*args)
+            if self.verbose:
+                print(text)
+            if self.listing is not None:
+                self.listing_lines.append(text)
+
+    def write_listing(self, filename=None):
+        with open(filename or self.listing, "w") as f:
+            for line in self.listing_lines:
+                f.write(line + "\n")
 
     def assemble(self):
+        if self.cache_dir is not None:
+            key = cache_key(self.sources, self.simulation, self.relax,
+                            self.optimize, self.runtime)
+            cached = load_cached(self.cache_dir, key)
+            if cached is not None:
+                self.mem, tables = cached
+                self.labels = tables["labels"]
+                self.pseudos = {int(pc): op
+                                for pc, op in tables["pseudos"].items()}
+                self.debug_args = [tuple(x) for x in tables["debug_args"]]
+                self.optimized = tables.get("optimized")
+                for label, pc in self.labels.items():
+                    self.pc_labels.setdefault(pc, []).append(label)
+                self.pc = len(self.mem) * 4
+                self.from_cache = True
+                return
+            for text in self.sources:
+                self.parse(text)
+
+        if self.runtime:
+            self.link()
+        if self.optimize:
+            self.optimizeInstructions()
+        if self.relax:
+            self.relaxInstructions()
+
         for inst in self.instructions:
             self.mem.append(self.encode(inst))
+        if self.listing is not None:
+            self.write_listing()
+
+        if self.cache_dir is not None:
+            store_cached(self.cache_dir, key, self.mem, {
+                "labels": self.labels,
+                "pseudos": self.pseudos,
+                "debug_args": self.debug_args,
+                "optimized": self.optimized})
 
     def encodeR(self, f7, rs2, rs1, f3, rd, op):
         return ((f7 << 25) | (rs2 << 20) | (rs1 << 15)
@@ -238,56 +730,59 @@ class RiscvAssembler():
 
     def encodeRops(self, instruction):
         rd, rs1, rs2 = [reg2int(x) for x in instruction.args]
-        _, f3, f7 = [x for x in RInstructions if x[0] == instruction.op][0]
+        f3, f7 = ROpcodes[instruction.op]
+        return self.encodeR(f7, rs2, rs1, f3, rd, 0b0110011)
+
+    def encodeMops(self, instruction):
+        rd, rs1, rs2 = [reg2int(x) for x in instruction.args]
+        f3, f7 = MOpcodes[instruction.op]
         return self.encodeR(f7, rs2, rs1, f3, rd, 0b0110011)
 
     def encodeIops(self, instruction):
         rd, rs = reg2int(instruction.args[0]), reg2int(instruction.args[1])
         imm = self.imm2int(instruction.args[2])
-        _, f3 = [x for x in IInstructions if x[0] == instruction.op][0]
+        f3 = IOpcodes[instruction.op]
         return self.encodeI(imm, rs, f3, rd, 0b0010011)
 
     def encodeIRops(self, instruction):
         rd, rs = reg2int(instruction.args[0]), reg2int(instruction.args[1])
         imm = self.imm2int(instruction.args[2])
-        _, f3, f7 = [x for x in IRInstructions if x[0] == instruction.op][0]
+        f3, f7 = IROpcodes[instruction.op]
         return self.encodeR(f7, imm, rs, f3, rd, 0b0010011)
 
     def encodeJops(self, instruction):
         if instruction.op == "JAL":
             rd = reg2int(instruction.args[0])
             imm = self.imm2int(instruction.args[1])
-            _, op = [x for x in JInstructions if x[0] == instruction.op][0]
             return self.encodeJ(imm, rd, 0b1101111)
         elif instruction.op == "JALR":
             rd, rs = reg2int(instruction.args[0]), reg2int(instruction.args[1])
             imm = self.imm2int(instruction.args[2])
-            _, op, f3 = [x for x in JInstructions if x[0] == instruction.op][0]
-            return self.encodeI(imm, rs, f3, rd, 0b1100111)
+            return self.encodeI(imm, rs, 0b000, rd, 0b1100111)
 
     def encodeBops(self, instruction):
         rs1, rs2 = reg2int(instruction.args[0]), reg2int(instruction.args[1])
         imm = self.imm2int(instruction.args[2])
-        _, f3 = [x for x in BInstructions if x[0] == instruction.op][0]
+        f3 = BOpcodes[instruction.op]
         return self.encodeB(imm, rs2, rs1, f3, 0b1100011)
 
     def encodeUops(self, instruction):
         rd = reg2int(instruction.args[0])
         imm = self.imm2int(instruction.args[1])
-        _, op = [x for x in UInstructions if x[0] == instruction.op][0]
+        op = UOpcodes[instruction.op]
         return self.encodeU(imm, rd, op)
 
     def encodeLops(self, instruction):
         rd, rs = reg2int(instruction.args[0]), reg2int(instruction.args[1])
         imm = self.imm2int(instruction.args[2])
-        _, f3 = [x for x in LInstructions if x[0] == instruction.op][0]
+        f3 = LOpcodes[instruction.op]
         return self.encodeI(imm, rs, f3, rd, 0b0000011)
 
     def encodeSops(self, instruction):
         # Swapped rs2, rs1 to match assembly code
         rs2, rs1 = reg2int(instruction.args[0]), reg2int(instruction.args[1])
         imm = self.imm2int(instruction.args[2])
-        _, f3 = [x for x in SInstructions if x[0] == instruction.op][0]
+        f3 = SOpcodes[instruction.op]
         return self.encodeS(imm, rs2, rs1, f3, 0b0100011)
 
     def encodeSysops(self, instruction):
@@ -305,14 +800,16 @@ class RiscvAssembler():
 
     def encodeMemops(self, instruction):
         op = instruction.op
+        # Data is a constant expression, labels are absolute addresses
+        value = lambda arg: self.evaluate(arg, self.labels, self.pc)
         if op == "DATAW":
-            w = int(instruction.args[0])
+            w = value(instruction.args[0])
             return w
         if op == "DATAB":
-            b1 = int(instruction.args[0]) & 0xff
-            b2 = int(instruction.args[1]) & 0xff
-            b3 = int(instruction.args[2]) & 0xff
-            b4 = int(instruction.args[3]) & 0xff
+            b1 = value(instruction.args[0]) & 0xff
+            b2 = value(instruction.args[1]) & 0xff
+            b3 = value(instruction.args[2]) & 0xff
+            b4 = value(instruction.args[3]) & 0xff
             return (b4 << 24) | (b3 << 16) | (b2 << 8) | b1
 
     def encodeDebugops(self, instruction):
@@ -322,26 +819,27 @@ class RiscvAssembler():
         if op == "TRACE":
             return (index << 24) | 0b11110011
 
-    def unravelPseudoOps(self, instruction):
+    def unravelPseudoOps(self, instruction, far=False):
         op = instruction.op
         instr = []
         if op == "NOP":
             instr.append(self.iFromLine("ADD x0, x0, x0"))
         elif op == "LI":
-            rd = instruction.args[0]
-            imm = self.imm2int(instruction.args[1])
-            if imm == 0:
-                instr.append(self.iFromLine("ADD {}, zero, zero".format(rd)))
-            elif -2048 <= imm < 2048:
-                instr.append(self.iFromLine("ADDI {}, zero, {}".format(
-                    rd, imm)))
-            else:
-                imm2 = hex(imm + ((imm & 0x800) << 1))
-                imm12 = hex(imm & 0xfff)
-                instr.append(self.iFromLine("LUI {}, {}".format(rd, imm2)))
-                if imm12 != 0:
-                    instr.append(self.iFromLine("ADDI {}, {}, {}".format(
-                        rd, rd, imm12)))
+            rd, arg = instruction.args
+            try:
+                instr += self.loadImmediate(rd, self.evaluate(arg))
+            except UnresolvedName:
+                if self.relax:
+                    # Depends on labels, sized by relaxInstructions()
+                    instr.append(Instruction("LI", rd, arg))
+                else:
+                    instr.append(self.iFromLine("LUI {}, %hi({})".format(
+                        rd, arg)))
+                    instr.append(self.iFromLine("ADDI {}, {}, %lo({})".format(
+                        rd, rd, arg)))
+        elif op == "CALL" and self.relax and not far:
+            # Resolved to JAL or AUIPC/JALR by relaxInstructions()
+            instr.append(Instruction("CALL", instruction.args[0]))
         elif op == "CALL":
             ref1 = LabelRef(op, "offset", instruction.args[0])
             ref2 = LabelRef(op, "offset12", instruction.args[0])
@@ -374,41 +872,395 @@ class RiscvAssembler():
             return [instruction], False
         return instr, True
 
-    def encode(self, instruction):
-        encoded = 0
-        if instruction.op in ROps:
-            encoded = self.encodeRops(instruction)
-        elif instruction.op in IOps:
-            encoded = self.encodeIops(instruction)
-        elif instruction.op in IROps:
-            encoded = self.encodeIRops(instruction)
-        elif instruction.op in JOps:
-            encoded = self.encodeJops(instruction)
-        elif instruction.op in BOps:
-            encoded = self.encodeBops(instruction)
-        elif instruction.op in UOps:
-            encoded = self.encodeUops(instruction)
-        elif instruction.op in LOps:
-            encoded = self.encodeLops(instruction)
-        elif instruction.op in SOps:
-            encoded = self.encodeSops(instruction)
-        elif instruction.op in SysOps:
-            encoded = self.encodeSysops(instruction)
-        elif instruction.op in MemOps:
-            encoded = self.encodeMemops(instruction)
-        elif instruction.op in DebugOps:
-            encoded = self.encodeDebugops(instruction)
+    def loadImmediate(self, rd, imm):
+        # Shortest sequence loading the 32-bit value imm into rd
+        try:
+            imm = signed32(imm)
+        except ExpressionError as e:
+            print("LI {}: {}".format(rd, e))
+            exit(1)
+        if imm == 0:
+            return [self.iFromLine("ADD {}, zero, zero".format(rd))]
+        if -2048 <= imm < 2048:
+            return [self.iFromLine("ADDI {}, zero, {}".format(rd, imm))]
+        instr = [self.iFromLine("LUI {}, {}".format(rd, hex(hi_part(imm))))]
+        if lo_part(imm) != 0:
+            instr.append(self.iFromLine("ADDI {}, {}, {}".format(
+                rd, rd, lo_part(imm))))
+        return instr
+
+    def evaluate(self, text, labels=None, pc=None):
+        # Value of a constant expression. Without labels (while parsing)
+        # label names and "." raise UnresolvedName.
+        resolving = set()
+
+        def lookup(name):
+            upp = name.upper()
+            if upp in self.constants:
+                value = self.constants[upp]
+                if isinstance(value, str):
+                    if upp in resolving:
+                        raise ExpressionError(
+                            "'{}' is defined in terms of itself".format(name))
+                    resolving.add(upp)
+                    value = evaluate(value, lookup)
+                    resolving.discard(upp)
+                return value
+            if name == ".":
+                if pc is None:
+                    raise UnresolvedName(name)
+                return pc
+            if labels is None:
+                raise UnresolvedName(name)
+            if upp in labels:
+                return labels[upp]
+            raise ExpressionError("unknown name '{}'".format(name))
+
+        return evaluate(text, lookup)
+
+    def labelTarget(self, arg):
+        # Label an immediate argument refers to, None for plain numbers
+        upp = arg.upper()
+        if upp in self.constants:
+            return None
+        if upp in self.labels:
+            return upp
+        if upp.startswith("LABELREF"):
+            l = LabelRef.fromString(upp)
+            if l.arg in self.labels:
+                return l.arg
+        return None
+
+    def relaxedValue(self, instruction, labels, pc):
+        try:
+            return signed32(self.evaluate(instruction.args[1], labels, pc))
+        except ExpressionError as e:
+            print("LI {}, {}: {}".format(instruction.args[0],
+                                         instruction.args[1], e))
+            exit(1)
+
+    def relaxInstructions(self):
+        # Pick the shortest form of every CALL and label branch:
+        #
+        #   CALL  target   JAL ra, target             within +-1 MiB
+        #                  AUIPC x6 / JALR ra, x6     otherwise
+        #   Bxx   target   Bxx target                 within +-4 KiB
+        #                  B!xx +8 / JAL x0, target   otherwise
+        #   LI    rd, x    ADDI rd, zero, x           x fits in 12 bits
+        #                  LUI rd / ADDI rd, rd       otherwise
+        #
+        # (LI only gets here when x depends on labels.)
+        #
+        # Every site starts short and only ever grows, so iterating until
+        # nothing changes terminates.
+        instructions = self.instructions
+        n = len(instructions)
+        label_index = {name: pc // 4 for name, pc in self.labels.items()}
+        sites = []
+        li_sites = []
+        for i, inst in enumerate(instructions):
+            if inst.op == "LI":
+                li_sites.append(i)
+            elif inst.op == "CALL":
+                target = inst.args[0].upper()
+                if target not in label_index:
+                    print("Unknown label '{}' in CALL".format(inst.args[0]))
+                    exit(1)
+                sites.append((i, target, -(1 << 20), (1 << 20) - 2))
+            elif inst.op in BOpcodes:
+                target = self.labelTarget(inst.args[2])
+                if target is not None:
+                    sites.append((i, target, -(1 << 12), (1 << 12) - 2))
+        size = [1] * n
+
+        changed = True
+        while changed:
+            changed = False
+            addr = [0] * (n + 1)
+            for i in range(n):
+                addr[i + 1] = addr[i] + 4 * size[i]
+            for i, target, low, high in sites:
+                if size[i] > 1:
+                    continue
+                if not low <= addr[label_index[target]] - addr[i] <= high:
+                    size[i] = 2
+                    changed = True
+            if li_sites:
+                labels = {name: addr[i] for name, i in label_index.items()}
+            for i in li_sites:
+                if size[i] == 1 and not -2048 <= self.relaxedValue(
+                        instructions[i], labels, addr[i]) < 2048:
+                    size[i] = 2
+                    changed = True
+
+        relaxed = []
+        new_index = [0] * (n + 1)
+        calls = 0
+        branches = 0
+        for i, inst in enumerate(instructions):
+            new_index[i] = len(relaxed)
+            if inst.op == "LI":
+                rd = inst.args[0]
+                imm = self.relaxedValue(inst, labels, addr[i])
+                if size[i] == 1:
+                    relaxed += self.loadImmediate(rd, imm)
+                else:
+                    relaxed.append(Instruction("LUI", rd, hex(hi_part(imm))))
+                    relaxed.append(Instruction("ADDI", rd, rd,
+                                               str(lo_part(imm))))
+            elif inst.op == "CALL":
+                if size[i] == 1:
+                    relaxed.append(Instruction("JAL", "ra", inst.args[0]))
+                    calls += 1
+                else:
+                    relaxed += self.unravelPseudoOps(
+                        Instruction("CALL", inst.args[0]), far=True)[0]
+            elif size[i] == 2:
+                # Inverted branch over a JAL to the target
+                rs1, rs2, target = inst.args
+                relaxed.append(Instruction(BInverted[inst.op], rs1, rs2, "8"))
+                relaxed.append(Instruction("JAL", "zero", target))
+                branches += 1
+            else:
+                relaxed.append(inst)
+        new_index[n] = len(relaxed)
+
+        if branches:
+            for i, target, low, high in sites:
+                offset = addr[label_index[target]] - addr[i] - 4
+                if size[i] == 2 and not -(1 << 20) <= offset < (1 << 20):
+                    print("Branch at pc={} out of range of {}".format(
+                        addr[i], target))
+                    exit(1)
+
+        self.instructions = relaxed
+        self.labels = {name: new_index[i] * 4
+                       for name, i in label_index.items()}
+        self.pc_labels = {}
+        for name, pc in self.labels.items():
+            self.pc_labels.setdefault(pc, []).append(name)
+        self.pseudos = {new_index[pc // 4] * 4: op
+                        for pc, op in self.pseudos.items()}
+        self.log("relaxed {} CALLs to JAL, {} branches to branch + JAL, "
+                 "{} words", calls, branches, len(relaxed))
+
+    # Peephole optimizer, run on the parsed instructions before relaxation
+    # with RiscvAssembler(optimize=True). Only straight-line code is
+    # changed, nothing moves across a label, a jump, a branch or a system
+    # op:
+    #
+    #   ADDI rd, rd, 0 / MV rd, rd           removed
+    #   LI rd, a / ADDI rd, rd, b            folded into LI rd, a + b when
+    #                                        that is a single instruction
+    #                                        (also SLLI, ORI, ANDI, ...)
+    #   write rd / write rd not reading rd   the first write is removed
+    #   LW rd / use of rd / ALU op           the ALU op is moved between the
+    #                                        load and the use, so that the
+    #                                        pipelined CPU does not stall
+    #
+    # ADD x0, x0, x0 (NOP) is never removed or moved, benches look for it.
+    # Code with numeric branch offsets or AUIPC depends on the position of
+    # every instruction and is not optimized.
+
+    def registerUse(self, instruction):
+        # (kind, registers written, registers read), kind is "alu", "load",
+        # "store" or None for instructions that are never moved
+        op, args = instruction.op, instruction.args
+        if op in ROpcodes or op in MOpcodes:
+            kind, written, read = "alu", args[0:1], args[1:3]
+        elif op in IOpcodes or op in IROpcodes:
+            kind, written, read = "alu", args[0:1], args[1:2]
+        elif op == "LUI":
+            kind, written, read = "alu", args[0:1], ()
+        elif op in LOpcodes:
+            kind, written, read = "load", args[0:1], args[1:2]
+        elif op in SOpcodes:
+            kind, written, read = "store", (), args[0:2]
+        else:
+            return None, set(), set()
+        return (kind, {reg2int(x) for x in written} - {0},
+                {reg2int(x) for x in read} - {0})
+
+    def positionDependent(self, instruction):
+        op, args = instruction.op, instruction.args
+        if op in BOpcodes:
+            return self.labelTarget(args[2]) is None
+        if op == "JAL":
+            return self.labelTarget(args[1]) is None
+        if op == "JALR":
+            return self.labelTarget(args[2]) is not None
+        if op == "AUIPC":
+            return not args[1].upper().startswith("LABELREF")
+        return False
+
+    def constantArg(self, arg):
+        try:
+            return self.evaluate(arg)
+        except ExpressionError:
+            return None
+
+    def isSelfMove(self, instruction):
+        op, args = instruction.op, instruction.args
+        if len(args) != 3 or reg2int(args[0]) == 0:
+            return False
+        if op in ("ADDI", "ORI", "XORI") or op in IROpcodes:
+            return (reg2int(args[1]) == reg2int(args[0])
+                    and self.constantArg(args[2]) == 0)
+        if op in ("ADD", "OR", "XOR", "SUB", "SLL", "SRL", "SRA"):
+            rd, rs1, rs2 = [reg2int(x) for x in args]
+            return (rs1 == rd and rs2 == 0) or (
+                op in ("ADD", "OR", "XOR") and rs1 == 0 and rs2 == rd)
+        return False
+
+    def loadedConstant(self, instruction):
+        # (rd, value) when the instruction loads a constant into rd
+        op, args = instruction.op, instruction.args
+        if op == "LUI":
+            value = self.constantArg(args[1])
+            if value is not None:
+                value = signed32(value & 0xfffff000)
+        elif op == "ADDI" and reg2int(args[1]) == 0:
+            value = self.constantArg(args[2])
+            if value is not None:
+                value = lo_part(value)
+        elif op == "ADD" and reg2int(args[1]) == 0 and reg2int(args[2]) == 0:
+            value = 0
         else:
+            return None
+        rd = reg2int(args[0])
+        if value is None or rd == 0:
+            return None
+        return rd, value
+
+    def fold(self, first, second):
+        # The constant load first and the ALU op second on the same register
+        # as one instruction, or None
+        loaded = self.loadedConstant(first)
+        op = second.op
+        if loaded is None or op not in ConstantFolds:
+            return None
+        rd, value = loaded
+        if reg2int(second.args[0]) != rd or reg2int(second.args[1]) != rd:
+            return None
+        imm = self.constantArg(second.args[2])
+        if imm is None:
+            return None
+        imm = imm & 31 if op in IROpcodes else lo_part(imm)
+        value = signed32(ConstantFolds[op](value, imm) & 0xffffffff)
+        instr = self.loadImmediate(second.args[0], value)
+        return instr[0] if len(instr) == 1 else None
+
+    def deadWrite(self, first, second):
+        # The register first writes is overwritten by second before use
+        kind, written, read = self.registerUse(first)
+        if kind != "alu" or not written:
+            return False
+        kind2, written2, read2 = self.registerUse(second)
+        return kind2 is not None and written <= written2 and not (
+            written & read2)
+
+    def optimizeInstructions(self):
+        instructions = self.instructions
+        n = len(instructions)
+        self.optimized = {"words": 0, "stalls": 0}
+        if any(self.positionDependent(inst) for inst in instructions):
+            self.log("optimizer: numeric branch offsets, not optimizing")
+            return
+        names = [[] for _ in range(n + 1)]
+        for name, pc in self.labels.items():
+            names[pc // 4].append(name)
+        pseudos = [self.pseudos.get(i * 4) for i in range(n)]
+
+        # Removals and folds. Labels of a removed instruction move on to
+        # the next one.
+        out = []
+        out_names = []
+        out_pseudos = []
+        pending = []
+        removed = 0
+        for i, inst in enumerate(instructions):
+            here = pending + names[i]
+            pending = []
+            if self.isSelfMove(inst):
+                self.log("  opt: removed {}", inst)
+                pending = here
+                removed += 1
+                continue
+            if out and not here:
+                folded = self.fold(out[-1], inst)
+                if folded is not None:
+                    self.log("  opt: folded {} {} -> {}", out[-1], inst,
+                             folded)
+                    out[-1] = folded
+                    removed += 1
+                    continue
+                if self.deadWrite(out[-1], inst):
+                    self.log("  opt: removed {}, overwritten by {}",
+                             out[-1], inst)
+                    out[-1] = inst
+                    out_pseudos[-1] = pseudos[i] or out_pseudos[-1]
+                    removed += 1
+                    continue
+            out.append(inst)
+            out_names.append(here)
+            out_pseudos.append(pseudos[i])
+        out_names.append(pending + names[n])
+
+        # Fill load-use slots with a later ALU op of the same block
+        uses = [self.registerUse(inst) for inst in out]
+        stalls = 0
+        for i in range(len(out) - 2):
+            kind, loaded, _ = uses[i]
+            if (kind != "load" or not loaded & uses[i + 1][2]
+                    or out_names[i + 1]):
+                continue
+            for j in range(i + 2, min(i + 10, len(out))):
+                kind_j, written_j, read_j = uses[j]
+                if out_names[j] or kind_j is None:
+                    break
+                if kind_j != "alu" or not written_j or loaded & read_j:
+                    continue
+                if any(uses[k][1] & (read_j | written_j)
+                       or uses[k][2] & written_j for k in range(i + 1, j)):
+                    continue
+                # Don't open a load-use slot where it was taken from
+                if (uses[j - 1][0] == "load" and j + 1 < len(out)
+                        and uses[j - 1][1] & uses[j + 1][2]):
+                    continue
+                self.log("  opt: moved {} after {}", out[j], out[i])
+                for l in (out, uses, out_pseudos):
+                    l.insert(i + 1, l.pop(j))
+                stalls += 1
+                break
+
+        self.instructions = out
+        self.labels = {}
+        self.pc_labels = {}
+        for i, here in enumerate(out_names):
+            for name in here:
+                self.labels[name] = i * 4
+                self.pc_labels.setdefault(i * 4, []).append(name)
+        self.pseudos = {i * 4: op for i, op in enumerate(out_pseudos)
+                        if op is not None}
+        self.optimized = {"words": removed, "stalls": stalls}
+        self.log("optimizer: {} words and {} load-use stalls removed, about "
+                 "{} cycles saved on the multi-cycle CPU and {} on the "
+                 "pipelined CPU", removed, stalls, 4 * removed,
+                 removed + stalls)
+
+    def encode(self, instruction):
+        encoder = self.encoders.get(instruction.op)
+        if encoder is None:
             print("Unhandled instruction / opcode {}".format(instruction))
             exit(1)
-        for l in self.labels:
-            if self.labels[l] == self.pc:
-                print("  lab@pc=0x{:03x}={} -> {}".format(self.pc, self.pc, l))
+        encoded = encoder(instruction)
+        for l in self.pc_labels.get(self.pc, ()):
+            self.log("  lab@pc=0x{:03x}={} -> {}", self.pc, self.pc, l)
         if self.pc in self.pseudos:
-            print("  psu@pc=0x{:03x}={} -> {}".format(self.pc, self.pc,
-                                                      self.pseudos[self.pc]))
-        print("  enc@pc=0x{:03x} {} -> 0b{:032b}".format(
-            self.pc, instruction, encoded))
+            self.log("  psu@pc=0x{:03x}={} -> {}", self.pc, self.pc,
+                     self.pseudos[self.pc])
+        self.log("  enc@pc=0x{:03x} {} -> 0b{:032b}",
+                 self.pc, instruction, encoded)
         self.pc += 4
         return encoded
 
@@ -425,7 +1277,45 @@ class RiscvAssembler():
             items = [x.strip() for x in rest.split(',')]
             return Instruction(op, *items)
 
-    def read(self, text):
+    def read(self, text, path=None):
+        # path is the file the text comes from, .include is relative to it
+        directory = os.path.dirname(path) if path else os.getcwd()
+        text = expand_includes(text, directory, set())
+        self.sources.append(text)
+        if self.cache_dir is None:
+            self.parse(text)
+
+    def link(self):
+        # Append the runtime routines the program refers to without defining
+        # them, and the routines those refer to
+        linked = []
+        names = referenced_names(self.instructions)
+        while True:
+            missing = [name for name in riscv_runtime.routines
+                       if name.upper() in names
+                       and name.upper() not in self.labels]
+            if not missing:
+                break
+            for name in missing:
+                instructions, labels, pseudos = compiled_routine(
+                    name, self.relax, self.simulation)
+                base = len(self.instructions) * 4
+                for label, pc in labels.items():
+                    if label in self.labels:
+                        print("Label '{}' of runtime routine {} is already "
+                              "defined".format(label, name))
+                        exit(1)
+                    self.labels[label] = base + pc
+                    self.pc_labels.setdefault(base + pc, []).append(label)
+                for pc, op in pseudos.items():
+                    self.pseudos[base + pc] = op
+                self.instructions += instructions
+                names |= referenced_names(instructions)
+                linked.append(name)
+        if linked:
+            self.log("linked runtime routines {}", ", ".join(linked))
+
+    def parse(self, text):
         instructions = []
         for line in text.splitlines():
             line = line.strip()
@@ -446,25 +1336,35 @@ class RiscvAssembler():
                 line = line.split(';', maxsplit=1)[0]
             # Constants
             if 'equ' in line:
-                items = [x.strip() for x in line.split()]
-                name = items[0]
-                value = "".join(items[2:])
-                self.constants[name.upper()] = int(value)
-                print("found equ '{}', value = '{}'".format(name, value))
-                continue
+                items = line.split(maxsplit=2)
+                if len(items) == 3 and items[1].lower() == "equ":
+                    name, value = items[0], items[2]
+                    try:
+                        # Expressions with labels are evaluated on use,
+                        # once the addresses are known
+                        self.constants[name.upper()] = self.evaluate(value)
+                    except UnresolvedName:
+                        self.constants[name.upper()] = value
+                    self.log("found equ '{}', value = '{}'", name, value)
+                    continue
             # Labels
             if ':' in line:
                 label, line = [x.strip() for x in line.split(':', maxsplit=1)]
-                pc = len(instructions) * 4
-                self.labels[label.upper()] = pc
-                print("found label '{}', pc = {}".format(label, pc))
+                # Addresses continue after the sources read before
+                pc = (len(self.instructions) + len(instructions)) * 4
+                name = label.upper()
+                if name in self.labels:
+                    self.pc_labels[self.labels[name]].remove(name)
+                self.labels[name] = pc
+                self.pc_labels.setdefault(pc, []).append(name)
+                self.log("found label '{}', pc = {}", label, pc)
             i = self.iFromLine(line)
             if i is not None:
                 unravelled, isPseudo = self.unravelPseudoOps(i)
                 if isPseudo:
-                    pc = len(instructions) * 4
+                    pc = (len(self.instructions) + len(instructions)) * 4
                     self.pseudos[pc] = i.op
-                    print("found peudo '{}', pc = {}".format(i.op, pc))
+                    self.log("found peudo '{}', pc = {}", i.op, pc)
                 for u in unravelled:
                     instructions.append(u)
         self.instructions += instructions
@@ -475,26 +1375,29 @@ class RiscvAssembler():
             return None
         if upp in self.constants:
             value = self.constants[upp]
+            if isinstance(value, str):
+                value = self.evaluate(arg, self.labels, self.pc)
             return value
         if upp in self.labels:
             offset = self.labels[upp] - self.pc
             # print("label offset = {}".format(offset))
             return offset
         if upp.startswith("LABELREF"):
-            print("  found labelref")
+            self.log("  found labelref")
             l = LabelRef.fromString(upp)
             if l.op == "CALL":
                 offset = self.imm2int(l.arg)
-                print("    resolving label {} -> {}".format(l.arg, offset))
+                self.log("    resolving label {} -> {}", l.arg, offset)
                 # print("offset = {}".format(offset))
                 if l.name == "OFFSET":
-                    return offset
+                    # Compensate for the sign extension of the low 12 bits
+                    return offset + 0x800
                 if l.name == "OFFSET12":
                     return (offset + 4) & 0xfff
             elif (l.op in ["J", "BEQZ", "BNEZ", "BGT"]):
                 if l.name == "IMM":
                     imm = self.imm2int(l.arg)
-                    print("    resolving label {} -> {}".format(l.arg, imm))
+                    self.log("    resolving label {} -> {}", l.arg, imm)
                     return imm
         if arg.startswith('"'):
             if arg.endswith('"'):
@@ -509,14 +1412,8 @@ class RiscvAssembler():
                 raise ValueError("Strange argument: {}".format(arg))
         try:
             return int(arg)
-        except ValueError as e:
-            if 'B' in upp[1]:
-                return int(arg, 2)
-            elif 'X' in upp:
-                if "0X" == upp[0:2] or "-0X" == upp[0:3]:
-                    return int(arg, 16)
-            else:
-                raise ValueError("Can't parse arg {}".format(arg))
+        except ValueError:
+            return self.evaluate(arg, self.labels, self.pc)
 
     def testCode(self):
         return """begin:
@@ -656,31 +1553,62 @@ class RiscvAssembler():
            NOP
            EBREAK
 
-            mulsi3:                 ; integer multiplication
-            MV      a2, a0
-            LI      a0, 0
-            mulsi3_l0:
-            ANDI    a3, a1, 1
-            BEQZ    a3, mulsi3_l1
-            ADD     a0, a0, a2
-            mulsi3_l1:
-            SRLI    a1, a1, 1
-            SLLI    a2, a2, 1
-            BNEZ    a1, mulsi3_l0
-            RET
-
-            wait:
-            LI      t0, 1
-            SLLI    t0, t0, slow_bit
-            wait_loop:
-            ADDI    t0, t0, -1
-            BNEZ    t0, wait_loop
-            RET
-
+           ; mulsi3 and wait are linked from the runtime library
     """
 
 if __name__ == "__main__":
-    a = RiscvAssembler(simulation=True)
-    a.read(a.testCode())
-    print(a.instructions)
+    parser = argparse.ArgumentParser(
+        description="Assemble RISC-V source files (default: the built-in "
+        "test program)")
+    parser.add_argument("sources", nargs="*",
+                        help="assembler source files, - for stdin")
+    parser.add_argument("-o", "--output", action="append", default=[],
+                        metavar="FILE",
+                        help="write the image to FILE, .hex ($readmemh), "
+                        ".bin or .elf (may be repeated)")
+    parser.add_argument("--simulation", action="store_true",
+                        help="assemble for simulation (keeps TRACE)")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="do not print the listing")
+    parser.add_argument("--listing", metavar="FILE",
+                        help="write the listing to FILE")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="run the peephole optimizer")
+    parser.add_argument("--cycles", metavar="CPU",
+                        help="print the listing annotated with cycle counts "
+                        "for CPU (fsm, fast_decode, pipeline, harvard or all)")
+    args = parser.parse_args()
+
+    # The built-in test program prints its listing unless -q, as before
+    a = RiscvAssembler(simulation=args.simulation or not args.sources,
+                       verbose=not (args.quiet or args.sources),
+                       listing=args.listing, relax=True,
+                       optimize=args.optimize)
+    if args.sources:
+        for filename in args.sources:
+            if filename == "-":
+                a.read(sys.stdin.read())
+            else:
+                with open(filename) as f:
+                    a.read(f.read(), filename)
+    else:
+        a.read(a.testCode())
+        a.log("{}", a.instructions)
     a.assemble()
+    if a.optimized is not None:
+        print("optimizer: {} words and {} load-use stalls removed".format(
+            a.optimized["words"], a.optimized["stalls"]))
+    if args.cycles:
+        import riscv_cycles
+        if args.cycles not in riscv_cycles.models and args.cycles != "all":
+            print("unknown CPU model '{}'".format(args.cycles))
+            exit(1)
+        riscv_cycles.print_cycles(a, args.cycles)
+    for filename in args.output:
+        try:
+            write_image(filename, a.mem, a.labels)
+        except ValueError as e:
+            print(e)
+            exit(1)
+        if not args.quiet:
+            print("wrote {} words to {}".format(len(a.mem), filename))
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+
+from riscv_assembler import (RiscvAssembler, BOpcodes, LOpcodes, SOpcodes,
+                             MOpcodes)
+from riscv_sim import MASK
+from riscv_disassembler import RiscvDisassembler, decodeWord
+
+# Static cycle counts of firmware on the CPUs of the later steps, without
+# simulating anything. Every instruction is annotated with the number of
+# cycles it takes on the selected model, the image is split into basic
+# blocks (at labels, branch targets and after control transfers) and the
+# cost of every block and every label is summed up:
+#
+#   python riscv_cycles.py memory.s --cpu fast_decode
+#   python riscv_cycles.py memory.s --cpu all     (compare the models)
+#
+# or from the assembler, python riscv_assembler.py memory.s --cycles fsm.
+#
+# Branches on the pipelined models cost more when they are taken, their
+# cost is shown as "not taken/taken". Block and label sums follow the fall
+# through path, so a loop iteration is the sum of its label plus the taken
+# penalty of the branch back.
+#
+# 18_mandelbrot/check_cycles.py runs small loops on the CPUs of step 18 and
+# checks these counts against the simulation.
+
+# Cycles per class of instruction.
+#
+# fsm:          FETCH_INSTR, WAIT_INSTR, FETCH_REGS and EXECUTE, then LOAD and
+#               WAIT_DATA for loads, STORE for stores or 33 DIVIDE cycles
+# fast_decode:  the same without FETCH_REGS
+# pipeline:     one instruction per cycle. Loads and stores pause fetching
+#               for a cycle, a load followed by a use of its result stalls
+#               for one, and taken branches and jumps redirect the fetch in
+#               EX, which costs one cycle. The pipelined core has no RV32M,
+#               M instructions are counted as ALU instructions.
+# harvard:      the pipeline with a separate instruction bus
+models = {
+    "fsm": {"alu": 4, "branch": 4, "jump": 4, "load": 6, "store": 5,
+            "divide": 37, "system": 4, "taken": 0, "load_use": 0},
+    "fast_decode": {"alu": 3, "branch": 3, "jump": 3, "load": 5, "store": 4,
+                    "divide": 36, "system": 3, "taken": 0, "load_use": 0},
+    "pipeline": {"alu": 1, "branch": 1, "jump": 1, "load": 2, "store": 2,
+                 "divide": 1, "system": 1, "taken": 1, "load_use": 1},
+    "harvard": {"alu": 1, "branch": 1, "jump": 1, "load": 1, "store": 1,
+                "divide": 1, "system": 1, "taken": 1, "load_use": 1},
+}
+
+DivideOps = [op for op in MOpcodes if op.startswith(("DIV", "REM"))]
+
+def classify(word):
+    # (class, pc relative target or None, registers read, register written)
+    # of an instruction word, class is None for words that are not
+    # instructions
+    op, args, offset = decodeWord(word & MASK)
+    if op is None:
+        return None, None, (), 0
+    opcode = word & 0x7f
+    rd = (word >> 7) & 31
+    rs1 = (word >> 15) & 31
+    rs2 = (word >> 20) & 31
+    if op in LOpcodes:
+        return "load", None, (rs1,), rd
+    if op in SOpcodes:
+        return "store", None, (rs1, rs2), 0
+    if op in BOpcodes:
+        return "branch", offset, (rs1, rs2), 0
+    if op == "JAL":
+        return "jump", offset, (), rd
+    if op == "JALR":
+        return "jump", None, (rs1,), rd
+    if op in ("ECALL", "EBREAK", "FENCE_I"):
+        return "system", None, (), 0
+    if op in DivideOps:
+        return "divide", None, (rs1, rs2), rd
+    if opcode == 0b0110011:
+        return "alu", None, (rs1, rs2), rd
+    if opcode == 0b0010011:
+        return "alu", None, (rs1,), rd
+    return "alu", None, (), rd
+
+class CycleCount():
+
+    def __init__(self, words, labels=None, model="fsm", base=0):
+        self.words = [word & MASK for word in words]
+        self.base = base
+        self.model = model
+        self.cycles = models[model]
+        self.disassembler = RiscvDisassembler(labels)
+        self.labels = self.disassembler.labels
+        # Per word: cycles when falling through, cycles when taken (None
+        # unless it is a branch), or None for data
+        self.costs = []
+        # (first pc, last pc, instructions, cycles, cycles when the branch
+        # at the end is taken)
+        self.blocks = []
+        self.annotate()
+
+    def annotate(self):
+        cycles = self.cycles
+        end = self.base + 4 * len(self.words)
+        leaders = {self.base}
+        leaders.update(pc for pc in self.labels.values()
+                       if self.base <= pc < end)
+        loaded = 0
+        for i, word in enumerate(self.words):
+            pc = self.base + 4 * i
+            kind, offset, reads, writes = classify(word)
+            if kind is None:
+                self.costs.append(None)
+                loaded = 0
+                continue
+            n = cycles[kind]
+            if loaded and loaded in reads:
+                n += cycles["load_use"]
+            taken = None
+            if kind == "branch":
+                taken = n + cycles["taken"]
+            elif kind == "jump":
+                n += cycles["taken"]
+            self.costs.append((n, taken))
+            loaded = writes if kind == "load" else 0
+            if kind in ("branch", "jump", "system"):
+                leaders.add(pc + 4)
+                if offset is not None:
+                    leaders.add((pc + offset) & MASK)
+
+        block = None
+        for i, cost in enumerate(self.costs):
+            pc = self.base + 4 * i
+            if pc in leaders and block is not None:
+                self.blocks.append(tuple(block))
+                block = None
+            if cost is None:
+                # Data ends the block
+                if block is not None:
+                    self.blocks.append(tuple(block))
+                    block = None
+                continue
+            if block is None:
+                block = [pc, pc, 0, 0, None]
+            block[1] = pc
+            block[2] += 1
+            block[3] += cost[0]
+            block[4] = None if cost[1] is None \
+                else block[3] - cost[0] + cost[1]
+        if block is not None:
+            self.blocks.append(tuple(block))
+
+    def cost(self, pc):
+        return self.costs[(pc - self.base) // 4]
+
+    def labelCosts(self):
+        # (name, pc, instructions, cycles) from every label to the next one
+        # in address order
+        starts = sorted((pc, name) for name, pc in self.labels.items())
+        end = self.base + 4 * len(self.words)
+        rows = []
+        for i, (pc, name) in enumerate(starts):
+            if not self.base <= pc < end:
+                continue
+            stop = end
+            for next_pc, _ in starts[i + 1:]:
+                if next_pc > pc:
+                    stop = min(next_pc, end)
+                    break
+            costs = [c for c in self.costs[(pc - self.base) // 4:
+                                           (stop - self.base) // 4]
+                     if c is not None]
+            rows.append((name, pc, len(costs), sum(c[0] for c in costs)))
+        return rows
+
+    def listing(self):
+        # Disassembly with the cycles of every instruction and a summary
+        # line after every basic block
+        d = self.disassembler
+        names = {}
+        for name, pc in self.labels.items():
+            names.setdefault(pc, []).append(name)
+        totals = {name: (n, cycles)
+                  for name, pc, n, cycles in self.labelCosts()}
+        block_ends = {block[1]: block for block in self.blocks}
+        for i, word in enumerate(self.words):
+            pc = self.base + 4 * i
+            for name in sorted(names.get(pc, ())):
+                if name in totals:
+                    n, cycles = totals[name]
+                    yield "{:44}; {} instructions, {} cycles".format(
+                        name + ":", n, cycles)
+                else:
+                    yield name + ":"
+            cost = self.costs[i]
+            text = "    {:04x}: {:08x}    {}".format(pc, word,
+                                                   d.disassemble(word, pc))
+            if cost is None:
+                yield text
+                continue
+            yield "{:56} {:>5}".format(text, format_cost(*cost))
+            block = block_ends.get(pc)
+            if block is not None:
+                first, last, n, cycles, taken = block
+                line = "    ; block {:04x}-{:04x}: {} instructions, {} " \
+                    "cycles".format(first, last, n, cycles)
+                if taken is not None and taken != cycles:
+                    line += " ({} taken)".format(taken)
+                yield line
+
+    def summary(self):
+        rows = self.labelCosts()
+        yield "{:24} {:>6} {:>12} {:>9}".format("label", "addr",
+                                                "instructions", "cycles")
+        for name, pc, n, cycles in rows:
+            yield "{:24} {:6x} {:12d} {:9d}".format(name, pc, n, cycles)
+
+def format_cost(cycles, taken):
+    if taken is None or taken == cycles:
+        return str(cycles)
+    return "{}/{}".format(cycles, taken)
+
+def compare(words, labels, base=0):
+    # Cycles per label on every model, side by side
+    counts = [CycleCount(words, labels, model, base) for model in models]
+    columns = [{name: cycles for name, pc, n, cycles in c.labelCosts()}
+               for c in counts]
+    yield "{:24} {:>6} {:>6}".format("label", "addr", "instr") + "".join(
+        " {:>11}".format(model) for model in models)
+    for name, pc, n, cycles in counts[0].labelCosts():
+        yield "{:24} {:6x} {:6d}".format(name, pc, n) + "".join(
+            " {:11d}".format(column[name]) for column in columns)
+
+def print_cycles(assembler, model, base=0, out=None):
+    # What the assembler's --cycles option prints
+    out = out or sys.stdout
+    if model == "all":
+        lines = compare(assembler.mem, assembler.labels, base)
+    else:
+        c = CycleCount(assembler.mem, assembler.labels, model, base)
+        lines = list(c.listing()) + [""] + list(c.summary())
+    for line in lines:
+        print(line, file=out)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Static cycle counts of RISC-V firmware (default: the "
+        "test program)")
+    parser.add_argument("sources", nargs="*",
+                        help="assembler source files, - for stdin")
+    parser.add_argument("--cpu", choices=list(models) + ["all"],
+                        default="fsm",
+                        help="CPU model (default fsm), all compares them")
+    parser.add_argument("--base", type=lambda x: int(x, 0), default=0,
+                        help="address of the first word")
+    parser.add_argument("-O", "--optimize", action="store_true",
+                        help="run the peephole optimizer")
+    args = parser.parse_args()
+
+    a = RiscvAssembler(verbose=False, listing=None, relax=True,
+                       optimize=args.optimize)
+    if args.sources:
+        for filename in args.sources:
+            if filename == "-":
+                a.read(sys.stdin.read())
+            else:
+                with open(filename) as f:
+                    a.read(f.read(), filename)
+    else:
+        a.read(a.testCode())
+    a.assemble()
+    print_cycles(a, args.cpu, args.base)
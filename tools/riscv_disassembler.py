@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import sys
+import time
+
+from riscv_assembler import (RiscvAssembler, Instruction, ROpcodes, MOpcodes,
+                             IOpcodes, IROpcodes, BOpcodes, LOpcodes,
+                             SOpcodes, abi_names)
+from riscv_sim import (MASK, ECALL, EBREAK, decodeIimm, decodeSimm,
+                       decodeBimm, decodeJimm, decodeUimm)
+
+# Disassembler for the words produced by RiscvAssembler. The output uses the
+# syntax of the assembler (LW rd, rs1, imm and SW rs2, rs1, imm, LUI with the
+# full value), so that a listing can be assembled again into the same words.
+# Every decoded word is encoded again with the assembler's own encoders, and
+# words that don't come out the same are shown as DATAW.
+#
+# Branch and jump targets are shown as labels when a label table is given,
+# e.g. the one RiscvAssembler collects:
+#
+#   d = RiscvDisassembler.fromAssembler(a)
+#   for line in d.listing(a.mem):
+#       print(line)
+#
+# and pc/instruction pairs from a simulation are decoded one at a time:
+#
+#   for line in d.trace(pairs):
+#       print(line)
+#
+# Every distinct word is only decoded once, later occurrences are a lookup.
+#
+# Usage: python riscv_disassembler.py [image.hex] [--base ADDR] [-s source]
+#        python riscv_disassembler.py --trace FILE     ("pc instr" per line)
+
+# Register names, x8 is shown as s0 rather than fp
+register_names = ["x{}".format(i) for i in range(32)]
+for name, index in abi_names.items():
+    if name != "fp":
+        register_names[index] = name
+
+# Decoding tables, indexed by (opcode, funct3) or (opcode, funct3, funct7)
+RTable = {(0b0110011, f3, f7): op
+          for op, (f3, f7) in list(ROpcodes.items()) + list(MOpcodes.items())}
+ITable = {(0b0010011, f3): op for op, f3 in IOpcodes.items()}
+IRTable = {(0b0010011, f3, f7): op for op, (f3, f7) in IROpcodes.items()}
+LTable = {(0b0000011, f3): op for op, f3 in LOpcodes.items()}
+STable = {(0b0100011, f3): op for op, f3 in SOpcodes.items()}
+BTable = {(0b1100011, f3): op for op, f3 in BOpcodes.items()}
+SystemTable = {ECALL: "ECALL", EBREAK: "EBREAK",
+               0b00000000000000000001000001110011: "FENCE_I"}
+
+def fmt(op, *args):
+    return "{:7}{}".format(op, ", ".join(args)).rstrip()
+
+def decodeWord(word):
+    # (op, args, offset) of the instruction, offset is the pc relative
+    # target of branches and JAL, None for everything else
+    opcode = word & 0x7f
+    rd = register_names[(word >> 7) & 31]
+    rs1 = register_names[(word >> 15) & 31]
+    rs2 = register_names[(word >> 20) & 31]
+    f3 = (word >> 12) & 7
+    if opcode == 0b0110011:
+        op = RTable.get((opcode, f3, word >> 25))
+        return op, (rd, rs1, rs2), None
+    if opcode == 0b0010011:
+        if f3 == 0b001 or f3 == 0b101:
+            op = IRTable.get((opcode, f3, word >> 25))
+            return op, (rd, rs1, str((word >> 20) & 31)), None
+        return ITable.get((opcode, f3)), (rd, rs1, str(decodeIimm(word))), \
+            None
+    if opcode == 0b0000011:
+        return LTable.get((opcode, f3)), (rd, rs1, str(decodeIimm(word))), \
+            None
+    if opcode == 0b0100011:
+        return STable.get((opcode, f3)), (rs2, rs1, str(decodeSimm(word))), \
+            None
+    if opcode == 0b1100011:
+        return BTable.get((opcode, f3)), (rs1, rs2), decodeBimm(word)
+    if opcode == 0b1101111:
+        return "JAL", (rd,), decodeJimm(word)
+    if opcode == 0b1100111 and f3 == 0:
+        return "JALR", (rd, rs1, str(decodeIimm(word))), None
+    if opcode == 0b0110111:
+        return "LUI", (rd, hex(decodeUimm(word))), None
+    if opcode == 0b0010111:
+        return "AUIPC", (rd, hex(decodeUimm(word))), None
+    if opcode == 0b1110011:
+        return SystemTable.get(word), (), None
+    return None, (), None
+
+class RiscvDisassembler():
+
+    def __init__(self, labels=None):
+        # labels maps names to addresses, as RiscvAssembler.labels
+        self.labels = {}
+        self.names = {}
+        if labels:
+            for name, pc in sorted(labels.items(), key=lambda x: x[1]):
+                name = name.lower()
+                self.labels[name] = pc
+                self.names.setdefault(pc, name)
+        self.addresses = sorted(self.names)
+        # word -> (text, None) or (text before the target, offset)
+        self.decoded = {}
+        # pc -> "label" or "label+offset"
+        self.symbols = {}
+        # Trace lines, indexed by pc and word
+        self.lines = {}
+        self.assembler = RiscvAssembler(verbose=False, listing=None,
+                                        cache=False)
+
+    @classmethod
+    def fromAssembler(cls, assembler):
+        return cls(assembler.labels)
+
+    def decode(self, word):
+        word &= MASK
+        op, args, offset = decodeWord(word)
+        if op is not None:
+            # Only keep what the assembler turns into the same word again
+            check = tuple(str(int(x, 16)) if x.startswith("0x") else x
+                          for x in args)
+            if offset is not None:
+                check += (str(offset),)
+            a = self.assembler
+            a.pc = 0
+            if a.encode(Instruction(op, *check)) == word:
+                if offset is None:
+                    return fmt(op, *args), None
+                return fmt(op, *args) + ", " if args else fmt(op) + " ", \
+                    offset
+        return fmt("DATAW", "0x{:08x}".format(word)), None
+
+    def disassemble(self, word, pc=None):
+        try:
+            text, offset = self.decoded[word]
+        except KeyError:
+            text, offset = self.decoded[word] = self.decode(word)
+        if offset is None:
+            return text
+        if pc is not None:
+            name = self.names.get((pc + offset) & MASK)
+            if name is not None:
+                return text + name
+        return text + str(offset)
+
+    def symbol(self, pc):
+        # Name of the label at or before pc
+        try:
+            return self.symbols[pc]
+        except KeyError:
+            pass
+        i = bisect.bisect_right(self.addresses, pc)
+        if i == 0:
+            symbol = ""
+        else:
+            base = self.addresses[i - 1]
+            symbol = self.names[base]
+            if pc != base:
+                symbol += "+{}".format(pc - base)
+        self.symbols[pc] = symbol
+        return symbol
+
+    def listing(self, words, base=0):
+        # Lines of a listing of the image, with a line for every label
+        labels = {}
+        for name, pc in self.labels.items():
+            labels.setdefault(pc, []).append(name)
+        disassemble = self.disassemble
+        for i, word in enumerate(words):
+            pc = base + 4 * i
+            for name in labels.get(pc, ()):
+                yield name + ":"
+            yield "    {:04x}: {:08x}    {}".format(pc, word & MASK,
+                                                    disassemble(word, pc))
+
+    def trace(self, pairs):
+        # Decoded lines for an iterable of (pc, instruction word). Loops
+        # execute the same pc and word over and over, so whole lines are
+        # kept as well.
+        lines = self.lines
+        for pc, word in pairs:
+            key = (pc << 32) | word
+            try:
+                yield lines[key]
+            except KeyError:
+                line = lines[key] = "{:08x} {:<16} {}".format(
+                    pc, self.symbol(pc), self.disassemble(word, pc))
+                yield line
+
+_default = None
+
+def disassemble(word, pc=None):
+    # Disassemble a single word without labels
+    global _default
+    if _default is None:
+        _default = RiscvDisassembler()
+    return _default.disassemble(word, pc)
+
+def read_hex(f):
+    # Words of a $readmemh file, one word per line, // comments
+    words = []
+    for line in f:
+        line = line.split("//", 1)[0].strip()
+        if line and not line.startswith("@"):
+            words += [int(x, 16) for x in line.split()]
+    return words
+
+def read_trace(f):
+    # "pc instr" pairs in hex, one per line, other lines are skipped
+    for line in f:
+        items = line.split()
+        if len(items) >= 2:
+            try:
+                yield int(items[0], 16), int(items[1], 16)
+            except ValueError:
+                pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Disassemble RISC-V words (default: the test program)")
+    parser.add_argument("image", nargs="?",
+                        help="$readmemh file to disassemble")
+    parser.add_argument("--base", type=lambda x: int(x, 0), default=0,
+                        help="address of the first word")
+    parser.add_argument("-s", "--source", action="append", default=[],
+                        help="assembler source the labels are taken from "
+                        "(default: the test program)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="decode 'pc instr' lines, - for stdin")
+    parser.add_argument("--benchmark", type=int, metavar="N",
+                        help="time decoding a trace of N instructions")
+    args = parser.parse_args()
+
+    a = RiscvAssembler(simulation=True, verbose=False, listing=None,
+                       relax=True)
+    if args.source:
+        for filename in args.source:
+            with open(filename) as f:
+                a.read(f.read())
+    else:
+        a.read(a.testCode())
+    a.assemble()
+    d = RiscvDisassembler.fromAssembler(a)
+
+    if args.benchmark:
+        pairs = [(4 * (i % len(a.mem)), a.mem[i % len(a.mem)])
+                 for i in range(args.benchmark)]
+        t0 = time.perf_counter()
+        for line in d.trace(pairs):
+            pass
+        t = time.perf_counter() - t0
+        print("{} instructions in {:.2f}s, {:.0f} instructions/s".format(
+            args.benchmark, t, args.benchmark / t))
+    elif args.trace:
+        f = sys.stdin if args.trace == "-" else open(args.trace)
+        with f:
+            for line in d.trace(read_trace(f)):
+                print(line)
+    else:
+        words = a.mem
+        if args.image:
+            with open(args.image) as f:
+                words = read_hex(f)
+        for line in d.listing(words, args.base):
+            print(line)
@@ -0,0 +1,94 @@
+# Runtime library of subroutines shared by the firmware of the later steps.
+#
+# RiscvAssembler links a routine into the image when the program refers to
+# its label without defining it, followed by the routines that one calls in
+# turn. Routines that are not used are left out. Every routine is parsed
+# only once per process.
+#
+#   mulsi3    a0 <- a0 * a1, for CPUs without RV32M     uses a1, a2, a3
+#   udivsi3   a0 <- a0 / a1, a1 <- a0 % a1, unsigned    uses a2, a3, t0, t1
+#   putc      send the character in a0 over the UART    uses t0, t1
+#   puts      send the zero terminated string at a0     uses a0, stack
+#   wait      busy loop of 1 << slow_bit iterations     uses t0
+#
+# putc and puts expect gp to point to the IO page (0x400000), wait expects
+# the program to define slow_bit with equ.
+
+routines = {}
+
+routines["mulsi3"] = """
+mulsi3:                     ; integer multiplication
+    MV      a2, a0
+    LI      a0, 0
+mulsi3_l0:
+    ANDI    a3, a1, 1
+    BEQZ    a3, mulsi3_l1
+    ADD     a0, a0, a2
+mulsi3_l1:
+    SRLI    a1, a1, 1
+    SLLI    a2, a2, 1
+    BNEZ    a1, mulsi3_l0
+    RET
+"""
+
+routines["udivsi3"] = """
+udivsi3:                    ; unsigned division, restoring
+    MV      a2, a0          ; a2: dividend, shifted out to the left
+    LI      a0, 0           ; a0: quotient
+    LI      a3, 32
+    MV      t0, a1          ; t0: divisor
+    LI      a1, 0           ; a1: remainder
+udivsi3_l0:
+    SRLI    t1, a2, 31
+    SLLI    a1, a1, 1
+    OR      a1, a1, t1
+    SLLI    a2, a2, 1
+    SLLI    a0, a0, 1
+    BLTU    a1, t0, udivsi3_l1
+    SUB     a1, a1, t0
+    ORI     a0, a0, 1
+udivsi3_l1:
+    ADDI    a3, a3, -1
+    BNEZ    a3, udivsi3_l0
+    RET
+"""
+
+routines["putc"] = """
+putc:                       ; Send one character
+    SW      a0, gp, 8       ; (1 << IO_UART_DAT_bit + 2)
+    LI      t0, 0x200       ; Test bit 9 (status bit) below
+putc_loop:
+    LW      t1, gp, 0x10    ; (1 << IO_UART_CNTL_bit + 2)
+    AND     t1, t1, t0      ; Test
+    BNEZ    t1, putc_loop
+    RET
+"""
+
+routines["puts"] = """
+puts:                       ; Send a zero terminated string
+    ADDI    sp, sp, -8
+    SW      ra, sp, 0
+    SW      s0, sp, 4
+    MV      s0, a0
+puts_loop:
+    LBU     a0, s0, 0
+    BEQZ    a0, puts_done
+    CALL    putc
+    ADDI    s0, s0, 1
+    J       puts_loop
+puts_done:
+    LW      ra, sp, 0
+    LW      s0, sp, 4
+    ADDI    sp, sp, 8
+    RET
+"""
+
+routines["wait"] = """
+wait:                       ; Wait for 1 << slow_bit iterations
+    LI      t0, 1
+    SLLI    t0, t0, slow_bit
+wait_loop:
+    ADDI    t0, t0, -1
+    BNEZ    t0, wait_loop
+    RET
+"""
@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+import sys
+import time
+import argparse
+
+from riscv_assembler import RiscvAssembler
+
+# Instruction set simulator for the RV32I(M) firmware images produced by
+# RiscvAssembler. It uses the memory map of the SOC in 17_memory_map and
+# 18_mandelbrot:
+#
+#   RAM below 0x400000
+#   IO page with bit 22 set, selected by the word address bits
+#     bit 0: LEDs         (0x400004)
+#     bit 1: UART data    (0x400008)
+#     bit 2: UART control (0x400010), bit 9 is the 'busy' flag
+#
+# Every instruction word is decoded once into a Python function, which is
+# kept in a table indexed by the word address. Executing an instruction is
+# then a single function call, which returns the next pc. Stores to RAM
+# drop the decoded function of the word they modify.
+
+MASK = 0xffffffff
+SIGN = 0x80000000
+
+IO_BIT = 1 << 22
+IO_LEDS_BIT = 1 << (0 + 2)
+IO_UART_DAT_BIT = 1 << (1 + 2)
+IO_UART_CNTL_BIT = 1 << (2 + 2)
+
+ECALL = 0b00000000000000000000000001110011
+EBREAK = 0b00000000000100000000000001110011
+
+class SimError(Exception):
+    pass
+
+class Halt(Exception):
+    pass
+
+def signed(x):
+    return x - (1 << 32) if x & SIGN else x
+
+def decodeIimm(instr):
+    return signed(instr) >> 20
+
+def decodeSimm(instr):
+    return ((signed(instr) >> 20) & ~0x1f) | ((instr >> 7) & 0x1f)
+
+def decodeBimm(instr):
+    return ((signed(instr) >> 19) & ~0xfff) | ((instr & 0x80) << 4) \
+        | ((instr >> 20) & 0x7e0) | ((instr >> 7) & 0x1e)
+
+def decodeJimm(instr):
+    return ((signed(instr) >> 11) & ~0xfffff) | (instr & 0xff000) \
+        | ((instr >> 9) & 0x800) | ((instr >> 20) & 0x7fe)
+
+def decodeUimm(instr):
+    return instr & 0xfffff000
+
+def _mulh(a, b):
+    return ((signed(a) * signed(b)) >> 32) & MASK
+
+def _mulhsu(a, b):
+    return ((signed(a) * b) >> 32) & MASK
+
+def _div(a, b):
+    if b == 0:
+        return MASK
+    a, b = signed(a), signed(b)
+    q = abs(a) // abs(b)
+    return (-q if (a < 0) != (b < 0) else q) & MASK
+
+def _rem(a, b):
+    if b == 0:
+        return a
+    a, b = signed(a), signed(b)
+    r = abs(a) % abs(b)
+    return (-r if a < 0 else r) & MASK
+
+# ALU operations, indexed by (funct7, funct3). The operands are {a} and {b}.
+ALUOps = {
+    (0b0000000, 0b000): "({a} + {b}) & MASK",
+    (0b0100000, 0b000): "({a} - {b}) & MASK",
+    (0b0000000, 0b001): "({a} << ({b} & 31)) & MASK",
+    (0b0000000, 0b010): "int(({a} ^ SIGN) < ({b} ^ SIGN))",
+    (0b0000000, 0b011): "int({a} < {b})",
+    (0b0000000, 0b100): "{a} ^ {b}",
+    (0b0000000, 0b101): "{a} >> ({b} & 31)",
+    (0b0100000, 0b101): "(signed({a}) >> ({b} & 31)) & MASK",
+    (0b0000000, 0b110): "{a} | {b}",
+    (0b0000000, 0b111): "{a} & {b}",
+}
+
+MulDivOps = {
+    (0b0000001, 0b000): "({a} * {b}) & MASK",
+    (0b0000001, 0b001): "_mulh({a}, {b})",
+    (0b0000001, 0b010): "_mulhsu({a}, {b})",
+    (0b0000001, 0b011): "({a} * {b}) >> 32",
+    (0b0000001, 0b100): "_div({a}, {b})",
+    (0b0000001, 0b101): "MASK if {b} == 0 else {a} // {b}",
+    (0b0000001, 0b110): "_rem({a}, {b})",
+    (0b0000001, 0b111): "{a} if {b} == 0 else {a} % {b}",
+}
+
+# Branch conditions, indexed by funct3
+BranchOps = {
+    0b000: "{a} == {b}",
+    0b001: "{a} != {b}",
+    0b100: "({a} ^ SIGN) < ({b} ^ SIGN)",
+    0b101: "({a} ^ SIGN) >= ({b} ^ SIGN)",
+    0b110: "{a} < {b}",
+    0b111: "{a} >= {b}",
+}
+
+# The operations above are compiled into factories once, which return the
+# function executing one particular instruction. This avoids a second
+# function call per instruction for the operation itself.
+def _factory(body):
+    text = ("def factory(regs, rd, rs1, rs2, imm):\n"
+            "    def op(pc):\n"
+            "{}"
+            "    return op\n").format(body)
+    scope = {"MASK": MASK, "SIGN": SIGN, "signed": signed, "_mulh": _mulh,
+             "_mulhsu": _mulhsu, "_div": _div, "_rem": _rem}
+    exec(text, scope)
+    return scope["factory"]
+
+def _operands(expr, a, b):
+    return "(" + expr.format(a=a, b=b) + ")"
+
+ALUregFactories = {}
+for key, expr in list(ALUOps.items()) + list(MulDivOps.items()):
+    ALUregFactories[key] = _factory(
+        "        regs[rd] = {}\n"
+        "        return pc + 4\n".format(
+            _operands(expr, "regs[rs1]", "regs[rs2]")))
+
+# RV32M has no immediate forms, a shift by immediate with funct7 0000001
+# is an illegal instruction
+ALUimmFactories = {}
+for key, expr in ALUOps.items():
+    ALUimmFactories[key] = _factory(
+        "        regs[rd] = {}\n"
+        "        return pc + 4\n".format(_operands(expr, "regs[rs1]", "imm")))
+
+BranchFactories = {}
+for key, expr in BranchOps.items():
+    BranchFactories[key] = _factory(
+        "        if {}:\n"
+        "            return (pc + imm) & MASK\n"
+        "        return pc + 4\n".format(
+            _operands(expr, "regs[rs1]", "regs[rs2]")))
+
+class RiscvSim():
+    def __init__(self, mem, ram_size=6 * 1024, uart=None, rv32m=True,
+                 debug_args=None):
+        if sys.byteorder != "little":
+            raise SimError("RiscvSim needs a little endian host")
+
+        ram_size = max(ram_size, len(mem) * 4)
+        self.ram = bytearray(ram_size)
+        self.ram_words = memoryview(self.ram).cast('I')
+        self.ram_halfwords = memoryview(self.ram).cast('H')
+        for i, w in enumerate(mem):
+            self.ram_words[i] = w & MASK
+
+        self.regs = [0] * 32
+        self.pc = 0
+        self.leds = 0
+        self.instret = 0
+        self.uart = sys.stdout if uart is None else uart
+        self.rv32m = rv32m
+        self.debug_args = debug_args
+
+        # Decoded instructions, indexed by word address
+        self.code = [None] * (ram_size // 4)
+
+        self.decoders = {
+            0b0110011: self.decodeALUreg,
+            0b0010011: self.decodeALUimm,
+            0b1100011: self.decodeBranch,
+            0b1100111: self.decodeJALR,
+            0b1101111: self.decodeJAL,
+            0b0010111: self.decodeAUIPC,
+            0b0110111: self.decodeLUI,
+            0b0000011: self.decodeLoad,
+            0b0100011: self.decodeStore,
+            0b1110011: self.decodeSystem,
+        }
+
+    ## Memory and IO
+
+    def io_read(self, addr):
+        # The UART is never busy
+        return 0
+
+    def io_write(self, addr, value):
+        if addr & IO_LEDS_BIT:
+            self.leds = value & 0x1f
+        if addr & IO_UART_DAT_BIT:
+            self.uart.write(chr(value & 0xff))
+
+    def load_word(self, addr):
+        if addr & IO_BIT:
+            return self.io_read(addr)
+        return self.ram_words[addr >> 2]
+
+    def store(self, addr, value, width):
+        if addr & IO_BIT:
+            self.io_write(addr, value)
+            return
+        if width == 4:
+            self.ram_words[addr >> 2] = value
+        elif width == 2:
+            self.ram_halfwords[addr >> 1] = value & 0xffff
+        else:
+            self.ram[addr] = value & 0xff
+        self.code[addr >> 2] = None
+
+    ## Decoders, turning an instruction word into a function pc -> next pc
+
+    def decode(self, instr):
+        decoder = self.decoders.get(instr & 0x7f)
+        if decoder is None:
+            return self.illegal(instr)
+        return decoder(instr)
+
+    def illegal(self, instr):
+        def op(pc):
+            raise SimError("Illegal instruction 0x{:08x} at pc=0x{:x}".format(
+                instr, pc))
+        return op
+
+    def decodeALUreg(self, instr):
+        rd, rs1, rs2 = (instr >> 7) & 31, (instr >> 15) & 31, (instr >> 20) & 31
+        key = (instr >> 25, (instr >> 12) & 7)
+        if key[0] == 0b0000001 and not self.rv32m:
+            return self.illegal(instr)
+        factory = ALUregFactories.get(key)
+        if factory is None:
+            return self.illegal(instr)
+        if rd == 0:
+            return lambda pc: pc + 4
+        return factory(self.regs, rd, rs1, rs2, 0)
+
+    def decodeALUimm(self, instr):
+        rd, rs1 = (instr >> 7) & 31, (instr >> 15) & 31
+        funct3 = (instr >> 12) & 7
+        if funct3 == 0b001 or funct3 == 0b101:
+            # Shifts by immediate
+            factory = ALUimmFactories.get((instr >> 25, funct3))
+            imm = (instr >> 20) & 31
+        else:
+            factory = ALUimmFactories[(0, funct3)]
+            imm = decodeIimm(instr) & MASK
+        if factory is None:
+            return self.illegal(instr)
+        if rd == 0:
+            return lambda pc: pc + 4
+        return factory(self.regs, rd, rs1, 0, imm)
+
+    def decodeBranch(self, instr):
+        rs1, rs2 = (instr >> 15) & 31, (instr >> 20) & 31
+        factory = BranchFactories.get((instr >> 12) & 7)
+        if factory is None:
+            return self.illegal(instr)
+        return factory(self.regs, 0, rs1, rs2, decodeBimm(instr))
+
+    def decodeJAL(self, instr):
+        regs = self.regs
+        rd = (instr >> 7) & 31
+        imm = decodeJimm(instr)
+        def op(pc):
+            if rd:
+                regs[rd] = pc + 4
+            return (pc + imm) & MASK
+        return op
+
+    def decodeJALR(self, instr):
+        regs = self.regs
+        rd, rs1 = (instr >> 7) & 31, (instr >> 15) & 31
+        imm = decodeIimm(instr)
+        def op(pc):
+            target = (regs[rs1] + imm) & (MASK - 1)
+            if rd:
+                regs[rd] = pc + 4
+            return target
+        return op
+
+    def decodeLUI(self, instr):
+        regs = self.regs
+        rd = (instr >> 7) & 31
+        imm = decodeUimm(instr)
+        def op(pc):
+            if rd:
+                regs[rd] = imm
+            return pc + 4
+        return op
+
+    def decodeAUIPC(self, instr):
+        regs = self.regs
+        rd = (instr >> 7) & 31
+        imm = decodeUimm(instr)
+        def op(pc):
+            if rd:
+                regs[rd] = (pc + imm) & MASK
+            return pc + 4
+        return op
+
+    def decodeLoad(self, instr):
+        regs = self.regs
+        rd, rs1 = (instr >> 7) & 31, (instr >> 15) & 31
+        funct3 = (instr >> 12) & 7
+        imm = decodeIimm(instr)
+        load_word = self.load_word
+        if funct3 == 0b010:
+            def op(pc):
+                value = load_word((regs[rs1] + imm) & MASK)
+                if rd:
+                    regs[rd] = value
+                return pc + 4
+        elif funct3 in (0b000, 0b100, 0b001, 0b101):
+            shift_mask = 0b11 if funct3 & 1 == 0 else 0b10
+            width_mask = 0xff if funct3 & 1 == 0 else 0xffff
+            sign = 0 if funct3 & 0b100 else (width_mask + 1) >> 1
+            def op(pc):
+                addr = (regs[rs1] + imm) & MASK
+                value = (load_word(addr & ~3) >> ((addr & shift_mask) * 8)) \
+                    & width_mask
+                if rd:
+                    regs[rd] = ((value ^ sign) - sign) & MASK
+                return pc + 4
+        else:
+            return self.illegal(instr)
+        return op
+
+    def decodeStore(self, instr):
+        regs = self.regs
+        rs1, rs2 = (instr >> 15) & 31, (instr >> 20) & 31
+        width = {0b000: 1, 0b001: 2, 0b010: 4}.get((instr >> 12) & 7)
+        if width is None:
+            return self.illegal(instr)
+        imm = decodeSimm(instr)
+        store = self.store
+        def op(pc):
+            store((regs[rs1] + imm) & MASK, regs[rs2], width)
+            return pc + 4
+        return op
+
+    def decodeSystem(self, instr):
+        if instr == ECALL or instr == EBREAK:
+            def op(pc):
+                raise Halt()
+            return op
+        if (instr & 0xffffff) == 0b11110011 and self.debug_args is not None:
+            # TRACE debug instruction of the assembler
+            args = self.debug_args[instr >> 24]
+            def op(pc):
+                self.trace(pc, args)
+                return pc + 4
+            return op
+        # The CPU in the SOC stops on any other system instruction as well
+        def op(pc):
+            raise Halt()
+        return op
+
+    def trace(self, pc, args):
+        from riscv_assembler import reg2int
+        text = ", ".join("{}={}".format(a, signed(self.regs[reg2int(a)]))
+                         for a in args)
+        print("TRACE pc=0x{:04x}: {}".format(pc, text), file=sys.stderr)
+
+    ## Execution
+
+    def step(self):
+        pc = self.pc
+        f = self.code[pc >> 2]
+        if f is None:
+            f = self.code[pc >> 2] = self.decode(self.load_word(pc))
+        self.pc = f(pc)
+        self.instret += 1
+
+    def run(self, max_instructions=None):
+        # Returns True when the program stopped at ECALL / EBREAK, False when
+        # max_instructions were executed.
+        code = self.code
+        decode = self.decode
+        load_word = self.load_word
+        pc = self.pc
+        n = 0
+        limit = max_instructions if max_instructions is not None else -1
+        halted = False
+        try:
+            while n != limit:
+                f = code[pc >> 2]
+                if f is None:
+                    f = code[pc >> 2] = decode(load_word(pc))
+                pc = f(pc)
+                n += 1
+        except Halt:
+            halted = True
+        except IndexError:
+            raise SimError("Memory access out of RAM at pc=0x{:x}".format(pc))
+        finally:
+            self.pc = pc
+            self.instret += n
+        return halted
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run RISC-V firmware in the instruction set simulator")
+    parser.add_argument("sources", nargs="*",
+                        help="assembler source files (default: test code)")
+    parser.add_argument("-n", "--max-instructions", type=int, default=None)
+    parser.add_argument("--ram-size", type=int, default=6 * 1024)
+    args = parser.parse_args()
+
+    a = RiscvAssembler(simulation=True, relax=True)
+    if args.sources:
+        for filename in args.sources:
+            with open(filename) as f:
+                a.read(f.read(), filename)
+    else:
+        a.read(a.testCode())
+    a.assemble()
+
+    sim = RiscvSim(a.mem, ram_size=args.ram_size, debug_args=a.debug_args)
+    start = time.perf_counter()
+    halted = sim.run(args.max_instructions)
+    elapsed = time.perf_counter() - start
+    sys.stdout.flush()
+
+    print("\n{} after {} instructions, pc=0x{:x}, {:.2f} MIPS".format(
+        "halted" if halted else "stopped", sim.instret, sim.pc,
+        sim.instret / elapsed / 1e6 if elapsed > 0 else 0), file=sys.stderr)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+from regression import root, bench_environment
+
+# Throughput of the Amaranth simulator on the SOC of every step:
+#
+#   python tools/sim_benchmark.py                   steps 04-18 and tests
+#   python tools/sim_benchmark.py 18 tests --cycles 50000 --repeat 3
+#
+# For every step, in a process of its own (see regression.py), it measures
+#
+#   construct   SOC()
+#   elaborate   Fragment.get() of the SOC
+#   assemble    assembling the firmware, which steps 07-12 do in SOC() and
+#               steps 13-18 in elaborate(). It is taken out of construct and
+#               elaborate, so that those compare across steps.
+#   compile     Simulator() of the elaborated design
+#   run         simulating --cycles cycles of the slow domain, which the
+#               CPUs of all these steps run in
+#
+# and from the run the simulated cycles and instructions per second. The
+# instructions are counted from cpu.retire where the CPU has it, otherwise
+# as the number of times the pc changes.
+#
+# Every run is appended to the history file (default sim_benchmark.json)
+# together with the Amaranth and Python versions and the git commit, and
+# compared with the run before it. Times that grew or rates that dropped by
+# more than --threshold percent are reported as regressions, and the exit
+# status is 1 when there are any.
+
+default_steps = ["04_instruction_decoder", "05_register_bank", "06_alu",
+                 "07_assembler", "08_jumps", "09_branches", "10_lui_auipc",
+                 "11_modules", "12_size_optimisation", "13_subroutines",
+                 "14_subroutines_v2", "15_load", "16_store",
+                 "17_memory_map", "18_mandelbrot", "tests"]
+
+# Metric -> True when larger is better
+metrics = {"construct": False, "elaborate": False, "assemble": False,
+           "compile": False, "cycles_per_s": True, "instr_per_s": True}
+
+def time_assembler(totals):
+    # Adds the time spent in RiscvAssembler.read() and assemble() to
+    # totals["assemble"], once for nested calls (the runtime library is
+    # assembled from within assemble())
+    from riscv_assembler import RiscvAssembler
+    depth = [0]
+
+    def timed(method):
+        def wrapper(*args, **kwargs):
+            depth[0] += 1
+            t0 = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                depth[0] -= 1
+                if depth[0] == 0:
+                    totals["assemble"] += time.perf_counter() - t0
+        return wrapper
+
+    RiscvAssembler.read = timed(RiscvAssembler.read)
+    RiscvAssembler.assemble = timed(RiscvAssembler.assemble)
+
+def measure(cycles):
+    # Runs in the directory of the step, returns the measurements
+    from amaranth import Fragment
+    from amaranth.sim import Simulator
+    from clockworks import add_clocks, enable_simulation_clock
+    from soc import SOC
+
+    # As the benches of 02-12 do, the simulator drives divided slow clocks
+    enable_simulation_clock()
+    totals = {"assemble": 0.0}
+    time_assembler(totals)
+    t0 = time.perf_counter()
+    soc = SOC()
+    t1 = time.perf_counter()
+    construct_asm = totals["assemble"]
+    fragment = Fragment.get(soc, None)
+    t2 = time.perf_counter()
+    elaborate_asm = totals["assemble"] - construct_asm
+    sim = Simulator(fragment)
+    t3 = time.perf_counter()
+
+    cpu = getattr(soc, "cpu", soc)
+    retire = getattr(cpu, "retire", None)
+    pc = getattr(cpu, "pc", None)
+    result = {"instructions": 0}
+
+    async def testbench(ctx):
+        instructions = 0
+        prev_pc = None
+        for _ in range(cycles):
+            if retire is not None:
+                instructions += ctx.get(retire)
+            elif pc is not None:
+                value = ctx.get(pc)
+                instructions += value != prev_pc
+                prev_pc = value
+            await ctx.tick("slow")
+        result["instructions"] = instructions
+
+    add_clocks(sim, 1e-6, soc)
+    sim.add_testbench(testbench)
+    t4 = time.perf_counter()
+    sim.run()
+    t5 = time.perf_counter()
+
+    run = t5 - t4
+    return {"construct": t1 - t0 - construct_asm,
+            "elaborate": t2 - t1 - elaborate_asm,
+            "assemble": totals["assemble"], "compile": t3 - t2,
+            "run": run, "cycles": cycles,
+            "instructions": result["instructions"],
+            "cycles_per_s": cycles / run,
+            "instr_per_s": result["instructions"] / run}
+
+def run_worker(step, cycles, timeout):
+    # Measurements of one step in a new process, or {"error": ...}
+    command = [sys.executable, os.path.abspath(__file__), "--worker",
+               "--cycles", str(cycles)]
+    try:
+        p = subprocess.run(command, cwd=os.path.join(root, step),
+                           env=bench_environment(), stdin=subprocess.DEVNULL,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return {"error": "no result after {}s".format(timeout)}
+    # The SOCs print while they are elaborated, the result is the last line
+    lines = p.stdout.decode(errors="replace").splitlines()
+    if p.returncode != 0 or not lines or not lines[-1].startswith("{"):
+        error = p.stderr.decode(errors="replace").strip().splitlines()
+        return {"error": error[-1] if error else
+                "exit status {}".format(p.returncode)}
+    return json.loads(lines[-1])
+
+def best(results):
+    # The fastest of repeated runs of a step
+    ok = [r for r in results if "error" not in r]
+    if not ok:
+        return results[-1]
+    return max(ok, key=lambda r: r["cycles_per_s"])
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=root, capture_output=True, check=True
+                              ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(previous, current, threshold):
+    # Regressions of current against previous as text lines
+    lines = []
+    for step, result in current["steps"].items():
+        before = previous["steps"].get(step)
+        if before is None or "error" in before or "error" in result:
+            continue
+        for metric, larger_is_better in metrics.items():
+            # Runs from before assemble was measured do not have it
+            if metric not in before:
+                continue
+            old, new = before[metric], result[metric]
+            if old <= 0:
+                continue
+            change = (new - old) / old * 100
+            worse = -change if larger_is_better else change
+            if worse > threshold:
+                lines.append("{:24} {:13} {:12.4g} -> {:12.4g} ({:+.1f}%)"
+                             .format(step, metric, old, new, change))
+    return lines
+
+def load_history(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+def select_steps(names):
+    if not names:
+        return default_steps
+    steps = []
+    for name in names:
+        matches = [s for s in default_steps
+                   if s == name or s.split("_")[0] == name.zfill(2)]
+        if not matches:
+            raise SystemExit("no step '{}'".format(name))
+        steps += matches
+    return steps
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the simulation throughput of every step")
+    parser.add_argument("steps", nargs="*",
+                        help="step numbers or directories (default: 04-18 "
+                        "and tests)")
+    parser.add_argument("--cycles", type=int, default=20000,
+                        help="cycles to simulate per step (default 20000)")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs per step, the fastest counts")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="wall seconds per run (default 600)")
+    parser.add_argument("--history", default="sim_benchmark.json",
+                        metavar="FILE",
+                        help="JSON history file (default sim_benchmark.json)")
+    parser.add_argument("--threshold", type=float, default=10,
+                        help="percent change reported as a regression "
+                        "(default 10)")
+    parser.add_argument("--worker", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        sys.path.insert(0, os.getcwd())
+        print(json.dumps(measure(args.cycles)))
+        sys.exit(0)
+
+    import amaranth
+    entry = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+             "commit": git_commit(),
+             "amaranth": getattr(amaranth, "__version__", None),
+             "python": sys.version.split()[0], "cycles": args.cycles,
+             "steps": {}}
+    print("{:24} {:>9} {:>9} {:>9} {:>9} {:>11} {:>11}".format(
+        "step", "construct", "elaborate", "assemble", "compile", "cycles/s",
+        "instr/s"))
+    for step in select_steps(args.steps):
+        r = best([run_worker(step, args.cycles, args.timeout)
+                  for _ in range(args.repeat)])
+        entry["steps"][step] = r
+        if "error" in r:
+            print("{:24} error: {}".format(step, r["error"]))
+        else:
+            print("{:24} {:8.2f}s {:8.2f}s {:8.2f}s {:8.2f}s {:11.0f} "
+                  "{:11.0f}".format(step, r["construct"], r["elaborate"],
+                                    r["assemble"], r["compile"],
+                                    r["cycles_per_s"], r["instr_per_s"]),
+                  flush=True)
+
+    history = load_history(args.history)
+    regressions = []
+    if history:
+        previous = history[-1]
+        regressions = compare(previous, entry, args.threshold)
+        print()
+        if regressions:
+            print("Regressions of more than {}% since {} ({}):".format(
+                args.threshold, previous["date"], previous["commit"]))
+            for line in regressions:
+                print("  " + line)
+        else:
+            print("No regressions of more than {}% since {} ({})".format(
+                args.threshold, previous["date"], previous["commit"]))
+    history.append(entry)
+    with open(args.history, "w") as f:
+        json.dump(history, f, indent=2)
+    sys.exit(1 if regressions else 0)